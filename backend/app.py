@@ -1,14 +1,31 @@
+import io
 import os
 import json
-import sqlite3
-from datetime import datetime
-from flask import Flask, request, jsonify
+import base64
+import hashlib
+import itertools
+import math
+import random
+import threading
+import time
+import uuid
+from flask import Flask, Response, g, request, jsonify, send_file, stream_with_context, url_for
 from flask_cors import CORS
 from PIL import Image
 
 from inference import StableDiffusionInference
-from fine_tuning import train
-from utils import base64_to_image
+from remote_inference import RemoteInference
+from broker import make_broker
+from utils import IMAGE_FORMATS, base64_to_image, clean_prompt, encode_image, make_contact_sheet, make_thumbnail
+from cache import ResultCache
+from jobs import JobQueue, QueueClosedError, QueueFullError, FINISHED_STATES, SUCCEEDED
+from db import Database
+from blob_store import BlobStore, MIME_TYPES, SCRATCH_DIR, ScratchStore, decode_data_url, encode_data_url
+from schedulers import sampling_options
+from memory import MemoryBudgetError
+from search import PromptIndex, fts_query
+from training import TrainingBusyError, TrainingOrchestrator
+from metrics import REGISTRY, STAGE_SECONDS
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -16,55 +33,272 @@ CORS(app)
 
 # Configuration
 MODEL_DIR = os.environ.get("MODEL_DIR", "./models")
+MODEL_ID = os.environ.get("MODEL_ID", "CompVis/stable-diffusion-v1-4")
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR") or None
+MODEL_WARMUP = os.environ.get("MODEL_WARMUP", "1") == "1"
+MAX_RESIDENT_MODELS = int(os.environ.get("MAX_RESIDENT_MODELS", 2))
+MAX_RESIDENT_ADAPTERS = int(os.environ.get("MAX_RESIDENT_ADAPTERS", 8))
+CPU_PROFILE = os.environ.get("CPU_PROFILE", "baseline")
+TORCH_NUM_THREADS = int(os.environ.get("TORCH_NUM_THREADS", 0)) or None
+TORCH_INTEROP_THREADS = int(os.environ.get("TORCH_INTEROP_THREADS", 0)) or None
+MEMORY_BUDGET_MB = int(os.environ.get("MEMORY_BUDGET_MB", 6144))
+VAE_TILE_SIZE = int(os.environ.get("VAE_TILE_SIZE", 512))
 DB_PATH = os.environ.get("DB_PATH", "./images.db")
+BLOB_DIR = os.environ.get("BLOB_DIR", "./blobs")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", 5))
 FINETUNED_MODEL_PATH = os.path.join(MODEL_DIR, "unet_final")
+DEFAULT_QUALITY = os.environ.get("DEFAULT_QUALITY", "standard")
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", 50))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 4))
+EMBEDDING_CACHE_MB = int(os.environ.get("EMBEDDING_CACHE_MB", 64))
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 1024))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", 32))
+JOB_STREAM_KEEPALIVE = 15
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", 256))
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "png")
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 90))
+PNG_COMPRESS_LEVEL = int(os.environ.get("PNG_COMPRESS_LEVEL", 1))
+ENCODE_THREADS = int(os.environ.get("ENCODE_THREADS", 4))
+TRAINING_THREADS = int(os.environ.get("TRAINING_THREADS", 0)) or max(1, (os.cpu_count() or 2) // 2)
+TRAINING_STATUS_PATH = os.environ.get("TRAINING_STATUS_PATH", os.path.join(MODEL_DIR, "training_status.json"))
+SEARCH_BACKFILL = os.environ.get("SEARCH_BACKFILL", "0") == "1"
+WEIGHTS_DIR = os.environ.get("WEIGHTS_DIR") or None
+# Images in one /api/generate/batch request, and in each batch it runs as
+MAX_GRID_SIZE = int(os.environ.get("MAX_GRID_SIZE", 64))
+GRID_CHUNK_SIZE = int(os.environ.get("GRID_CHUNK_SIZE", 8))
+# Run generations on inference worker processes through this broker instead of in this process
+BROKER_URL = os.environ.get("BROKER_URL", "")
+TASK_TIMEOUT = float(os.environ.get("TASK_TIMEOUT", 600))
+TASK_MAX_ATTEMPTS = int(os.environ.get("TASK_MAX_ATTEMPTS", 3))
+WORKER_LEASE_SECONDS = float(os.environ.get("WORKER_LEASE_SECONDS", 30))
+# Keep job state in the database, so server processes can serve each other's jobs
+SHARED_JOBS = os.environ.get("SHARED_JOBS", "0") == "1"
+MAX_PAGE_SIZE = 100
 
 # Ensure model directory exists
 os.makedirs(MODEL_DIR, exist_ok=True)
 
 # Initialize database
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS images (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        prompt TEXT NOT NULL,
-        image_data TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        seed INTEGER,
-        params TEXT,
-        feedback INTEGER DEFAULT 0
-    )
-    ''')
-    conn.commit()
-    conn.close()
+db = Database(DB_PATH, pool_size=DB_POOL_SIZE, busy_timeout=DB_BUSY_TIMEOUT)
+db.init_schema()
+
+# Image bytes live on disk; the images table only references them
+blob_store = BlobStore(BLOB_DIR)
+
+def row_image_bytes(row):
+    """Return a row's image as ``(bytes, format)``, reading it from the blob store when migrated"""
+    if row['blob_ref']:
+        return blob_store.get(row['blob_ref'], row['blob_format']), row['blob_format']
+    return decode_data_url(row['image_data'])
+
+def row_image_data(row):
+    """Return a row's image as a data URL, reading it from the blob store when migrated"""
+    if row['blob_ref']:
+        return encode_data_url(*row_image_bytes(row))
+    return row['image_data']
+
+def image_row_to_dict(row):
+    """Serialize an images row, inlining its image and linking to the raw bytes"""
+    image = dict(row)
+    image['image_data'] = row_image_data(row)
+    image['image_url'] = url_for('get_image_raw', image_id=row['id'], _external=True)
+    image['thumbnail_url'] = url_for('get_image_thumbnail', image_id=row['id'], _external=True)
+    for column in ('blob_ref', 'blob_format', 'thumb_ref', 'thumb_format'):
+        image.pop(column, None)
+    return image
+
+def image_summary(row):
+    """Serialize image metadata with thumbnail and raw image URLs but no image data"""
+    return {
+        **dict(row),
+        "thumbnail_url": url_for('get_image_thumbnail', image_id=row['id'], _external=True),
+        "image_url": url_for('get_image_raw', image_id=row['id'], _external=True),
+    }
+
+def store_thumbnail(data):
+    """Store a thumbnail for raw image bytes and return ``(digest, format)``"""
+    thumbnail = make_thumbnail(Image.open(io.BytesIO(data)), THUMBNAIL_SIZE)
+    thumb_ref, _ = blob_store.put(thumbnail, 'webp')
+    return thumb_ref, 'webp'
+
+def store_image(prompt, data, blob_format, seed, params):
+    """Store encoded image bytes and a thumbnail in the blob store, returning the row to insert for them"""
+    with STAGE_SECONDS.time("blob_write"):
+        blob_ref, blob_size = blob_store.put(data, blob_format)
+        thumb_ref, thumb_format = store_thumbnail(data)
+    return {
+        'prompt': prompt,
+        'seed': seed,
+        'params': params,
+        'blob_ref': blob_ref,
+        'blob_size': blob_size,
+        'blob_format': blob_format,
+        'thumb_ref': thumb_ref,
+        'thumb_format': thumb_format,
+    }
+
+def encode_cursor(created_at, image_id):
+    """Encode a gallery position as an opaque cursor string"""
+    return base64.urlsafe_b64encode(json.dumps([created_at, image_id]).encode()).decode()
 
-init_db()
+def decode_cursor(cursor):
+    created_at, image_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return created_at, int(image_id)
 
 # Initialize the inference model
-if os.path.exists(FINETUNED_MODEL_PATH):
-    inference = StableDiffusionInference(model_path=FINETUNED_MODEL_PATH)
+inference_options = {
+    "model_id": MODEL_ID,
+    "batch_window": BATCH_WINDOW_MS / 1000,
+    "max_batch_size": MAX_BATCH_SIZE,
+    "embedding_cache_bytes": EMBEDDING_CACHE_MB * 1024 * 1024,
+    "cache_dir": MODEL_CACHE_DIR,
+    "model_dir": MODEL_DIR,
+    "max_resident_models": MAX_RESIDENT_MODELS,
+    "max_adapters": MAX_RESIDENT_ADAPTERS,
+    "cpu_profile": CPU_PROFILE,
+    "num_threads": TORCH_NUM_THREADS,
+    "interop_threads": TORCH_INTEROP_THREADS,
+    # A budget of 0 disables the memory limit
+    "memory_budget_bytes": MEMORY_BUDGET_MB * 1024 * 1024 or None,
+    "vae_tile_size": VAE_TILE_SIZE,
+    "encode_threads": ENCODE_THREADS,
+    "png_compress_level": PNG_COMPRESS_LEVEL,
+    "weights_dir": WEIGHTS_DIR,
+}
+
+broker = make_broker(BROKER_URL, lease_seconds=WORKER_LEASE_SECONDS, max_attempts=TASK_MAX_ATTEMPTS)
+
+if broker is not None:
+    # Workers started with inference_worker.py load the model; this process never does
+    inference = RemoteInference(
+        broker,
+        ScratchStore(os.path.join(BLOB_DIR, SCRATCH_DIR)),
+        MODEL_ID,
+        MODEL_DIR,
+        memory_budget_bytes=inference_options["memory_budget_bytes"],
+        vae_tile_size=VAE_TILE_SIZE,
+        task_timeout=TASK_TIMEOUT,
+    )
+elif os.path.exists(FINETUNED_MODEL_PATH):
+    inference = StableDiffusionInference(model_path=FINETUNED_MODEL_PATH, **inference_options)
 else:
     # Use the base model if no fine-tuned model exists
-    inference = StableDiffusionInference()
+    inference = StableDiffusionInference(**inference_options)
 
-@app.route('/api/generate', methods=['POST'])
-def generate_image():
-    data = request.json
+# Weights load in the background so the server accepts health checks immediately
+if MODEL_WARMUP:
+    inference.warmup()
+
+# Cache of seeded generation requests, mapping request parameters to stored image ids
+result_cache = ResultCache(RESULT_CACHE_SIZE)
+
+# Background workers for asynchronous generation jobs
+job_queue = JobQueue(
+    num_workers=JOB_WORKERS,
+    max_pending=JOB_QUEUE_SIZE,
+    store=db if SHARED_JOBS else None,
+)
+
+def drain(timeout=None):
+    """Stop taking jobs and wait for queued and running ones, before the process exits"""
+    return job_queue.close(timeout)
+
+# Similarity index over prompt embeddings, loaded from the vectors stored so far
+prompt_index = PromptIndex()
+prompt_index_rowid = 0
+prompt_index_lock = threading.Lock()
+
+def sync_prompt_index():
+    """Add vectors stored since the last sync, including those of other server processes"""
+    global prompt_index_rowid
+    with prompt_index_lock:
+        for batch in db.iter_prompt_vectors(after_rowid=prompt_index_rowid):
+            prompt_index.add(
+                [prompt for _, prompt, _ in batch],
+                [PromptIndex.from_bytes(vector) for _, _, vector in batch],
+            )
+            prompt_index_rowid = batch[-1][0]
+
+sync_prompt_index()
+
+def index_prompts(prompts):
+    """Add prompts missing from the similarity index, storing their vectors"""
+    prompts = [prompt for prompt in dict.fromkeys(prompts) if prompt not in prompt_index]
+    if not prompts:
+        return
     
-    if not data or 'prompt' not in data:
-        return jsonify({"error": "Prompt is required"}), 400
+    # Embeddings of freshly generated prompts are already in the text cache
+    vectors = inference.embed_prompts(prompts)
+    prompt_index.add(prompts, vectors)
+    db.save_prompt_vectors([
+        (prompt, PromptIndex.to_bytes(vector)) for prompt, vector in zip(prompts, vectors)
+    ])
+
+def try_index_prompts(prompts):
+    # Search indexing must never fail a generation request
+    try:
+        index_prompts(prompts)
+    except Exception as e:
+        print(f"Error indexing prompts for search: {e}")
+
+def backfill_prompt_index(batch_size=64):
+    """Embed prompts stored before similarity search existed"""
+    while True:
+        prompts = db.prompts_missing_vectors(batch_size)
+        if not prompts:
+            return
+        try:
+            index_prompts(prompts)
+        except Exception as e:
+            print(f"Stopping prompt index backfill: {e}")
+            return
+
+if SEARCH_BACKFILL:
+    threading.Thread(target=backfill_prompt_index, name="prompt-index-backfill", daemon=True).start()
+
+def register_trained_model(name, path):
+    # Checkpoints under MODEL_DIR are found by the registry anyway; this makes one servable right away
+    if inference.ready:
+        inference.registry.register(name, path)
+
+# Fine-tuning on positively rated images, in a separate process
+trainer = TrainingOrchestrator(
+    MODEL_DIR,
+    db,
+    BLOB_DIR,
+    TRAINING_STATUS_PATH,
+    num_threads=TRAINING_THREADS,
+    model_id=MODEL_ID,
+    on_complete=register_trained_model,
+)
+
+def encode_previews(progress_callback):
+    """Wrap a job's progress callback so preview images reach it as small WebP data URLs"""
+    if progress_callback is None:
+        return None
+    
+    def report_progress(step, total_steps, preview=None):
+        if preview is not None:
+            preview = encode_data_url(make_thumbnail(preview, size=max(preview.size), quality=60), 'webp')
+        progress_callback(step, total_steps, preview=preview)
     
+    return report_progress
+
+def create_image(data, progress_callback=None):
+    """Generate an image for a request body and store it, returning the response payload"""
     prompt = data.get('prompt')
     negative_prompt = data.get('negative_prompt', '')
     height = data.get('height', 512)
     width = data.get('width', 512)
-    num_inference_steps = data.get('num_inference_steps', 50)
+    scheduler, num_inference_steps = sampling_options(data, DEFAULT_QUALITY)
     guidance_scale = data.get('guidance_scale', 7.5)
     seed = data.get('seed')
+    image_format, quality = output_options(data)
+    model_name, model_version = inference.resolve_model(data.get('model'))
     
-    try:
+    def run_generation():
         # Generate image
         result = inference.generate_image(
             prompt=prompt,
@@ -74,36 +308,562 @@ def generate_image():
             num_inference_steps=num_inference_steps,
             guidance_scale=guidance_scale,
             seed=seed,
+            progress_callback=encode_previews(progress_callback),
+            model=model_name,
+            scheduler=scheduler,
+            preview_every=int(data.get('preview_every') or 0),
+            image_format=image_format,
+            quality=quality,
         )
         
         # Save to database
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
         params = json.dumps({
             'negative_prompt': negative_prompt,
             'height': height,
             'width': width,
             'num_inference_steps': num_inference_steps,
             'guidance_scale': guidance_scale,
+            'scheduler': scheduler,
+            'model': model_name,
         })
         
-        cursor.execute(
-            'INSERT INTO images (prompt, image_data, seed, params) VALUES (?, ?, ?, ?)',
-            (prompt, result['image'], result['seed'], params)
-        )
-        
-        image_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        row = store_image(prompt, result['image'], result['format'], result['seed'], params)
+        with STAGE_SECONDS.time("db_write"):
+            image_id, = db.insert_images([row])
+        try_index_prompts([prompt])
         
-        return jsonify({
+        return {
             "id": image_id,
             "image": result['image'],
+            "format": result['format'],
             "prompt": result['prompt'],
-            "seed": result['seed']
-        })
+            "seed": result['seed'],
+            "model": model_name
+        }
+    
+    # Without an explicit seed the result is random and cannot be reused
+    if seed is None:
+        return run_generation()
+    
+    cache_key = ResultCache.make_key(
+        model_version,
+        clean_prompt(prompt),
+        negative_prompt,
+        height,
+        width,
+        scheduler,
+        num_inference_steps,
+        guidance_scale,
+        seed,
+        image_format,
+        quality,
+    )
+    
+    def generate_and_store():
+        return run_generation()["id"]
+    
+    # Identical requests reuse the stored image or share the in-flight run.
+    # A cached image that was deleted since is generated again, once.
+    for _ in range(2):
+        image_id, cached = result_cache.get_or_compute(cache_key, generate_and_store)
+        row = db.get_image(image_id)
+        if row is not None:
+            break
+        result_cache.invalidate(cache_key)
+    else:
+        raise RuntimeError("The generated image was deleted before it could be returned")
+    
+    image, image_format = row_image_bytes(row)
+    return {
+        "id": row['id'],
+        "image": image,
+        "format": image_format,
+        "prompt": clean_prompt(row['prompt']),
+        "seed": row['seed'],
+        "model": model_name,
+        "cached": cached
+    }
+
+def create_variations(data, progress_callback=None):
+    """Generate variations for a request body and store them, returning the response payload"""
+    image_data = data.get('image')
+    prompt = data.get('prompt', '')
+    negative_prompt = data.get('negative_prompt', '')
+    strength = data.get('strength', 0.75)
+    scheduler, num_inference_steps = sampling_options(data, DEFAULT_QUALITY)
+    guidance_scale = data.get('guidance_scale', 7.5)
+    num_variations = data.get('num_variations', 4)
+    model_name = data.get('model')
+    image_format, quality = output_options(data)
+    
+    # Convert base64 to PIL Image
+    image = base64_to_image(image_data)
+    
+    # Generate variations
+    results = inference.generate_variations(
+        image=image,
+        prompt=prompt,
+        negative_prompt=negative_prompt,
+        strength=strength,
+        num_inference_steps=num_inference_steps,
+        guidance_scale=guidance_scale,
+        num_variations=num_variations,
+        progress_callback=encode_previews(progress_callback),
+        model=model_name,
+        scheduler=scheduler,
+        preview_every=int(data.get('preview_every') or 0),
+        image_format=image_format,
+        quality=quality,
+    )
+    
+    params = json.dumps({
+        'negative_prompt': negative_prompt,
+        'strength': strength,
+        'num_inference_steps': num_inference_steps,
+        'guidance_scale': guidance_scale,
+        'scheduler': scheduler,
+        'model': results[0]['model'] if results else model_name,
+    })
+    
+    # Write all variations in one transaction
+    rows = [
+        store_image(result['prompt'], result['image'], result['format'], result['seed'], params)
+        for result in results
+    ]
+    with STAGE_SECONDS.time("db_write"):
+        variation_ids = db.insert_images(rows)
+    try_index_prompts([row['prompt'] for row in rows])
+    
+    return [
+        {
+            "id": variation_id,
+            "image": result['image'],
+            "format": result['format'],
+            "prompt": result['prompt'],
+            "seed": result['seed'],
+            "model": result['model']
+        }
+        for variation_id, result in zip(variation_ids, results)
+    ]
+
+GRID_AXES = ('prompt', 'guidance_scale', 'num_inference_steps', 'seed')
+
+def grid_items(data):
+    """Expand a batch request body into one item per image
+
+    ``grid`` maps any of ``GRID_AXES`` to a list of values that replace
+    the body's own setting; ``seed_count`` is shorthand for a seed axis
+    counting up from ``seed``, or from a random seed. Items cover every
+    combination, with the last axis in ``GRID_AXES`` changing fastest, and
+    record theirs in ``grid``. Returns ``(items, columns)``, where columns
+    is the length of the fastest changing axis, for laying out a contact sheet.
+    """
+    grid = data.get('grid') or {}
+    if not isinstance(grid, dict) or set(grid) - set(GRID_AXES):
+        raise ValueError(f"Grid axes must be among {', '.join(GRID_AXES)}")
+    grid = dict(grid)
+    
+    seed_count = data.get('seed_count')
+    if seed_count is not None:
+        if 'seed' in grid:
+            raise ValueError("Give either seed_count or a seed axis, not both")
+        if not isinstance(seed_count, int) or seed_count < 1:
+            raise ValueError("seed_count must be a positive integer")
+        base_seed = data.get('seed')
+        if base_seed is None:
+            base_seed = random.randrange(2**32)
+        grid['seed'] = [(base_seed + i) % 2**32 for i in range(seed_count)]
+    
+    axes = [axis for axis in GRID_AXES if axis in grid]
+    for axis in axes:
+        if not isinstance(grid[axis], list) or not grid[axis]:
+            raise ValueError(f"Grid axis '{axis}' must be a non-empty list")
+    size = math.prod(len(grid[axis]) for axis in axes)
+    if size > MAX_GRID_SIZE:
+        raise ValueError(f"The grid has {size} images; at most {MAX_GRID_SIZE} are allowed")
+    
+    _, num_inference_steps = sampling_options(data, DEFAULT_QUALITY)
+    base = {
+        'prompt': data.get('prompt'),
+        'negative_prompt': data.get('negative_prompt', ''),
+        'guidance_scale': data.get('guidance_scale', 7.5),
+        'num_inference_steps': num_inference_steps,
+        'seed': data.get('seed'),
+    }
+    items = []
+    for values in itertools.product(*(grid[axis] for axis in axes)):
+        coordinates = dict(zip(axes, values))
+        item = {**base, **coordinates, 'grid': coordinates}
+        if not isinstance(item['prompt'], str) or not item['prompt'].strip():
+            raise ValueError("Every prompt must be a non-empty string")
+        if not isinstance(item['guidance_scale'], (int, float)):
+            raise ValueError("Guidance scale must be a number")
+        if not isinstance(item['num_inference_steps'], int) or item['num_inference_steps'] < 1:
+            raise ValueError("Inference steps must be a positive integer")
+        if item['seed'] is not None and not isinstance(item['seed'], int):
+            raise ValueError("Seeds must be integers")
+        items.append(item)
+    
+    return items, len(grid[axes[-1]]) if axes else 1
+
+def generate_batch(data, items):
+    """Generate a batch request's items chunk by chunk, yielding each chunk's stored results
+
+    Each chunk's images are written to the blob store and their rows
+    inserted in one transaction as soon as it finishes, so its results
+    carry their ``id`` along with the item's ``index`` and ``grid`` coordinates.
+    """
+    height = data.get('height', 512)
+    width = data.get('width', 512)
+    scheduler, _ = sampling_options(data, DEFAULT_QUALITY)
+    image_format, quality = output_options(data)
+    model_name, _ = inference.resolve_model(data.get('model'))
+    
+    chunks = inference.generate_grid(
+        [{key: value for key, value in item.items() if key != 'grid'} for item in items],
+        height=height,
+        width=width,
+        model=model_name,
+        scheduler=scheduler,
+        image_format=image_format,
+        quality=quality,
+        max_chunk_size=GRID_CHUNK_SIZE,
+    )
+    for chunk in chunks:
+        rows = []
+        results = []
+        for index, result in chunk:
+            item = items[index]
+            params = json.dumps({
+                'negative_prompt': item['negative_prompt'],
+                'height': height,
+                'width': width,
+                'num_inference_steps': item['num_inference_steps'],
+                'guidance_scale': item['guidance_scale'],
+                'scheduler': scheduler,
+                'model': model_name,
+            })
+            rows.append(store_image(result['prompt'], result['image'], result['format'], result['seed'], params))
+            results.append({
+                "index": index,
+                "grid": item['grid'],
+                "image": result['image'],
+                "format": result['format'],
+                "prompt": result['prompt'],
+                "seed": result['seed'],
+                "model": model_name,
+            })
+        
+        with STAGE_SECONDS.time("db_write"):
+            image_ids = db.insert_images(rows)
+        try_index_prompts([row['prompt'] for row in rows])
+        for result, image_id in zip(results, image_ids):
+            result['id'] = image_id
+        yield results
+
+def contact_sheet(data, results, columns):
+    """A data URL of the results tiled in grid order, one row per value of the slower axes"""
+    image_format, quality = output_options(data)
+    images = [Image.open(io.BytesIO(result['image'])) for result in sorted(results, key=lambda r: r['index'])]
+    sheet = make_contact_sheet(images, columns, cell_size=THUMBNAIL_SIZE)
+    return encode_data_url(encode_image(sheet, image_format, quality, PNG_COMPRESS_LEVEL), image_format)
+
+def output_options(data):
+    """Return the ``(format, image quality)`` a request's images are encoded with
+
+    The body's ``format`` wins, then an ``image/*`` type the client accepts,
+    then the server default.
+    """
+    image_format = data.get('format')
+    if image_format is not None and not isinstance(image_format, str):
+        raise ValueError("Format must be a string")
+    if image_format is None and response_mode() == 'binary':
+        image_format = accepted_image_format()
+    image_format = normalize_format(image_format or IMAGE_FORMAT)
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Format must be one of {', '.join(IMAGE_FORMATS)}")
+    
+    # ``quality`` already names the sampling tier
+    quality = data.get('image_quality', IMAGE_QUALITY)
+    if not isinstance(quality, int) or not 1 <= quality <= 100:
+        raise ValueError("Image quality must be an integer from 1 to 100")
+    return image_format, quality
+
+def normalize_format(image_format):
+    image_format = image_format.lower()
+    return 'jpeg' if image_format == 'jpg' else image_format
+
+def response_mode():
+    """How the client asked to receive images: ``json``, ``binary`` or ``multipart``"""
+    best = request.accept_mimetypes.best_match(['application/json', 'multipart/mixed', 'image/*'])
+    if best == 'multipart/mixed':
+        return 'multipart'
+    if best == 'image/*' or (best is None and accepted_image_format()):
+        return 'binary'
+    return 'json'
+
+def accepted_image_format():
+    """The first supported image type named in the Accept header, if any"""
+    for mimetype, q in request.accept_mimetypes:
+        if q > 0 and mimetype.startswith('image/'):
+            image_format = normalize_format(mimetype[len('image/'):])
+            if image_format in IMAGE_FORMATS:
+                return image_format
+    return None
+
+def image_metadata(result):
+    """A result without its image bytes"""
+    return {key: value for key, value in result.items() if key not in ('image', 'format')}
+
+def json_result(result):
+    """A result with its image inlined as a data URL, ready to serialize as JSON"""
+    return {**image_metadata(result), "image": encode_data_url(result['image'], result['format'])}
+
+def json_results(results):
+    if isinstance(results, dict):
+        return json_result(results)
+    return [json_result(result) for result in results]
+
+def image_filename(result):
+    return f"{result['id']}.{result['format']}"
+
+def binary_response(result):
+    """One image as raw bytes, with its metadata in ``X-Image-*`` headers"""
+    response = Response(result['image'], mimetype=MIME_TYPES[result['format']])
+    response.headers['X-Image-Id'] = str(result['id'])
+    response.headers['X-Image-Seed'] = str(result['seed'])
+    response.headers['X-Image-Model'] = result['model']
+    if 'cached' in result:
+        response.headers['X-Image-Cached'] = str(result['cached']).lower()
+    response.headers['Content-Disposition'] = f'inline; filename="{image_filename(result)}"'
+    return response
+
+def multipart_response(results):
+    """A JSON part with the results' metadata, shaped as in JSON responses, then one part per image"""
+    items = [results] if isinstance(results, dict) else results
+    if isinstance(results, dict):
+        metadata = image_metadata(results)
+    else:
+        metadata = [image_metadata(result) for result in results]
+    
+    parts = [('Content-Type: application/json', json.dumps(metadata).encode())]
+    for result in items:
+        headers = (
+            f"Content-Type: {MIME_TYPES[result['format']]}\r\n"
+            f'Content-Disposition: inline; name="image"; filename="{image_filename(result)}"'
+        )
+        parts.append((headers, result['image']))
+    
+    boundary = uuid.uuid4().hex
+    body = b''.join(
+        f'--{boundary}\r\n{headers}\r\n\r\n'.encode() + content + b'\r\n'
+        for headers, content in parts
+    )
+    return Response(body + f'--{boundary}--\r\n'.encode(), mimetype=f'multipart/mixed; boundary={boundary}')
+
+def image_response(results):
+    """Answer with generated images as JSON, raw bytes or a multipart body, as the client asked
+
+    Raw bytes need a single image; several images asked for as ``image/*``
+    come back as a multipart body instead.
+    """
+    mode = response_mode()
+    if mode == 'binary' and isinstance(results, dict):
+        return binary_response(results)
+    if mode != 'json':
+        return multipart_response(results)
+    return jsonify(json_results(results))
+
+def check_memory(data):
+    """Validate a generate request's image size and check that it fits in the memory budget"""
+    height = data.get('height', 512)
+    width = data.get('width', 512)
+    if not all(isinstance(dim, int) and dim > 0 and dim % 8 == 0 for dim in (height, width)):
+        raise ValueError("Height and width must be positive multiples of 8")
+    guidance_scale = data.get('guidance_scale', 7.5)
+    if not isinstance(guidance_scale, (int, float)):
+        raise ValueError("Guidance scale must be a number")
+    inference.plan_memory(height, width, guidance_scale=guidance_scale)
+
+def check_variations_memory(data):
+    """Check that variations of a request's image fit in the memory budget"""
+    try:
+        size = base64_to_image(data['image']).size
+    except OSError:
+        raise ValueError("Image could not be decoded")
+    width, height = (dim - dim % 8 for dim in size)
+    num_variations = data.get('num_variations', 4)
+    if not isinstance(num_variations, int) or num_variations < 1:
+        raise ValueError("Number of variations must be a positive integer")
+    guidance_scale = data.get('guidance_scale', 7.5)
+    if not isinstance(guidance_scale, (int, float)):
+        raise ValueError("Guidance scale must be a number")
+    inference.plan_memory(height, width, batch_size=num_variations, guidance_scale=guidance_scale)
+
+def memory_error_response(e):
+    return jsonify({
+        "error": str(e),
+        "estimated_mb": e.estimated_bytes // 2**20,
+        "budget_mb": e.budget_bytes // 2**20,
+    }), 413
+
+def job_result(results):
+    """What a finished job keeps of its results: their metadata, without the image bytes"""
+    if isinstance(results, dict):
+        return image_metadata(results)
+    return [image_metadata(result) for result in results]
+
+def inline_job_result(job):
+    """A job snapshot with its result's images inlined as data URLs, as in synchronous JSON responses"""
+    if job['state'] != SUCCEEDED or job.get('result') is None:
+        return job
+    
+    def inline(result):
+        row = db.get_image(result['id'])
+        return {
+            **result,
+            "image": row_image_data(row) if row is not None else None,
+            "image_url": url_for('get_image_raw', image_id=result['id'], _external=True),
+        }
+    
+    result = job['result']
+    job['result'] = inline(result) if isinstance(result, dict) else [inline(item) for item in result]
+    return job
+
+def submit_job(kind, func, data):
+    """Queue a generation job, answering 202 with its id or 429 when the queue is full"""
+    try:
+        job = job_queue.submit(
+            kind,
+            # The images are in the blob store already; they are inlined when the job is read
+            lambda report_progress: job_result(func(data, report_progress)),
+            priority=data.get('priority', 0),
+        )
+    except QueueFullError as e:
+        response = jsonify({"error": str(e), "retry_after": e.retry_after})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+    except QueueClosedError as e:
+        return jsonify({"error": str(e)}), 503
+    
+    return jsonify({"job_id": job.id, "state": job.state}), 202
+
+# Prometheus metrics; gauges are read from the components' own stats on every scrape.
+# Worker processes of serve.py each count their own requests, so their series are labelled apart
+if os.environ.get("WORKER_SLOT") is not None:
+    REGISTRY.const_labels["worker"] = os.environ["WORKER_SLOT"]
+REQUESTS = REGISTRY.counter(
+    "http_requests_total",
+    "HTTP requests served, by route and status",
+    labels=("method", "endpoint", "status"),
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_duration_seconds",
+    "Time to serve an HTTP request, by route",
+    labels=("method", "endpoint"),
+)
+
+CACHE_STATS = {"text_embedding": inference.text_cache_stats, "result": result_cache.stats}
+
+def cache_gauge(name, help, field, kind="gauge"):
+    """Expose one field of every cache's stats, labelled by cache"""
+    read = lambda: {cache: stats().get(field) for cache, stats in CACHE_STATS.items()}
+    REGISTRY.gauge(name, help, read, labels=("cache",), kind=kind)
+
+cache_gauge("sd_cache_hits_total", "Cache lookups that found an entry", "hits", kind="counter")
+cache_gauge("sd_cache_misses_total", "Cache lookups that found no entry", "misses", kind="counter")
+cache_gauge("sd_cache_hit_ratio", "Share of cache lookups that found an entry", "hit_rate")
+cache_gauge("sd_cache_entries", "Entries held in each cache", "entries")
+
+REGISTRY.gauge("sd_jobs_queued", "Jobs waiting for a worker", lambda: job_queue.stats()["queued"])
+REGISTRY.gauge("sd_jobs_running", "Jobs being processed", lambda: job_queue.stats()["running"])
+if broker is not None:
+    REGISTRY.gauge("sd_broker_tasks", "Broker tasks in each state", broker.counts, labels=("state",))
+    REGISTRY.gauge("sd_inference_workers", "Live inference workers", lambda: len(broker.workers()))
+else:
+    REGISTRY.gauge("sd_batch_queue_depth", "Generation requests waiting to be batched", inference.scheduler.pending)
+REGISTRY.gauge(
+    "sd_resident_model_bytes",
+    "Weight memory of each resident U-Net",
+    lambda: inference.registry.resident_bytes() if inference.ready else {},
+    labels=("model",),
+)
+REGISTRY.gauge(
+    "sd_db_queries_total",
+    "Database queries run, by query",
+    lambda: {name: stats["count"] for name, stats in db.metrics.snapshot().items()},
+    labels=("query",),
+    kind="counter",
+)
+REGISTRY.gauge(
+    "sd_db_query_seconds_total",
+    "Time spent running database queries, by query",
+    lambda: {name: stats["total_time"] for name, stats in db.metrics.snapshot().items()},
+    labels=("query",),
+    kind="counter",
+)
+REGISTRY.gauge(
+    "sd_training_samples_per_second",
+    "Throughput of the running training run",
+    lambda: trainer.status().get("samples_per_second") if trainer.active else 0,
+)
+REGISTRY.gauge("sd_training_step", "Step of the current or last training run", lambda: trainer.status().get("step", 0))
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    # Label by route pattern, not path, so image ids don't create a series each
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    if 'request_start' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, request.method, endpoint)
+    REQUESTS.inc(request.method, endpoint, str(response.status_code))
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    # Liveness: the server is up even while the model is still loading
+    return jsonify({"status": "ok", "model": inference.status()})
+
+@app.route('/api/health/ready', methods=['GET'])
+def readiness():
+    status = inference.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/api/generate', methods=['POST'])
+def generate_image():
+    data = request.json
+    
+    if not data or 'prompt' not in data:
+        return jsonify({"error": "Prompt is required"}), 400
+    
+    if data.get('model') and not inference.registry.exists(data['model']):
+        return jsonify({"error": "Unknown model"}), 400
     
+    try:
+        sampling_options(data, DEFAULT_QUALITY)
+        check_memory(data)
+        # Resolved now, since async jobs run without the request's Accept header
+        data['format'], data['image_quality'] = output_options(data)
+    except MemoryBudgetError as e:
+        return memory_error_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if data.get('async'):
+        return submit_job('generate', create_image, data)
+    
+    try:
+        return image_response(create_image(data))
+    
+    except MemoryBudgetError as e:
+        return memory_error_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -114,102 +874,339 @@ def generate_variations():
     if not data or 'image' not in data:
         return jsonify({"error": "Image is required"}), 400
     
-    image_data = data.get('image')
-    prompt = data.get('prompt', '')
-    negative_prompt = data.get('negative_prompt', '')
-    strength = data.get('strength', 0.75)
-    num_inference_steps = data.get('num_inference_steps', 50)
-    guidance_scale = data.get('guidance_scale', 7.5)
-    num_variations = data.get('num_variations', 4)
+    if data.get('model') and not inference.registry.exists(data['model']):
+        return jsonify({"error": "Unknown model"}), 400
     
     try:
-        # Convert base64 to PIL Image
-        image = base64_to_image(image_data)
-        
-        # Generate variations
-        results = inference.generate_variations(
-            image=image,
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            strength=strength,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            num_variations=num_variations,
-        )
+        sampling_options(data, DEFAULT_QUALITY)
+        check_variations_memory(data)
+        # Resolved now, since async jobs run without the request's Accept header
+        data['format'], data['image_quality'] = output_options(data)
+    except MemoryBudgetError as e:
+        return memory_error_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if data.get('async'):
+        return submit_job('variations', create_variations, data)
+    
+    try:
+        return image_response(create_variations(data))
+    
+    except MemoryBudgetError as e:
+        return memory_error_response(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/generate/batch', methods=['POST'])
+def generate_batch_images():
+    data = request.json
+    
+    if not data or ('prompt' not in data and 'prompt' not in (data.get('grid') or {})):
+        return jsonify({"error": "Prompt is required"}), 400
+    
+    if data.get('model') and not inference.registry.exists(data['model']):
+        return jsonify({"error": "Unknown model"}), 400
+    
+    try:
+        items, columns = grid_items(data)
+        for guidance_scale in {item['guidance_scale'] for item in items}:
+            check_memory({**data, 'guidance_scale': guidance_scale})
+        output_options(data)
+    except MemoryBudgetError as e:
+        return memory_error_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    stream = data.get('stream') or request.accept_mimetypes.best == 'text/event-stream'
+    if not stream:
+        try:
+            results = [result for chunk in generate_batch(data, items) for result in chunk]
+        except MemoryBudgetError as e:
+            return memory_error_response(e)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
         
-        variations = []
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        results.sort(key=lambda result: result['index'])
+        return jsonify({
+            "items": json_results(results),
+            "contact_sheet": contact_sheet(data, results, columns) if data.get('contact_sheet') else None,
+        })
+    
+    def events():
+        # Chunks that finished before an error or a client disconnect stay stored
+        results = []
+        try:
+            for chunk in generate_batch(data, items):
+                results.extend(chunk)
+                yield f"event: images\ndata: {json.dumps(json_results(chunk))}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+            return
         
+        # Chunks finish grouped by settings, so put the ids back in grid order
+        ids = [None] * len(items)
         for result in results:
-            params = json.dumps({
-                'negative_prompt': negative_prompt,
-                'strength': strength,
-                'num_inference_steps': num_inference_steps,
-                'guidance_scale': guidance_scale,
-            })
-            
-            cursor.execute(
-                'INSERT INTO images (prompt, image_data, seed, params) VALUES (?, ?, ?, ?)',
-                (result['prompt'], result['image'], result['seed'], params)
-            )
-            
-            variation_id = cursor.lastrowid
-            
-            variations.append({
-                "id": variation_id,
-                "image": result['image'],
-                "prompt": result['prompt'],
-                "seed": result['seed']
-            })
+            ids[result['index']] = result['id']
+        done = {
+            "ids": ids,
+            "contact_sheet": contact_sheet(data, results, columns) if data.get('contact_sheet') else None,
+        }
+        yield f"event: done\ndata: {json.dumps(done)}\n\n"
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+@app.route('/api/models', methods=['GET'])
+def list_models():
+    try:
+        registry = inference.registry
+        resident = inference.resident_models()
         
-        conn.commit()
-        conn.close()
+        models = [
+            {
+                "name": name,
+                "version": checkpoint['version'],
+                "adapter": checkpoint['adapter'],
+                "resident": name in resident,
+                "default": name == registry.default,
+            }
+            for name, checkpoint in registry.checkpoints().items()
+        ]
         
-        return jsonify(variations)
+        return jsonify(models)
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/models/default', methods=['POST'])
+def set_default_model():
+    data = request.json
+    
+    if not data or 'name' not in data:
+        return jsonify({"error": "Model name is required"}), 400
+    
+    if not inference.registry.exists(data['name']):
+        return jsonify({"error": "Unknown model"}), 404
+    
+    try:
+        # Loads the model before switching, so new requests never wait on it
+        name, version = inference.set_default_model(data['name'])
+        return jsonify({"name": name, "version": version})
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    
+    return jsonify(inline_job_result(job))
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(inline_job_result(job))
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_job(job_id):
+    if job_queue.get(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+    
+    # Clients streaming a job they own can have it cancelled when they go away
+    cancel_on_close = request.args.get('cancel_on_close') == '1'
+    
+    def events():
+        version = None
+        preview_step = None
+        finished = False
+        try:
+            while True:
+                job, new_version = job_queue.wait_for_update(job_id, version, timeout=JOB_STREAM_KEEPALIVE)
+                if job is None:
+                    return
+                
+                if new_version == version:
+                    # Comment lines keep proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                
+                version = new_version
+                finished = job['state'] in FINISHED_STATES
+                
+                # Send each preview once instead of repeating it with every progress update
+                preview = job.pop('preview')
+                if preview and preview['step'] != preview_step:
+                    preview_step = preview['step']
+                    yield f"event: preview\ndata: {json.dumps(preview)}\n\n"
+                
+                yield f"event: {job['state']}\ndata: {json.dumps(inline_job_result(job))}\n\n"
+                
+                if finished:
+                    return
+        finally:
+            # Runs when the client disconnects mid-stream, freeing the worker for other jobs
+            if cancel_on_close and not finished:
+                job_queue.cancel(job_id)
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+@app.route('/api/search', methods=['GET'])
+def search_images():
+    query = request.args.get('q', '').strip()
+    mode = request.args.get('mode', 'text')
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_PAGE_SIZE)
+    
+    if not query:
+        return jsonify({"error": "Query is required"}), 400
+    
+    try:
+        if mode == 'text':
+            match_query = fts_query(query)
+            rows = db.search_prompts(match_query, limit) if match_query else []
+            return jsonify({"items": [image_summary(row) for row in rows]})
+        
+        if mode == 'similar':
+            vector = inference.embed_prompts([query])[0]
+            sync_prompt_index()
+            matches = prompt_index.search(vector, limit)
+            scores = dict(matches)
+            
+            rows = db.latest_images_for_prompts(list(scores))
+            items = [{**image_summary(row), "score": scores[row['prompt']]} for row in rows]
+            items.sort(key=lambda item: item['score'], reverse=True)
+            return jsonify({"items": items})
+        
+        return jsonify({"error": "Mode must be 'text' or 'similar'"}), 400
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/images', methods=['GET'])
 def get_images():
+    if request.args.get('view') == 'thumbnails':
+        return list_thumbnails()
+    
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
         limit = request.args.get('limit', 20, type=int)
         offset = request.args.get('offset', 0, type=int)
         
-        cursor.execute(
-            'SELECT id, prompt, image_data, created_at, seed, feedback FROM images ORDER BY created_at DESC LIMIT ? OFFSET ?',
-            (limit, offset)
-        )
-        
-        images = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        images = [image_row_to_dict(row) for row in db.list_images(limit, offset)]
         
         return jsonify(images)
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def list_thumbnails():
+    """Gallery listing with thumbnail URLs only, paginated by a (created_at, id) cursor"""
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_PAGE_SIZE)
+    feedback = request.args.get('feedback', type=int)
+    prompt_filter = request.args.get('q')
+    
+    after = None
+    if request.args.get('cursor'):
+        try:
+            after = decode_cursor(request.args['cursor'])
+        except Exception:
+            return jsonify({"error": "Invalid cursor"}), 400
+    
+    try:
+        rows = db.list_image_page(limit, after=after, feedback=feedback, prompt_filter=prompt_filter)
+        
+        items = [image_summary(row) for row in rows[:limit]]
+        
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = encode_cursor(last['created_at'], last['id'])
+        
+        return jsonify({"items": items, "next_cursor": next_cursor})
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/images/<int:image_id>', methods=['GET'])
 def get_image(image_id):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        row = db.get_image(image_id)
         
-        cursor.execute('SELECT * FROM images WHERE id = ?', (image_id,))
+        if not row:
+            return jsonify({"error": "Image not found"}), 404
         
-        row = cursor.fetchone()
-        conn.close()
+        return jsonify(image_row_to_dict(row))
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/images/<int:image_id>/thumbnail', methods=['GET'])
+def get_image_thumbnail(image_id):
+    try:
+        row = db.get_image(image_id)
         
         if not row:
             return jsonify({"error": "Image not found"}), 404
         
-        return jsonify(dict(row))
+        thumb_ref, thumb_format = row['thumb_ref'], row['thumb_format']
+        
+        # Images stored before thumbnails existed get one on first request
+        if not thumb_ref:
+            if row['blob_ref']:
+                data = blob_store.get(row['blob_ref'], row['blob_format'])
+            else:
+                data, _ = decode_data_url(row['image_data'])
+            thumb_ref, thumb_format = store_thumbnail(data)
+            db.set_thumbnail(image_id, thumb_ref, thumb_format)
+        
+        return send_file(
+            blob_store.path(thumb_ref, thumb_format),
+            mimetype=MIME_TYPES.get(thumb_format),
+            etag=thumb_ref,
+            conditional=True,
+            max_age=31536000,
+        )
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/images/<int:image_id>/raw', methods=['GET'])
+def get_image_raw(image_id):
+    try:
+        row = db.get_image(image_id)
+        
+        if not row:
+            return jsonify({"error": "Image not found"}), 404
+        
+        # Blobs are content-addressed, so their digest is a strong ETag and never changes
+        if row['blob_ref']:
+            return send_file(
+                blob_store.path(row['blob_ref'], row['blob_format']),
+                mimetype=MIME_TYPES.get(row['blob_format']),
+                etag=row['blob_ref'],
+                conditional=True,
+                max_age=31536000,
+            )
+        
+        # Rows not yet migrated still hold a data URL
+        data, image_format = decode_data_url(row['image_data'])
+        return send_file(
+            io.BytesIO(data),
+            mimetype=MIME_TYPES.get(image_format),
+            etag=hashlib.sha256(data).hexdigest(),
+            conditional=True,
+        )
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -225,18 +1222,9 @@ def save_feedback():
     feedback = data.get('feedback')
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('UPDATE images SET feedback = ? WHERE id = ?', (feedback, image_id))
-        
-        if cursor.rowcount == 0:
-            conn.close()
+        if not db.update_feedback(image_id, feedback):
             return jsonify({"error": "Image not found"}), 404
         
-        conn.commit()
-        conn.close()
-        
         return jsonify({"success": True})
     
     except Exception as e:
@@ -244,55 +1232,55 @@ def save_feedback():
 
 @app.route('/api/retrain', methods=['POST'])
 def retrain_model():
+    data = request.json or {}
+    
     try:
-        # Get the training parameters
-        data = request.json or {}
-        learning_rate = data.get('learning_rate', 1e-5)
-        num_epochs = data.get('num_epochs', 5)
-        batch_size = data.get('batch_size', 1)
-        
-        # Start fine-tuning
-        output_dir = os.path.join(MODEL_DIR, f"retrained_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
-        
-        # This is a placeholder for starting the training process
-        # In a real application, you would likely run this in a separate thread or process
-        # to avoid blocking the API
-        return jsonify({
-            "message": "Retraining started",
-            "output_dir": output_dir,
-            "parameters": {
-                "learning_rate": learning_rate,
-                "num_epochs": num_epochs,
-                "batch_size": batch_size
-            }
-        })
+        parameters = {
+            "learning_rate": float(data.get('learning_rate', 1e-5)),
+            "num_epochs": int(data.get('num_epochs', 5)),
+            "batch_size": int(data.get('batch_size', 1)),
+            # LoRA adapters train in a fraction of the memory of the full U-Net; 0 trains every weight
+            "lora_rank": int(data.get('lora_rank', 4)),
+        }
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid training parameters"}), 400
+    
+    try:
+        status = trainer.start(parameters)
+        return jsonify({"message": "Retraining started", **status}), 202
     
+    except TrainingBusyError as e:
+        return jsonify({"error": str(e)}), 409
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+@app.route('/api/retrain/resume', methods=['POST'])
+def resume_training():
+    try:
+        status = trainer.start(resume=True)
+        return jsonify({"message": "Retraining resumed", **status}), 202
+    
+    except TrainingBusyError as e:
+        return jsonify({"error": str(e)}), 409
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
+@app.route('/api/retrain/cancel', methods=['POST'])
+def cancel_training():
+    if not trainer.cancel():
+        return jsonify({"error": "No training run in progress"}), 409
+    return jsonify(trainer.status())
 
 @app.route('/api/retrain/status', methods=['GET'])
 def get_training_status():
-    # This endpoint would typically retrieve the status from a database or file
-    # For demonstration purposes, we'll return a mock status
-    if os.path.exists('training_status.json'):
-        try:
-            with open('training_status.json', 'r') as f:
-                status = json.load(f)
-                return jsonify(status)
-        except Exception as e:
-            return jsonify({"error": str(e)}), 500
-    else:
-        return jsonify({
-            "active": False,
-            "progress": 0,
-            "current_epoch": 0,
-            "total_epochs": 0,
-            "current_loss": 0.0,
-            "completed": False,
-            "start_time": None,
-            "end_time": None
-        })
\ No newline at end of file
+    try:
+        return jsonify(trainer.status())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+if __name__ == '__main__':
+    app.run(debug=True, host='0.0.0.0', port=5000)
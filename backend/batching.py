@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class BatchRequest:
+    def __init__(self, key, payload):
+        self.key = key
+        self.payload = payload
+        self.arrival = time.monotonic()
+        self.future = Future()
+
+
+class BatchScheduler:
+    """Collect compatible requests arriving within a window and run them as one batch.
+
+    Requests are grouped by ``key``; only requests sharing a key are batched
+    together. A single worker thread owns ``run_batch``, so the wrapped model
+    is never called concurrently. ``run_batch`` returns one result per
+    request; an exception in place of a result fails just that request.
+    """
+
+    def __init__(self, run_batch, window=0.05, max_batch_size=4, name="batch-scheduler"):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch_size = max(1, max_batch_size)
+
+        # Pending requests grouped by key, oldest key first
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, key, payload):
+        """Queue a request and return a Future resolved with its result"""
+        request = BatchRequest(key, payload)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Batch scheduler is closed")
+            self._pending.setdefault(key, []).append(request)
+            self._cond.notify()
+        return request.future
+
+    def pending(self):
+        """Number of requests waiting to be batched"""
+        with self._cond:
+            return sum(len(queue) for queue in self._pending.values())
+
+    def close(self):
+        """Stop accepting requests and let the worker exit once the queue is drained"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                if self._closed:
+                    return None, []
+                self._cond.wait()
+
+            # Serve the key whose oldest request has waited longest
+            key, queue = next(iter(self._pending.items()))
+            deadline = queue[0].arrival + self.window
+
+            # Wait for more compatible requests until the window closes or the batch is full
+            while len(queue) < self.max_batch_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = queue[:self.max_batch_size]
+            del queue[:self.max_batch_size]
+            if not queue:
+                del self._pending[key]
+
+            return key, batch
+
+    def _loop(self):
+        while True:
+            key, batch = self._next_batch()
+            if not batch:
+                return
+
+            # Skip requests whose callers already gave up
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                results = self.run_batch(key, [request.payload for request in batch])
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            for request, result in zip(batch, results):
+                if isinstance(result, BaseException):
+                    request.future.set_exception(result)
+                else:
+                    request.future.set_result(result)
+
+
+def grid_chunks(items, chunk_size):
+    """Split grid items into batches that can run as one denoising run
+
+    Items batch together when they share a guidance scale and step count;
+    ``chunk_size(guidance_scale, num_inference_steps)`` caps the size of
+    each batch. Returns ``(guidance_scale, num_inference_steps, indices)``
+    triples, grouped in the order the settings first appear in ``items``.
+    """
+    groups = OrderedDict()
+    for index, item in enumerate(items):
+        groups.setdefault((item["guidance_scale"], item["num_inference_steps"]), []).append(index)
+
+    chunks = []
+    for (guidance_scale, num_inference_steps), indices in groups.items():
+        size = max(1, chunk_size(guidance_scale, num_inference_steps))
+        for start in range(0, len(indices), size):
+            chunks.append((guidance_scale, num_inference_steps, indices[start:start + size]))
+    return chunks
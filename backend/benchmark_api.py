@@ -0,0 +1,444 @@
+"""Load-test the Flask API end to end with a tiny stand-in model, fully offline.
+
+The server runs in a subprocess on a fresh database, blob store and model
+directory, loading a tiny randomly initialized model (see ``tiny_model.py``)
+unless ``--model-id`` names real weights. With ``--workers`` it runs
+under ``serve.py`` with that many worker processes instead of Flask's
+development server. ``/api/generate``,
+``/api/variations``, ``/api/images`` and ``/api/feedback`` are then driven
+in turn by ``--concurrency`` clients. Every request is seeded, so runs
+are reproducible. Example:
+
+    python benchmark_api.py --requests 64 --concurrency 8 --output results.json
+    python benchmark_api.py --env MAX_BATCH_SIZE=1 --baseline results.json
+
+``--baseline`` compares against an earlier run's JSON output, such as one
+recorded on another commit.
+"""
+import argparse
+import base64
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROMPTS = [
+    "A beautiful sunset over the ocean",
+    "A red fox in a snowy forest",
+    "An astronaut riding a horse on the moon",
+    "A bowl of ramen, studio lighting",
+    "A watercolor painting of a lighthouse",
+]
+
+SERVER_SCRIPT = """
+import sys
+from app import app
+app.run(host="127.0.0.1", port=int(sys.argv[1]), threaded=True)
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def call(base_url, method, path, body=None, timeout=600):
+    """Send a request, returning ``(status, response body, seconds)``"""
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(base_url + path, data=data, method=method)
+    if data is not None:
+        request.add_header("Content-Type", "application/json")
+
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status, content = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, content = e.code, e.read()
+    return status, content, time.perf_counter() - start
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of already sorted values"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def process_tree(pid):
+    """A process and all of its descendants, such as gunicorn's workers"""
+    pids = [pid]
+    for parent in pids:
+        try:
+            with open(f"/proc/{parent}/task/{parent}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def read_kb(path, fields):
+    """Values in kB of ``fields`` in a /proc status-style file, or None if it can't be read"""
+    values = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in fields:
+                    values[name] = int(value.split()[0])
+    except OSError:
+        return None
+    return values
+
+
+def process_memory(pid):
+    """Resident memory of a process and its descendants in MB, from /proc (Linux only)
+
+    RSS counts pages shared between processes, such as memory-mapped
+    weights, once in every process; PSS divides them among the processes
+    sharing them, so it adds up to the memory actually used.
+    """
+    totals = {}
+    for member in process_tree(pid):
+        for path, fields in ((f"/proc/{member}/status", ("VmRSS", "VmHWM")), (f"/proc/{member}/smaps_rollup", ("Pss",))):
+            for name, value in (read_kb(path, fields) or {}).items():
+                totals[name] = totals.get(name, 0) + value
+    return {
+        key: totals[name] / 1024 if name in totals else None
+        for key, name in (("rss_mb", "VmRSS"), ("peak_rss_mb", "VmHWM"), ("pss_mb", "Pss"))
+    }
+
+
+def directory_bytes(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def database_bytes(db_path):
+    """Size of a SQLite database including its write-ahead log"""
+    return sum(
+        os.path.getsize(db_path + suffix)
+        for suffix in ("", "-wal", "-shm")
+        if os.path.exists(db_path + suffix)
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=BACKEND_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(args, work_dir, model_id, log):
+    """Start the API on a free port, logging to ``log``, and return ``(process, base URL)``"""
+    port = free_port()
+    env = {
+        **os.environ,
+        "MODEL_ID": model_id,
+        "MODEL_DIR": os.path.join(work_dir, "models"),
+        "DB_PATH": os.path.join(work_dir, "images.db"),
+        "BLOB_DIR": os.path.join(work_dir, "blobs"),
+        "MODEL_WARMUP": "1",
+        # Never reach for the network, even for a missing file
+        "HF_HUB_OFFLINE": "1",
+        "TRANSFORMERS_OFFLINE": "1",
+    }
+    for setting in args.env:
+        name, _, value = setting.partition("=")
+        env[name] = value
+
+    if args.workers:
+        command = [
+            sys.executable, "serve.py",
+            "--workers", str(args.workers),
+            "--bind", f"127.0.0.1:{port}",
+            "--weights-dir", os.path.join(work_dir, "weights"),
+        ]
+    else:
+        command = [sys.executable, "-c", SERVER_SCRIPT, str(port)]
+
+    process = subprocess.Popen(
+        command,
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    return process, f"http://127.0.0.1:{port}"
+
+
+def wait_until_ready(process, base_url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}; see server.log")
+        try:
+            status, _, _ = call(base_url, "GET", "/api/health/ready", timeout=5)
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"Server was not ready after {timeout} seconds")
+
+
+def run_phase(name, base_url, requests, concurrency):
+    """Send ``(method, path, body)`` requests from ``concurrency`` clients and summarize their latencies"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        responses = list(pool.map(lambda request: call(base_url, *request), requests))
+    wall_time = time.perf_counter() - start
+
+    latencies = sorted(seconds for status, _, seconds in responses if status < 400)
+    errors = [status for status, _, _ in responses if status >= 400]
+    if errors:
+        print(f"{name}: {len(errors)} of {len(requests)} requests failed (status {sorted(set(errors))})")
+
+    return {
+        "endpoint": name,
+        "requests": len(requests),
+        "errors": len(errors),
+        "wall_time": wall_time,
+        "throughput": len(latencies) / wall_time if wall_time else None,
+        "latency": {
+            "mean": statistics.mean(latencies) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        },
+    }, responses
+
+
+def generate_body(i, args):
+    return {
+        "prompt": PROMPTS[i % len(PROMPTS)],
+        # Distinct seeds, so no request is answered from the result cache
+        "seed": i,
+        "height": args.size,
+        "width": args.size,
+        "num_inference_steps": args.steps,
+        "format": args.format,
+    }
+
+
+def run_benchmark(args, work_dir, model_id):
+    log = open(os.path.join(work_dir, "server.log"), "w")
+    process, base_url = start_server(args, work_dir, model_id, log)
+    try:
+        start = time.perf_counter()
+        wait_until_ready(process, base_url, args.startup_timeout)
+        startup_time = time.perf_counter() - start
+        memory = {"startup": process_memory(process.pid)}
+
+        # Untimed requests, so lazy initialization doesn't count against the first phase
+        for i in range(args.warmup):
+            call(base_url, "POST", "/api/generate", generate_body(args.requests + i, args))
+
+        phases = []
+
+        result, responses = run_phase(
+            "generate",
+            base_url,
+            [("POST", "/api/generate", generate_body(i, args)) for i in range(args.requests)],
+            args.concurrency,
+        )
+        phases.append(result)
+        memory["generate"] = process_memory(process.pid)
+        image_ids = [json.loads(content)["id"] for status, content, _ in responses if status < 400]
+        if not image_ids:
+            raise RuntimeError("No image was generated; see server.log")
+
+        # Vary generated images, sent back the way a client uploads them
+        status, content, _ = call(base_url, "GET", f"/api/images/{image_ids[0]}/raw")
+        init_image = f"data:image/{args.format};base64," + base64.b64encode(content).decode()
+        result, _ = run_phase(
+            "variations",
+            base_url,
+            [
+                ("POST", "/api/variations", {
+                    "image": init_image,
+                    "prompt": PROMPTS[i % len(PROMPTS)],
+                    "num_variations": args.variations,
+                    "num_inference_steps": args.steps,
+                    "format": args.format,
+                })
+                for i in range(args.variation_requests)
+            ],
+            args.concurrency,
+        )
+        phases.append(result)
+        memory["variations"] = process_memory(process.pid)
+
+        result, _ = run_phase(
+            "images",
+            base_url,
+            [("GET", "/api/images?view=thumbnails&limit=20", None)] * args.requests,
+            args.concurrency,
+        )
+        phases.append(result)
+
+        result, _ = run_phase(
+            "feedback",
+            base_url,
+            [
+                ("POST", "/api/feedback", {"image_id": image_ids[i % len(image_ids)], "feedback": 1 if i % 2 else -1})
+                for i in range(args.requests)
+            ],
+            args.concurrency,
+        )
+        phases.append(result)
+        memory["end"] = process_memory(process.pid)
+
+        status, content, _ = call(base_url, "GET", "/metrics")
+        metrics = content.decode() if status == 200 else None
+    finally:
+        process.terminate()
+        process.wait()
+        log.close()
+
+    return {
+        "startup_time": startup_time,
+        "phases": phases,
+        "memory": memory,
+        "storage": {
+            "db_bytes": database_bytes(os.path.join(work_dir, "images.db")),
+            "blob_bytes": directory_bytes(os.path.join(work_dir, "blobs")),
+        },
+        "metrics": metrics,
+    }
+
+
+def relative_change(value, baseline):
+    if value is None or not baseline:
+        return None
+    return value / baseline - 1
+
+
+def compare(results, baseline):
+    """Relative change of each endpoint's p50 latency and throughput against a baseline run"""
+    previous = {phase["endpoint"]: phase for phase in baseline["phases"]}
+    changes = {}
+    for phase in results["phases"]:
+        before = previous.get(phase["endpoint"])
+        if before is None:
+            continue
+        changes[phase["endpoint"]] = {
+            "p50": relative_change(phase["latency"]["p50"], before["latency"]["p50"]),
+            "throughput": relative_change(phase["throughput"], before["throughput"]),
+        }
+    return changes
+
+
+def format_seconds(value):
+    return f"{value * 1000:>9.1f}" if value is not None else f"{'-':>9}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model-id", help="Weights to serve instead of a tiny random model")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the tiny model's weights")
+    parser.add_argument("--requests", type=int, default=32, help="Requests per endpoint")
+    parser.add_argument("--variation-requests", type=int, default=8)
+    parser.add_argument("--variations", type=int, default=2, help="Images per variations request")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--format", default="png", choices=["png", "webp", "jpeg"])
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed generations before measuring")
+    parser.add_argument("--workers", type=int, default=0, help="Serve with serve.py and this many workers")
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Server setting, such as MAX_BATCH_SIZE=8; may be repeated",
+    )
+    parser.add_argument("--work-dir", help="Keep the database, blobs and server log here instead of a temporary directory")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="benchmark-api-")
+    if args.work_dir:
+        # Every run starts from an empty database and blob store
+        for name in ("images.db", "images.db-wal", "images.db-shm", "blobs", "models", "weights"):
+            path = os.path.join(work_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        os.makedirs(work_dir, exist_ok=True)
+
+    try:
+        model_id = args.model_id
+        if model_id is None:
+            from tiny_model import build_tiny_model
+            model_id = build_tiny_model(os.path.join(work_dir, "tiny-model"), args.seed)
+
+        results = {
+            "commit": git_commit(),
+            "config": vars(args),
+            **run_benchmark(args, work_dir, model_id),
+        }
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["baseline"] = {"path": args.baseline, "changes": compare(results, json.load(f))}
+
+    print(f"{'endpoint':<12} {'requests':>8} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for phase in results["phases"]:
+        latency = phase["latency"]
+        print(
+            f"{phase['endpoint']:<12} {phase['requests']:>8} {phase['errors']:>7} {phase['throughput'] or 0:>8.2f} "
+            f"{format_seconds(latency['p50'])} {format_seconds(latency['p95'])} {format_seconds(latency['p99'])}"
+        )
+
+    memory = results["memory"]["end"]
+    storage = results["storage"]
+    if memory["rss_mb"] is not None:
+        print(f"Server memory: {memory['rss_mb']:.0f} MB resident, {memory['peak_rss_mb']:.0f} MB peak")
+    if memory["pss_mb"] is not None:
+        print(f"Server memory: {memory['pss_mb']:.0f} MB proportional set size, shared pages counted once")
+    print(f"Stored: {storage['db_bytes'] / 2**20:.1f} MB database, {storage['blob_bytes'] / 2**20:.1f} MB blobs")
+
+    if args.baseline:
+        print(f"Against {args.baseline}:")
+        for endpoint, change in results["baseline"]["changes"].items():
+            p50 = f"{change['p50']:+.1%}" if change["p50"] is not None else "-"
+            throughput = f"{change['throughput']:+.1%}" if change["throughput"] is not None else "-"
+            print(f"  {endpoint:<12} p50 {p50:>8}  throughput {throughput:>8}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
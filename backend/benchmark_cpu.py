@@ -0,0 +1,123 @@
+"""Compare CPU profiles by denoising speed and peak memory.
+
+Each profile runs in a fresh process, so its peak resident memory is not
+inflated by weights other profiles loaded before it. Example:
+
+    python benchmark_cpu.py --profiles baseline int8 bf16 --steps 20 --runs 3
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import statistics
+import time
+
+from cpu_profiles import CPU_PROFILES
+
+
+def run_profile(profile, args, results):
+    """Load the model with one profile, time a few generations and report back through ``results``"""
+    try:
+        from inference import StableDiffusionInference
+
+        inference = StableDiffusionInference(
+            model_id=args.model_id,
+            cache_dir=args.cache_dir,
+            batch_window=0,
+            cpu_profile=profile,
+            num_threads=args.threads,
+            interop_threads=args.interop_threads,
+        )
+
+        start = time.perf_counter()
+        inference.load()
+        load_time = time.perf_counter() - start
+
+        # Untimed run so lazy initialization doesn't count against the first sample
+        inference.generate_image(args.prompt, height=args.size, width=args.size, num_inference_steps=args.steps, seed=0)
+
+        step_times = []
+        latencies = []
+        for run in range(args.runs):
+            step_stamps = []
+            start = time.perf_counter()
+            inference.generate_image(
+                args.prompt,
+                height=args.size,
+                width=args.size,
+                num_inference_steps=args.steps,
+                seed=run,
+                progress_callback=lambda step, total: step_stamps.append(time.perf_counter()),
+            )
+            latencies.append(time.perf_counter() - start)
+
+            # Time between step callbacks excludes text encoding and VAE decoding
+            if len(step_stamps) > 1:
+                step_times.append((step_stamps[-1] - step_stamps[0]) / (len(step_stamps) - 1))
+
+        results.put({
+            "profile": profile,
+            "load_time": load_time,
+            "seconds_per_step": statistics.median(step_times) if step_times else None,
+            "latency": statistics.median(latencies),
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        })
+    except Exception as e:
+        results.put({"profile": profile, "error": str(e)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model-id", default="CompVis/stable-diffusion-v1-4")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--profiles", nargs="+", default=list(CPU_PROFILES), choices=list(CPU_PROFILES))
+    parser.add_argument("--prompt", default="A beautiful sunset over the ocean")
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--interop-threads", type=int, default=None)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    # Always measure the baseline so the other profiles have something to compare against
+    profiles = args.profiles if "baseline" in args.profiles else ["baseline"] + args.profiles
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for profile in profiles:
+        queue = context.Queue()
+        process = context.Process(target=run_profile, args=(profile, args, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+
+    # Relative speed and memory against the baseline
+    baseline = next(result for result in results if result["profile"] == "baseline")
+    for result in results:
+        if "error" in result or "error" in baseline:
+            continue
+        if result["seconds_per_step"] and baseline["seconds_per_step"]:
+            result["speedup"] = baseline["seconds_per_step"] / result["seconds_per_step"]
+        result["memory_ratio"] = result["peak_rss_mb"] / baseline["peak_rss_mb"]
+
+    print(f"{'profile':<12} {'s/step':>8} {'latency':>8} {'load':>8} {'peak MB':>9} {'speedup':>8} {'memory':>7}")
+    for result in results:
+        if "error" in result:
+            print(f"{result['profile']:<12} failed: {result['error']}")
+            continue
+        seconds_per_step = result["seconds_per_step"] or float("nan")
+        print(
+            f"{result['profile']:<12} {seconds_per_step:>8.3f} {result['latency']:>8.2f} "
+            f"{result['load_time']:>8.1f} {result['peak_rss_mb']:>9.0f} "
+            f"{result.get('speedup', float('nan')):>7.2f}x {result.get('memory_ratio', float('nan')):>6.2f}x"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
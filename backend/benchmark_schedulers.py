@@ -0,0 +1,124 @@
+"""Compare schedulers and step counts by latency and closeness to a full-quality reference.
+
+Every configuration renders the same prompts and seeds. Quality is the PSNR
+of each image against the image the reference configuration (50 PNDM steps
+by default) produced for the same prompt and seed, so higher means closer
+to full quality. Example:
+
+    python benchmark_schedulers.py --configs dpm++:18 dpm++:25 euler_a:20 unipc:18
+"""
+import argparse
+import io
+import json
+import statistics
+import time
+
+import numpy as np
+from PIL import Image
+
+from inference import StableDiffusionInference
+from schedulers import QUALITY_TIERS, SCHEDULERS
+
+DEFAULT_PROMPTS = [
+    "A serene mountain landscape at dawn with misty valleys and golden light",
+    "A futuristic city skyline at night with neon lights",
+    "A portrait of an old fisherman, detailed oil painting",
+]
+
+
+def decode(data):
+    return np.asarray(Image.open(io.BytesIO(data)).convert("RGB"), dtype=np.float64)
+
+
+def psnr(image, reference):
+    mse = np.mean((image - reference) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+def parse_config(text):
+    """Parse ``scheduler:steps``"""
+    scheduler, steps = text.rsplit(":", 1)
+    if scheduler not in SCHEDULERS:
+        raise argparse.ArgumentTypeError(f"Unknown scheduler '{scheduler}'")
+    return scheduler, int(steps)
+
+
+def render(inference, scheduler, steps, args):
+    """Render every prompt and seed, returning the images and per-image latencies"""
+    images = []
+    latencies = []
+    for prompt in args.prompts:
+        for seed in range(args.seeds):
+            start = time.perf_counter()
+            result = inference.generate_image(
+                prompt,
+                height=args.size,
+                width=args.size,
+                num_inference_steps=steps,
+                guidance_scale=args.guidance_scale,
+                seed=seed,
+                scheduler=scheduler,
+            )
+            latencies.append(time.perf_counter() - start)
+            images.append(decode(result["image"]))
+    return images, latencies
+
+
+def main():
+    tiers = [f"{tier['scheduler']}:{tier['num_inference_steps']}" for tier in QUALITY_TIERS.values()]
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model-id", default="CompVis/stable-diffusion-v1-4")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--configs", nargs="+", type=parse_config, default=[parse_config(tier) for tier in tiers])
+    parser.add_argument("--reference", type=parse_config, default=parse_config("pndm:50"))
+    parser.add_argument("--prompts", nargs="+", default=DEFAULT_PROMPTS)
+    parser.add_argument("--seeds", type=int, default=2)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--guidance-scale", type=float, default=7.5)
+    parser.add_argument("--cpu-profile", default="baseline")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    inference = StableDiffusionInference(
+        model_id=args.model_id,
+        cache_dir=args.cache_dir,
+        batch_window=0,
+        cpu_profile=args.cpu_profile,
+    )
+    inference.load()
+
+    reference_images, reference_latencies = render(inference, *args.reference, args)
+
+    results = []
+    for scheduler, steps in [args.reference] + [config for config in args.configs if config != args.reference]:
+        if (scheduler, steps) == args.reference:
+            images, latencies = reference_images, reference_latencies
+        else:
+            images, latencies = render(inference, scheduler, steps, args)
+
+        scores = [psnr(image, reference) for image, reference in zip(images, reference_images)]
+        finite_scores = [score for score in scores if score != float("inf")]
+        results.append({
+            "scheduler": scheduler,
+            "steps": steps,
+            "latency": statistics.median(latencies),
+            "speedup": statistics.median(reference_latencies) / statistics.median(latencies),
+            "psnr": statistics.mean(finite_scores) if finite_scores else None,
+        })
+
+    print(f"{'scheduler':<10} {'steps':>5} {'latency':>8} {'speedup':>8} {'PSNR dB':>8}")
+    for result in results:
+        psnr_text = "ref" if result["psnr"] is None else f"{result['psnr']:.1f}"
+        print(
+            f"{result['scheduler']:<10} {result['steps']:>5} {result['latency']:>8.2f} "
+            f"{result['speedup']:>7.2f}x {psnr_text:>8}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import base64
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+
+MIME_TYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+}
+
+# Directory under the blob store root of the scratch store, beside the two-hex-digit shards
+SCRATCH_DIR = "scratch"
+
+# Columns on the images table that reference a stored blob
+BLOB_COLUMNS = {
+    "blob_ref": "TEXT",
+    "blob_size": "INTEGER",
+    "blob_format": "TEXT",
+    "thumb_ref": "TEXT",
+    "thumb_format": "TEXT",
+}
+
+
+def add_blob_columns(conn):
+    """Add the blob reference columns to an images table created before the blob store"""
+    existing = {row[1] for row in conn.execute('PRAGMA table_info(images)')}
+    for name, column_type in BLOB_COLUMNS.items():
+        if name not in existing:
+            conn.execute(f'ALTER TABLE images ADD COLUMN {name} {column_type}')
+    conn.commit()
+
+
+def decode_data_url(data_url):
+    """Split a base64 data URL into raw bytes and an image format"""
+    header, _, payload = data_url.partition("base64,")
+    image_format = "png"
+    if header.startswith("data:image/"):
+        image_format = header[len("data:image/"):].split(";")[0] or image_format
+    if image_format == "jpg":
+        image_format = "jpeg"
+    return base64.b64decode(payload or header), image_format
+
+
+def encode_data_url(data, image_format):
+    """Build a base64 data URL from raw image bytes"""
+    encoded = base64.b64encode(data).decode("utf-8")
+    return f"data:{MIME_TYPES.get(image_format, 'application/octet-stream')};base64,{encoded}"
+
+
+class BlobStore:
+    """Content-addressed file store for image bytes.
+
+    Blobs are named by the SHA-256 of their content and sharded into two
+    levels of directories, so identical images are stored once and no single
+    directory grows too large.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, digest, image_format):
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}.{image_format}")
+
+    def put(self, data, image_format="png"):
+        """Store bytes and return ``(digest, size)``"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest, image_format)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomic(path, data)
+
+        return digest, len(data)
+
+    def put_data_url(self, data_url):
+        """Store a base64 data URL and return ``(digest, size, format)``"""
+        data, image_format = decode_data_url(data_url)
+        digest, size = self.put(data, image_format)
+        return digest, size, image_format
+
+    def get(self, digest, image_format):
+        with open(self.path(digest, image_format), "rb") as f:
+            return f.read()
+
+    def exists(self, digest, image_format):
+        return os.path.exists(self.path(digest, image_format))
+
+
+def write_atomic(path, data):
+    """Write bytes to a temporary file and rename it, so readers never see a partial file"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ScratchStore:
+    """Short-lived files handed between processes, such as images passed to and from inference workers.
+
+    Unlike ``BlobStore``, every file gets a name of its own, so deleting one
+    once it has been read never takes an image another request still
+    needs. ``prune`` removes the files a crashed reader left behind.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name, image_format):
+        return os.path.join(self.root, f"{name}.{image_format}")
+
+    def put(self, data, image_format="png"):
+        """Store bytes and return their name"""
+        name = uuid.uuid4().hex
+        write_atomic(self.path(name, image_format), data)
+        return name
+
+    def get(self, name, image_format):
+        with open(self.path(name, image_format), "rb") as f:
+            return f.read()
+
+    def delete(self, name, image_format):
+        try:
+            os.remove(self.path(name, image_format))
+        except FileNotFoundError:
+            pass
+
+    def prune(self, max_age):
+        """Delete files older than ``max_age`` seconds"""
+        cutoff = time.time() - max_age
+        for entry in os.scandir(self.root):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,338 @@
+"""Task broker between the API and inference worker processes.
+
+The API submits generation tasks; workers started with
+``inference_worker.py`` claim them, run them and hand their images back
+through the shared scratch store. Every broker has the same interface:
+
+- ``submit(kind, payload, model=None, route=None, priority=0)`` queues a
+  task and returns its id. ``route`` names the model version it runs on.
+- ``claim(worker_id, models=(), routes=())`` takes the next task for a
+  worker, preferring tasks routed to a model version it has resident.
+- ``heartbeat(worker_id, ...)`` marks a worker alive and extends the
+  leases of its running tasks.
+- ``report_progress``, ``complete`` and ``fail`` are called by the worker
+  running a task, ``get``, ``cancel`` and ``wait`` by the API.
+- ``requeue_expired()`` retries the tasks of workers that stopped
+  heartbeating, up to each task's ``max_attempts``.
+
+``SQLiteBroker`` keeps tasks in a SQLite file, for workers on the same
+host or sharing a volume with the API. ``make_broker`` picks a broker
+from a URL.
+"""
+import json
+import os
+import socket
+import time
+import uuid
+
+from db import Database
+from jobs import CANCELLED, FAILED, FINISHED_STATES, QUEUED, RUNNING, SUCCEEDED
+
+BROKER_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS tasks (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        model TEXT,
+        route TEXT,
+        priority INTEGER NOT NULL DEFAULT 0,
+        payload TEXT NOT NULL,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL,
+        worker_id TEXT,
+        lease_expires REAL,
+        progress TEXT,
+        cancel_requested INTEGER NOT NULL DEFAULT 0,
+        result TEXT,
+        error TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_tasks_state ON tasks (state, priority, created_at)',
+    '''
+    CREATE TABLE IF NOT EXISTS workers (
+        id TEXT PRIMARY KEY,
+        host TEXT NOT NULL,
+        pid INTEGER NOT NULL,
+        models TEXT NOT NULL,
+        routes TEXT NOT NULL,
+        running INTEGER NOT NULL DEFAULT 0,
+        started_at REAL NOT NULL,
+        heartbeat_at REAL NOT NULL
+    )
+    ''',
+]
+
+
+class TaskFailed(Exception):
+    """Raised while waiting for a task that failed or was cancelled"""
+
+    def __init__(self, task):
+        super().__init__(task["error"] or f"Task {task['state']}")
+        self.task = task
+
+
+def make_broker(url, **options):
+    """Broker for a URL such as ``sqlite:///data/broker.db``; an empty URL means inference runs in-process"""
+    if not url:
+        return None
+    scheme, _, path = url.partition("://")
+    if scheme == "sqlite" and path:
+        return SQLiteBroker(path, **options)
+    raise ValueError(f"Unsupported broker URL: {url}")
+
+
+class SQLiteBroker(Database):
+    """Broker keeping tasks and worker heartbeats in a SQLite database
+
+    A claimed task is leased to its worker for ``lease_seconds``, and the
+    worker's heartbeats keep renewing the lease. When a worker dies, its
+    leases expire and ``requeue_expired`` puts its tasks back in the queue.
+    A task that isn't routed to a live worker's resident model, or has
+    waited ``affinity_seconds``, goes to whichever worker is free first.
+    """
+
+    def __init__(self, db_path, lease_seconds=30, affinity_seconds=0.5, max_attempts=3, pool_size=8, busy_timeout=5.0):
+        super().__init__(db_path, pool_size=pool_size, busy_timeout=busy_timeout)
+        self.lease_seconds = lease_seconds
+        self.affinity_seconds = affinity_seconds
+        self.max_attempts = max_attempts
+        self.init_schema()
+
+    def init_schema(self):
+        with self.pool.connection() as conn:
+            for statement in BROKER_SCHEMA:
+                conn.execute(statement)
+
+    @staticmethod
+    def _task(row):
+        if row is None:
+            return None
+        task = dict(row)
+        for column in ("payload", "progress", "result"):
+            task[column] = json.loads(task[column]) if task[column] else None
+        task["cancel_requested"] = bool(task["cancel_requested"])
+        return task
+
+    # API side
+
+    def submit(self, kind, payload, model=None, route=None, priority=0):
+        task_id = uuid.uuid4().hex
+        now = time.time()
+        self.execute(
+            'submit_task',
+            'INSERT INTO tasks (id, kind, model, route, priority, payload, state, max_attempts, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (task_id, kind, model, route, priority, json.dumps(payload), QUEUED, self.max_attempts, now, now),
+        )
+        return task_id
+
+    def get(self, task_id):
+        return self._task(self.fetch_one('get_task', 'SELECT * FROM tasks WHERE id = ?', (task_id,)))
+
+    def cancel(self, task_id):
+        """Drop a queued task, or ask the worker running it to stop at its next step"""
+        with self.transaction() as conn:
+            self.execute(
+                'cancel_queued_task',
+                'UPDATE tasks SET state = ?, error = ?, updated_at = ? WHERE id = ? AND state = ?',
+                (CANCELLED, "Cancelled", time.time(), task_id, QUEUED),
+                conn=conn,
+            )
+            self.execute(
+                'cancel_running_task',
+                'UPDATE tasks SET cancel_requested = 1 WHERE id = ? AND state = ?',
+                (task_id, RUNNING),
+                conn=conn,
+            )
+
+    def wait(self, task_id, timeout=None, on_progress=None, poll_interval=0.02, max_poll_interval=0.25):
+        """Block until a task finishes and return its result
+
+        ``on_progress(progress)`` is called whenever the task's progress
+        changes. Raises ``TaskFailed`` if the task fails or is cancelled
+        and ``TimeoutError`` after ``timeout`` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        next_requeue = time.monotonic() + self.lease_seconds / 2
+        progress = None
+        while True:
+            task = self.get(task_id)
+            if task is None:
+                raise KeyError(f"Unknown task: {task_id}")
+            if task["state"] == SUCCEEDED:
+                return task["result"]
+            if task["state"] in FINISHED_STATES:
+                raise TaskFailed(task)
+
+            if on_progress is not None and task["progress"] and task["progress"] != progress:
+                progress = task["progress"]
+                on_progress(progress)
+
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise TimeoutError(f"Task {task_id} did not finish within {timeout} seconds")
+            if now >= next_requeue:
+                # Without this, a task whose worker died would wait for another worker's heartbeat
+                self.requeue_expired()
+                next_requeue = now + self.lease_seconds / 2
+
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, max_poll_interval)
+
+    def counts(self):
+        """Number of tasks in each state"""
+        rows = self.fetch_all('count_tasks', 'SELECT state, COUNT(*) AS count FROM tasks GROUP BY state')
+        return {row['state']: row['count'] for row in rows}
+
+    def workers(self):
+        """Workers that heartbeated within the lease, with the models they serve and have resident"""
+        rows = self.fetch_all(
+            'list_workers',
+            'SELECT * FROM workers WHERE heartbeat_at > ? ORDER BY started_at',
+            (time.time() - self.lease_seconds,),
+        )
+        return [
+            {**dict(row), "models": json.loads(row['models']), "routes": json.loads(row['routes'])}
+            for row in rows
+        ]
+
+    def prune(self, keep_seconds=3600):
+        """Delete finished tasks older than ``keep_seconds`` and workers gone for as long"""
+        cutoff = time.time() - keep_seconds
+        with self.transaction() as conn:
+            self.execute(
+                'prune_tasks',
+                f'DELETE FROM tasks WHERE state IN ({", ".join("?" * len(FINISHED_STATES))}) AND updated_at < ?',
+                (*FINISHED_STATES, cutoff),
+                conn=conn,
+            )
+            self.execute('prune_workers', 'DELETE FROM workers WHERE heartbeat_at < ?', (cutoff,), conn=conn)
+
+    # Worker side
+
+    def register_worker(self, models=()):
+        """Add a worker and return its id; it counts as live until its heartbeats stop"""
+        worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        now = time.time()
+        self.execute(
+            'register_worker',
+            'INSERT INTO workers (id, host, pid, models, routes, started_at, heartbeat_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (worker_id, socket.gethostname(), os.getpid(), json.dumps(list(models)), '[]', now, now),
+        )
+        return worker_id
+
+    def unregister_worker(self, worker_id):
+        self.execute('unregister_worker', 'DELETE FROM workers WHERE id = ?', (worker_id,))
+
+    def heartbeat(self, worker_id, routes=(), running=0):
+        now = time.time()
+        with self.transaction() as conn:
+            self.execute(
+                'worker_heartbeat',
+                'UPDATE workers SET routes = ?, running = ?, heartbeat_at = ? WHERE id = ?',
+                (json.dumps(list(routes)), running, now, worker_id),
+                conn=conn,
+            )
+            self.execute(
+                'renew_leases',
+                'UPDATE tasks SET lease_expires = ? WHERE worker_id = ? AND state = ?',
+                (now + self.lease_seconds, worker_id, RUNNING),
+                conn=conn,
+            )
+
+    def claim(self, worker_id, models=(), routes=()):
+        """Lease the next task to a worker, or return None if there is none it may run
+
+        A worker restricted to ``models`` only takes tasks for those. Tasks
+        routed to one of ``routes``, the model versions the worker has
+        resident, come first; tasks routed to a version another live worker
+        has resident are left to that worker for ``affinity_seconds``.
+        """
+        now = time.time()
+        resident_elsewhere = set()
+        for worker in self.workers():
+            if worker["id"] != worker_id:
+                resident_elsewhere.update(worker["routes"])
+        resident_elsewhere -= set(routes)
+
+        with self.transaction() as conn:
+            row = self._timed('claim_task', lambda: conn.execute(
+                'SELECT id FROM tasks '
+                'WHERE state = ? '
+                'AND (? = 0 OR model IN (SELECT value FROM json_each(?))) '
+                'AND (route IS NULL OR route NOT IN (SELECT value FROM json_each(?)) OR created_at < ?) '
+                'ORDER BY route IN (SELECT value FROM json_each(?)) DESC, priority DESC, created_at '
+                'LIMIT 1',
+                (
+                    QUEUED,
+                    len(models),
+                    json.dumps(list(models)),
+                    json.dumps(sorted(resident_elsewhere)),
+                    now - self.affinity_seconds,
+                    json.dumps(list(routes)),
+                ),
+            ).fetchone())
+            if row is None:
+                return None
+            self.execute(
+                'lease_task',
+                'UPDATE tasks SET state = ?, worker_id = ?, attempts = attempts + 1, lease_expires = ?, updated_at = ? '
+                'WHERE id = ?',
+                (RUNNING, worker_id, now + self.lease_seconds, now, row['id']),
+                conn=conn,
+            )
+            task = conn.execute('SELECT * FROM tasks WHERE id = ?', (row['id'],)).fetchone()
+        return self._task(task)
+
+    def report_progress(self, task_id, worker_id, progress):
+        """Record a running task's progress; returns False once the task should stop"""
+        with self.transaction() as conn:
+            self.execute(
+                'task_progress',
+                'UPDATE tasks SET progress = ?, updated_at = ? WHERE id = ? AND worker_id = ? AND state = ?',
+                (json.dumps(progress), time.time(), task_id, worker_id, RUNNING),
+                conn=conn,
+            )
+            row = conn.execute(
+                'SELECT cancel_requested, worker_id, state FROM tasks WHERE id = ?', (task_id,)
+            ).fetchone()
+        # A task requeued after its lease expired belongs to another worker now
+        return bool(row) and not row['cancel_requested'] and row['worker_id'] == worker_id and row['state'] == RUNNING
+
+    def complete(self, task_id, worker_id, result):
+        self._finish(task_id, worker_id, SUCCEEDED, result=json.dumps(result))
+
+    def fail(self, task_id, worker_id, error, cancelled=False):
+        self._finish(task_id, worker_id, CANCELLED if cancelled else FAILED, error=error)
+
+    def _finish(self, task_id, worker_id, state, result=None, error=None):
+        # Only the worker holding the lease may finish a task
+        self.execute(
+            'finish_task',
+            'UPDATE tasks SET state = ?, result = ?, error = ?, lease_expires = NULL, updated_at = ? '
+            'WHERE id = ? AND worker_id = ? AND state = ?',
+            (state, result, error, time.time(), task_id, worker_id, RUNNING),
+        )
+
+    def requeue_expired(self):
+        """Retry tasks whose worker stopped heartbeating, failing those out of attempts; returns how many"""
+        now = time.time()
+        with self.transaction() as conn:
+            failed = self.execute(
+                'fail_expired_tasks',
+                'UPDATE tasks SET state = ?, error = ?, lease_expires = NULL, updated_at = ? '
+                'WHERE state = ? AND lease_expires < ? AND (attempts >= max_attempts OR cancel_requested = 1)',
+                (FAILED, "The inference worker running this task stopped responding", now, RUNNING, now),
+                conn=conn,
+            ).rowcount
+            requeued = self.execute(
+                'requeue_expired_tasks',
+                'UPDATE tasks SET state = ?, worker_id = NULL, lease_expires = NULL, progress = NULL, updated_at = ? '
+                'WHERE state = ? AND lease_expires < ?',
+                (QUEUED, now, RUNNING, now),
+                conn=conn,
+            ).rowcount
+        return failed + requeued
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def tensor_nbytes(tensor):
+    """Size of a tensor's data in bytes"""
+    return tensor.element_size() * tensor.nelement()
+
+
+def module_nbytes(module):
+    """Size of a module's parameters and buffers in bytes"""
+    return sum(tensor_nbytes(tensor) for tensor in [*module.parameters(), *module.buffers()])
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by the total size of its entries.
+
+    ``sizeof`` measures a single value; by default every entry counts as 1,
+    which makes ``max_size`` a plain entry limit.
+    """
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return the cached value for key and mark it as recently used"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        """Insert a value, evicting least recently used entries to stay within budget"""
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Remove an entry and return its value"""
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value, size = self._entries.pop(key)
+            self.size -= size
+            return value
+
+    def clear(self):
+        """Drop every entry; counters are kept"""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Return hit/miss counters and current usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size": self.size,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+class ResultCache:
+    """Content-addressed cache for deterministic computations.
+
+    Concurrent calls for the same key share a single computation: the first
+    caller computes while the others wait for its result.
+    """
+
+    def __init__(self, max_entries):
+        self._cache = LRUCache(max_entries)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts):
+        """Hash the parts describing a computation into a stable key"""
+        payload = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_or_compute(self, key, compute):
+        """Return ``(value, cached)``, running ``compute`` only if no result exists or is in flight
+
+        If the in-flight computation this call waited on fails, for example
+        because its request was cancelled, this call computes the value itself.
+        """
+        while True:
+            with self._lock:
+                value = self._cache.get(key)
+                if value is not None:
+                    return value, True
+
+                future = self._inflight.get(key)
+                owner = future is None
+                if owner:
+                    future = Future()
+                    self._inflight[key] = future
+
+            if owner:
+                break
+
+            try:
+                return future.result(), True
+            except Exception:
+                continue
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._cache.put(key, value)
+            del self._inflight[key]
+        future.set_result(value)
+        return value, False
+
+    def invalidate(self, key):
+        """Forget a cached result, e.g. when the stored image no longer exists"""
+        self._cache.pop(key)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats["in_flight"] = len(self._inflight)
+        return stats
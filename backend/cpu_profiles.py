@@ -0,0 +1,100 @@
+import torch
+
+# Settings applied by each CPU performance profile:
+#   autocast          run the pipeline under torch.autocast (bfloat16 on CPU)
+#   dtype             cast the text encoder, VAE and U-Net weights to this dtype
+#   quantize          dynamic int8 quantization of Linear layers in the U-Net and text encoder
+#   channels_last     store convolution weights and activations in NHWC layout
+#   attention_slicing compute attention in slices to cap peak memory
+#   compile           torch.compile the U-Net and warm it up at load time
+CPU_PROFILES = {
+    "baseline": {"autocast": True},
+    "fp32": {"channels_last": True},
+    "bf16": {"dtype": torch.bfloat16, "channels_last": True},
+    "int8": {"quantize": True, "channels_last": True},
+    "compile": {"channels_last": True, "compile": True},
+    "low_memory": {"channels_last": True, "attention_slicing": True},
+}
+
+
+def get_profile(name):
+    """Return the settings of a CPU profile, with unset options defaulted"""
+    if name not in CPU_PROFILES:
+        raise ValueError(f"Unknown CPU profile '{name}', expected one of {', '.join(CPU_PROFILES)}")
+    profile = {
+        "autocast": False,
+        "dtype": None,
+        "quantize": False,
+        "channels_last": False,
+        "attention_slicing": False,
+        "compile": False,
+    }
+    profile.update(CPU_PROFILES[name])
+
+    # Fall back to float32 where the CPU has no fast bfloat16 path
+    if profile["dtype"] == torch.bfloat16 and not cpu_supports_bf16():
+        print("bfloat16 is not supported efficiently on this CPU, using float32")
+        profile["dtype"] = None
+
+    return profile
+
+
+def cpu_supports_bf16():
+    """Whether the CPU has AVX-512 (with BF16/AMX) instructions that make bfloat16 worthwhile"""
+    get_capability = getattr(torch.backends.cpu, "get_cpu_capability", None)
+    if get_capability is None:
+        return False
+    return get_capability() in ("AVX512", "AVX512_BF16", "AMX")
+
+
+def set_thread_counts(intra_op=None, inter_op=None):
+    """Set torch's thread pools; call before any parallel work has run"""
+    if intra_op:
+        torch.set_num_threads(intra_op)
+    if inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError as e:
+            # The inter-op pool can only be sized before it is first used
+            print(f"Could not set inter-op threads: {e}")
+
+
+def optimize_unet(unet, profile):
+    """Apply a profile's settings to a U-Net and return the module to run"""
+    if profile["dtype"] is not None:
+        unet.to(profile["dtype"])
+    if profile["channels_last"]:
+        unet.to(memory_format=torch.channels_last)
+    if profile["attention_slicing"]:
+        unet.set_attention_slice("auto")
+    if profile["quantize"]:
+        unet = torch.ao.quantization.quantize_dynamic(unet, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if profile["compile"]:
+        unet = torch.compile(unet)
+    return unet
+
+
+def cast_weights(model, profile):
+    """Cast the components of a StableDiffusionModel to a profile's dtype and memory format
+
+    Casting the weights is the part of a profile that can be done ahead
+    of time: the result is what ``StableDiffusionModel.save_weights``
+    snapshots for server processes to share.
+    """
+    if profile["dtype"] is not None:
+        model.text_encoder.to(profile["dtype"])
+        model.vae.to(profile["dtype"])
+        model.unet.to(profile["dtype"])
+    if profile["channels_last"]:
+        model.vae.to(memory_format=torch.channels_last)
+        model.unet.to(memory_format=torch.channels_last)
+
+
+def apply_profile(model, profile):
+    """Apply a profile to the components of a StableDiffusionModel in place"""
+    cast_weights(model, profile)
+    if profile["quantize"]:
+        model.text_encoder = torch.ao.quantization.quantize_dynamic(
+            model.text_encoder, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    model.unet = optimize_unet(model.unet, profile)
@@ -0,0 +1,287 @@
+import io
+import json
+import math
+import random
+from collections import Counter
+
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Sampler, get_worker_info
+
+from utils import base64_to_image, preprocess_image, clean_prompt
+
+
+def make_buckets(size=512, step=64, max_aspect=2.0):
+    """Return ``(width, height)`` buckets of about ``size * size`` pixels, multiples of ``step``
+
+    Buckets range from ``1 / max_aspect`` to ``max_aspect`` in aspect ratio,
+    so images are resized to the closest shape instead of squashed into a square.
+    """
+    buckets = {(size, size)}
+    width = size
+    while True:
+        width += step
+        height = (size * size // width) // step * step
+        if height < step or width / height > max_aspect:
+            break
+        buckets.add((width, height))
+        buckets.add((height, width))
+    return sorted(buckets)
+
+
+def nearest_bucket(width, height, buckets):
+    """The bucket closest in aspect ratio to an image of ``width`` x ``height``"""
+    aspect = math.log(width / height)
+    return min(buckets, key=lambda bucket: abs(math.log(bucket[0] / bucket[1]) - aspect))
+
+
+def resize_to_bucket(image, bucket):
+    """Center-crop an image to a bucket's aspect ratio and resize it, returning a [C, H, W] tensor"""
+    width, height = image.size
+    bucket_width, bucket_height = bucket
+    if width * bucket_height > height * bucket_width:
+        crop_width = round(height * bucket_width / bucket_height)
+        left = (width - crop_width) // 2
+        image = image.crop((left, 0, left + crop_width, height))
+    else:
+        crop_height = round(width * bucket_height / bucket_width)
+        top = (height - crop_height) // 2
+        image = image.crop((0, top, width, top + crop_height))
+    return preprocess_image(image, bucket)
+
+
+def record_image(item):
+    """Open a record's image, stored either as raw bytes or as a base64 string"""
+    if isinstance(item["image"], bytes):
+        return Image.open(io.BytesIO(item["image"]))
+    return base64_to_image(item["image"])
+
+
+def load_example(item, buckets):
+    """Decode a dataset record into ``{"caption", "image"}`` at its bucket's size"""
+    image = record_image(item)
+    bucket = nearest_bucket(*image.size, buckets)
+    return {"caption": clean_prompt(item["description"]), "image": resize_to_bucket(image, bucket)}
+
+
+def collate_examples(examples):
+    """Stack examples of one bucket into ``{"captions", "images"}``"""
+    return {
+        "captions": [example["caption"] for example in examples],
+        "images": torch.stack([example["image"] for example in examples]),
+    }
+
+
+class _ScanDataset(Dataset):
+    """Reads each record's image header, without decoding pixels, to find its bucket"""
+
+    def __init__(self, dataset, buckets):
+        self.dataset = dataset
+        self.buckets = buckets
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        try:
+            image = record_image(self.dataset[idx])
+            size = image.size
+            # Catches truncated and corrupt files
+            image.verify()
+            return idx, nearest_bucket(*size, self.buckets), None
+        except Exception as e:
+            return idx, None, str(e)
+
+
+def _collect(results):
+    return results
+
+
+def scan_dataset(dataset, buckets, num_workers=0):
+    """Assign every sample of a map-style dataset to a bucket, before training starts
+
+    Returns ``(samples, bad)``: ``(index, bucket)`` for each usable sample and
+    ``{"index", "error"}`` for each one that could not be read.
+    """
+    loader = DataLoader(
+        _ScanDataset(dataset, buckets),
+        batch_size=64,
+        num_workers=num_workers,
+        collate_fn=_collect,
+    )
+    samples = []
+    bad = []
+    for results in loader:
+        for idx, bucket, error in results:
+            if error is None:
+                samples.append((idx, bucket))
+            else:
+                bad.append({"index": idx, "error": error})
+    return samples, bad
+
+
+class BucketedImageDataset(Dataset):
+    """Scanned samples of a map-style dataset, each resized to its bucket"""
+
+    def __init__(self, dataset, samples):
+        self.dataset = dataset
+        self.samples = samples
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        index, bucket = self.samples[idx]
+        item = self.dataset[index]
+        return {
+            "caption": clean_prompt(item["description"]),
+            "image": resize_to_bucket(record_image(item), bucket),
+        }
+
+    @property
+    def buckets(self):
+        return [bucket for _, bucket in self.samples]
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of indices that all share a bucket, so every batch stacks into one shape.
+
+    ``buckets`` holds one bucket key per sample. Batches are shuffled across
+    buckets every epoch; call ``set_epoch`` to reshuffle deterministically.
+    """
+
+    def __init__(self, buckets, batch_size, shuffle=True, drop_last=False, seed=0):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+        self.groups = {}
+        for idx, bucket in enumerate(buckets):
+            self.groups.setdefault(bucket, []).append(idx)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        batches = []
+        for indices in self.groups.values():
+            indices = list(indices)
+            if self.shuffle:
+                rng.shuffle(indices)
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(indices) // self.batch_size for indices in self.groups.values())
+        return sum(math.ceil(len(indices) / self.batch_size) for indices in self.groups.values())
+
+
+class StreamingBucketDataset(IterableDataset):
+    """Batches of one bucket each, decoded from a streamed dataset without materializing it.
+
+    Every worker reads its own share of the stream and keeps a buffer per
+    bucket, yielding a batch as soon as a bucket fills up and the partial
+    batches once the stream ends. Records that fail to decode are counted
+    per worker and reported as they are skipped.
+    """
+
+    def __init__(self, dataset, buckets, batch_size):
+        self.dataset = dataset
+        self.buckets = buckets
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker else (0, 1)
+        # A streamed Hugging Face dataset already gives each DataLoader worker its own shards
+        split_by_worker = not hasattr(self.dataset, "n_shards")
+
+        pending = {}
+        bad = 0
+        for i, item in enumerate(self.dataset):
+            if split_by_worker and i % num_workers != worker_id:
+                continue
+            try:
+                example = load_example(item, self.buckets)
+            except Exception as e:
+                bad += 1
+                print(f"Skipping unreadable sample {i} ({bad} so far in worker {worker_id}): {e}")
+                continue
+
+            shape = tuple(example["image"].shape)
+            pending.setdefault(shape, []).append(example)
+            if len(pending[shape]) == self.batch_size:
+                yield collate_examples(pending.pop(shape))
+
+        for examples in pending.values():
+            yield collate_examples(examples)
+
+
+def loader_options(num_workers, prefetch_factor):
+    """DataLoader options that decode in worker processes ahead of the training loop"""
+    options = {
+        "num_workers": num_workers,
+        # Page-locked batches copy to the GPU asynchronously
+        "pin_memory": torch.cuda.is_available(),
+    }
+    if num_workers > 0:
+        options["prefetch_factor"] = prefetch_factor
+        options["persistent_workers"] = True
+    return options
+
+
+def make_image_dataloader(
+    dataset,
+    buckets,
+    batch_size,
+    streaming=False,
+    num_workers=4,
+    prefetch_factor=4,
+    shuffle=True,
+    bad_samples_path=None,
+):
+    """DataLoader of ``{"captions", "images"}`` batches, each resized to one bucket
+
+    Map-style datasets are scanned first, so unreadable samples are known
+    (and written to ``bad_samples_path``) before training starts. Streamed
+    datasets are bucketed as they are read.
+    """
+    options = loader_options(num_workers, prefetch_factor)
+
+    if streaming:
+        n_shards = getattr(dataset, "n_shards", None)
+        if n_shards is not None and n_shards < num_workers:
+            print(f"The stream has {n_shards} shards, so only {n_shards} of {num_workers} loader workers will read it")
+        if shuffle:
+            dataset = dataset.shuffle(buffer_size=1000)
+        return DataLoader(StreamingBucketDataset(dataset, buckets, batch_size), batch_size=None, **options)
+
+    samples, bad = scan_dataset(dataset, buckets, num_workers)
+    if bad:
+        print(f"Skipping {len(bad)} unreadable samples of {len(dataset)}")
+        if bad_samples_path:
+            with open(bad_samples_path, "w") as f:
+                json.dump(bad, f, indent=2)
+    if not samples:
+        raise ValueError("No sample in the dataset could be loaded")
+
+    bucketed = BucketedImageDataset(dataset, samples)
+    print(f"Bucketed {len(samples)} samples: {dict(Counter(bucketed.buckets))}")
+    return DataLoader(
+        bucketed,
+        batch_sampler=BucketBatchSampler(bucketed.buckets, batch_size, shuffle=shuffle),
+        collate_fn=collate_examples,
+        **options,
+    )
@@ -0,0 +1,430 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from blob_store import add_blob_columns
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    prompt TEXT NOT NULL,
+    image_data TEXT NOT NULL DEFAULT '',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    seed INTEGER,
+    params TEXT,
+    feedback INTEGER DEFAULT 0,
+    blob_ref TEXT,
+    blob_size INTEGER,
+    blob_format TEXT,
+    thumb_ref TEXT,
+    thumb_format TEXT
+)
+'''
+
+# Indexes backing keyset pagination of the gallery, optionally filtered by feedback
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_images_created_at_id ON images (created_at, id)',
+    'CREATE INDEX IF NOT EXISTS idx_images_feedback_created_at_id ON images (feedback, created_at, id)',
+    'CREATE INDEX IF NOT EXISTS idx_images_prompt ON images (prompt)',
+]
+
+# Full-text index over prompts and params, kept in sync with the images table by triggers
+FTS_SCHEMA = [
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(
+        prompt, params, content='images', content_rowid='id'
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS images_fts_insert AFTER INSERT ON images BEGIN
+        INSERT INTO images_fts (rowid, prompt, params) VALUES (new.id, new.prompt, new.params);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS images_fts_delete AFTER DELETE ON images BEGIN
+        INSERT INTO images_fts (images_fts, rowid, prompt, params) VALUES ('delete', old.id, old.prompt, old.params);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS images_fts_update AFTER UPDATE OF prompt, params ON images BEGIN
+        INSERT INTO images_fts (images_fts, rowid, prompt, params) VALUES ('delete', old.id, old.prompt, old.params);
+        INSERT INTO images_fts (rowid, prompt, params) VALUES (new.id, new.prompt, new.params);
+    END
+    ''',
+]
+
+# Pooled CLIP embeddings of distinct prompts, for similarity search
+PROMPT_VECTORS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS prompt_vectors (
+    prompt TEXT PRIMARY KEY,
+    vector BLOB NOT NULL
+)
+'''
+
+# Snapshots of asynchronous jobs, shared by every server process
+JOBS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    snapshot TEXT NOT NULL,
+    finished INTEGER NOT NULL DEFAULT 0,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+)
+'''
+
+INSERT_IMAGE = (
+    'INSERT INTO images (prompt, image_data, blob_ref, blob_size, blob_format, thumb_ref, thumb_format, '
+    'seed, params) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+)
+
+IMAGE_COLUMNS = 'id, prompt, image_data, blob_ref, blob_format, thumb_ref, thumb_format, created_at, seed, feedback'
+
+
+class ConnectionPool:
+    """Thread-safe pool of SQLite connections set up for concurrent readers and writers.
+
+    Connections use WAL journaling, so readers never block the writer, and a
+    busy timeout, so writers wait for the lock instead of failing with
+    "database is locked". Each connection keeps its own prepared statement
+    cache, which is why queries are issued with constant SQL strings.
+    """
+
+    def __init__(self, db_path, size=8, busy_timeout=5.0, cached_statements=256):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            isolation_level=None,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout * 1000)}')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of the block"""
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+
+            try:
+                yield conn
+            finally:
+                # Never hand out a connection with a half-finished transaction
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+
+class QueryMetrics:
+    """Per-query call counts and timings"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queries = {}
+
+    def record(self, name, duration):
+        with self._lock:
+            stats = self._queries.setdefault(name, {"count": 0, "total_time": 0.0, "max_time": 0.0})
+            stats["count"] += 1
+            stats["total_time"] += duration
+            stats["max_time"] = max(stats["max_time"], duration)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: {**stats, "avg_time": stats["total_time"] / stats["count"]}
+                for name, stats in self._queries.items()
+            }
+
+
+class Database:
+    """Data-access layer for the images table"""
+
+    def __init__(self, db_path, pool_size=8, busy_timeout=5.0):
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path, size=pool_size, busy_timeout=busy_timeout)
+        self.metrics = QueryMetrics()
+
+    def init_schema(self):
+        with self.pool.connection() as conn:
+            conn.execute(SCHEMA)
+
+            # Databases created before the blob store lack the reference columns
+            add_blob_columns(conn)
+
+            for statement in INDEXES:
+                conn.execute(statement)
+
+            # Index rows that existed before the full-text table was created
+            fts_exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'images_fts'"
+            ).fetchone()
+            for statement in FTS_SCHEMA:
+                conn.execute(statement)
+            if not fts_exists:
+                conn.execute("INSERT INTO images_fts (images_fts) VALUES ('rebuild')")
+
+            conn.execute(PROMPT_VECTORS_SCHEMA)
+            conn.execute(JOBS_SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        """Run the block in one write transaction on a pooled connection"""
+        with self.pool.connection() as conn:
+            # Take the write lock up front so the transaction cannot fail midway on upgrade
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def _timed(self, name, func):
+        start = time.perf_counter()
+        try:
+            return func()
+        finally:
+            self.metrics.record(name, time.perf_counter() - start)
+
+    def fetch_one(self, name, sql, args=()):
+        with self.pool.connection() as conn:
+            return self._timed(name, lambda: conn.execute(sql, args).fetchone())
+
+    def fetch_all(self, name, sql, args=()):
+        with self.pool.connection() as conn:
+            return self._timed(name, lambda: conn.execute(sql, args).fetchall())
+
+    def execute(self, name, sql, args=(), conn=None):
+        """Run a write statement, inside ``conn``'s transaction if given, and return its cursor"""
+        if conn is not None:
+            return self._timed(name, lambda: conn.execute(sql, args))
+        with self.transaction() as conn:
+            return self._timed(name, lambda: conn.execute(sql, args))
+
+    # Images
+
+    def insert_images(self, images):
+        """Insert image rows in a single transaction and return their ids
+
+        Each image is a dict with ``prompt``, ``seed``, ``params`` and the
+        blob store references of the image and its thumbnail.
+        """
+        ids = []
+        with self.transaction() as conn:
+            for image in images:
+                cursor = self.execute('insert_image', INSERT_IMAGE, (
+                    image['prompt'],
+                    '',
+                    image['blob_ref'],
+                    image['blob_size'],
+                    image['blob_format'],
+                    image['thumb_ref'],
+                    image['thumb_format'],
+                    image['seed'],
+                    image['params'],
+                ), conn=conn)
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def get_image(self, image_id):
+        return self.fetch_one('get_image', 'SELECT * FROM images WHERE id = ?', (image_id,))
+
+    def list_images(self, limit, offset):
+        return self.fetch_all(
+            'list_images',
+            f'SELECT {IMAGE_COLUMNS} FROM images ORDER BY created_at DESC LIMIT ? OFFSET ?',
+            (limit, offset),
+        )
+
+    def list_image_page(self, limit, after=None, feedback=None, prompt_filter=None):
+        """List image metadata newest first, starting after a ``(created_at, id)`` position
+
+        Returns up to ``limit + 1`` rows; the extra row tells the caller
+        whether another page exists.
+        """
+        conditions = []
+        args = []
+
+        if after is not None:
+            # Row-value comparison lets SQLite seek straight into the index
+            conditions.append('(created_at, id) < (?, ?)')
+            args.extend(after)
+
+        if feedback is not None:
+            conditions.append('feedback = ?')
+            args.append(feedback)
+
+        if prompt_filter:
+            conditions.append("prompt LIKE ? ESCAPE '\\'")
+            escaped = prompt_filter.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            args.append(f'%{escaped}%')
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        return self.fetch_all(
+            'list_image_page',
+            f'SELECT id, prompt, created_at, seed, feedback FROM images {where} '
+            'ORDER BY created_at DESC, id DESC LIMIT ?',
+            args + [limit + 1],
+        )
+
+    def set_thumbnail(self, image_id, thumb_ref, thumb_format):
+        self.execute(
+            'set_thumbnail',
+            'UPDATE images SET thumb_ref = ?, thumb_format = ? WHERE id = ?',
+            (thumb_ref, thumb_format, image_id),
+        )
+
+    def update_feedback(self, image_id, feedback):
+        """Set an image's feedback and return whether the image exists"""
+        cursor = self.execute(
+            'update_feedback',
+            'UPDATE images SET feedback = ? WHERE id = ?',
+            (feedback, image_id),
+        )
+        return cursor.rowcount > 0
+
+    def iter_feedback_image_ids(self, min_feedback=1, batch_size=1000):
+        """Yield ids of images rated at least ``min_feedback``, in id order, one batch at a time"""
+        last_id = 0
+        while True:
+            rows = self.fetch_all(
+                'iter_feedback_image_ids',
+                'SELECT id FROM images WHERE id > ? AND feedback >= ? ORDER BY id LIMIT ?',
+                (last_id, min_feedback, batch_size),
+            )
+            if not rows:
+                return
+            last_id = rows[-1]['id']
+            yield [row['id'] for row in rows]
+
+    # Search
+
+    def search_prompts(self, match_query, limit):
+        """Full-text search over prompts and params, best matches first"""
+        return self.fetch_all(
+            'search_prompts',
+            'SELECT images.id, images.prompt, images.created_at, images.seed, images.feedback, '
+            'bm25(images_fts) AS rank '
+            'FROM images_fts JOIN images ON images.id = images_fts.rowid '
+            'WHERE images_fts MATCH ? ORDER BY rank LIMIT ?',
+            (match_query, limit),
+        )
+
+    def latest_images_for_prompts(self, prompts):
+        """Return the newest image row for each of the given prompts"""
+        if not prompts:
+            return []
+        placeholders = ', '.join('?' * len(prompts))
+        return self.fetch_all(
+            'latest_images_for_prompts',
+            'SELECT id, prompt, created_at, seed, feedback FROM images WHERE id IN ('
+            f'SELECT MAX(id) FROM images WHERE prompt IN ({placeholders}) GROUP BY prompt)',
+            list(prompts),
+        )
+
+    def save_prompt_vectors(self, vectors):
+        """Store ``(prompt, vector_bytes)`` pairs, ignoring prompts already stored"""
+        with self.transaction() as conn:
+            self._timed('save_prompt_vectors', lambda: conn.executemany(
+                'INSERT OR IGNORE INTO prompt_vectors (prompt, vector) VALUES (?, ?)',
+                vectors,
+            ))
+
+    def iter_prompt_vectors(self, after_rowid=0, batch_size=1000):
+        """Yield stored ``(rowid, prompt, vector_bytes)`` rows past ``after_rowid`` in batches"""
+        last_rowid = after_rowid
+        while True:
+            rows = self.fetch_all(
+                'iter_prompt_vectors',
+                'SELECT rowid, prompt, vector FROM prompt_vectors WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                (last_rowid, batch_size),
+            )
+            if not rows:
+                return
+            last_rowid = rows[-1]['rowid']
+            yield [(row['rowid'], row['prompt'], row['vector']) for row in rows]
+
+    def prompts_missing_vectors(self, limit):
+        """Distinct prompts of stored images that have no vector yet"""
+        rows = self.fetch_all(
+            'prompts_missing_vectors',
+            'SELECT DISTINCT images.prompt FROM images '
+            'LEFT JOIN prompt_vectors ON prompt_vectors.prompt = images.prompt '
+            'WHERE prompt_vectors.prompt IS NULL LIMIT ?',
+            (limit,),
+        )
+        return [row['prompt'] for row in rows]
+
+    # Jobs
+
+    def save_job(self, snapshot, version):
+        """Store a job snapshot, unless a newer version of it is already stored"""
+        self.execute(
+            'save_job',
+            'INSERT INTO jobs (id, version, snapshot, finished, cancel_requested, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET version = excluded.version, snapshot = excluded.snapshot, '
+            'finished = excluded.finished, cancel_requested = max(jobs.cancel_requested, excluded.cancel_requested), '
+            'updated_at = excluded.updated_at '
+            'WHERE excluded.version > jobs.version',
+            (
+                snapshot['id'],
+                version,
+                json.dumps(snapshot),
+                int(snapshot['finished_at'] is not None),
+                int(snapshot['cancel_requested']),
+                time.time(),
+            ),
+        )
+
+    def get_job(self, job_id):
+        """Return a stored job's ``(snapshot, version)``, or ``(None, None)`` if it is unknown"""
+        row = self.fetch_one(
+            'get_job',
+            'SELECT version, snapshot, cancel_requested FROM jobs WHERE id = ?',
+            (job_id,),
+        )
+        if row is None:
+            return None, None
+        snapshot = json.loads(row['snapshot'])
+        snapshot['cancel_requested'] = snapshot['cancel_requested'] or bool(row['cancel_requested'])
+        return snapshot, row['version']
+
+    def request_job_cancel(self, job_id):
+        self.execute('request_job_cancel', 'UPDATE jobs SET cancel_requested = 1 WHERE id = ?', (job_id,))
+
+    def job_cancel_requested(self, job_id):
+        row = self.fetch_one('job_cancel_requested', 'SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,))
+        return bool(row and row['cancel_requested'])
+
+    def prune_jobs(self, keep):
+        """Delete finished jobs beyond the ``keep`` most recently updated"""
+        self.execute(
+            'prune_jobs',
+            'DELETE FROM jobs WHERE finished = 1 AND id NOT IN '
+            '(SELECT id FROM jobs WHERE finished = 1 ORDER BY updated_at DESC LIMIT ?)',
+            (keep,),
+        )
@@ -1,38 +1,80 @@
+import json
 import os
+import shutil
+import time
 import torch
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import DataLoader
 from datasets import load_dataset
 from tqdm.auto import tqdm
 from accelerate import Accelerator
+from data_pipeline import BucketBatchSampler, loader_options, make_buckets, make_image_dataloader
+from latent_cache import LatentCache, LatentDataset
 from model import StableDiffusionModel
-from utils import base64_to_image, preprocess_image, clean_prompt
 
+# Attention projections of the U-Net that LoRA adapters are trained on
+LORA_TARGET_MODULES = ["to_q", "to_k", "to_v", "to_out.0"]
 
-class ImageCaptionDataset(Dataset):
-    def __init__(self, dataset, tokenizer, size=512):
-        self.dataset = dataset
-        self.tokenizer = tokenizer
-        self.size = size
+OPTIMIZERS = ("adamw", "adamw8bit", "adafactor")
+
+
+def make_optimizer(name, params, learning_rate):
+    """Create one of ``OPTIMIZERS``; the 8-bit and Adafactor ones keep much smaller optimizer states"""
+    if name == "adamw":
+        return torch.optim.AdamW(params, lr=learning_rate)
+    if name == "adamw8bit":
+        try:
+            import bitsandbytes as bnb
+        except ImportError:
+            raise ImportError("The adamw8bit optimizer requires bitsandbytes: pip install bitsandbytes")
+        return bnb.optim.AdamW8bit(params, lr=learning_rate)
+    if name == "adafactor":
+        from transformers.optimization import Adafactor
+        return Adafactor(params, lr=learning_rate, scale_parameter=False, relative_step=False)
+    raise ValueError(f"Unknown optimizer '{name}', expected one of {', '.join(OPTIMIZERS)}")
+
+
+def add_lora_adapter(unet, rank, alpha=None):
+    """Freeze the U-Net and add trainable LoRA layers to its attention projections"""
+    from peft import LoraConfig
+    
+    unet.requires_grad_(False)
+    unet.add_adapter(LoraConfig(
+        r=rank,
+        lora_alpha=alpha or rank,
+        init_lora_weights="gaussian",
+        target_modules=LORA_TARGET_MODULES,
+    ))
+
+
+def save_unet(unet, output_dir, lora=False):
+    """Save a full U-Net checkpoint, or only the LoRA adapter weights"""
+    if not lora:
+        unet.save_pretrained(output_dir)
+        return
     
-    def __len__(self):
-        return len(self.dataset)
+    from diffusers import StableDiffusionPipeline
+    from diffusers.utils import convert_state_dict_to_diffusers
+    from peft.utils import get_peft_model_state_dict
     
-    def __getitem__(self, idx):
-        item = self.dataset[idx]
-        
-        # Get the caption (text prompt)
-        caption = clean_prompt(item["description"])
-        
-        # Process the base64 image
-        try:
-            image = base64_to_image(item["image"])
-            image_tensor = preprocess_image(image, self.size)
-            return {"caption": caption, "image": image_tensor}
-        except Exception as e:
-            # Skip problematic images
-            print(f"Error processing image at index {idx}: {e}")
-            return None
+    StableDiffusionPipeline.save_lora_weights(
+        output_dir,
+        unet_lora_layers=convert_state_dict_to_diffusers(get_peft_model_state_dict(unet)),
+        safe_serialization=True,
+    )
+
+
+def load_lora_weights(unet, input_dir):
+    """Load LoRA adapter weights saved by ``save_unet`` into a U-Net that already has the adapter"""
+    from diffusers import StableDiffusionPipeline
+    from diffusers.utils import convert_unet_state_dict_to_peft
+    from peft.utils import set_peft_model_state_dict
+    
+    state_dict, _ = StableDiffusionPipeline.lora_state_dict(input_dir)
+    unet_state_dict = {
+        key[len("unet."):]: value for key, value in state_dict.items() if key.startswith("unet.")
+    }
+    set_peft_model_state_dict(unet, convert_unet_state_dict_to_peft(unet_state_dict), adapter_name="default")
 
 
 def train(
@@ -45,67 +87,189 @@ def train(
     num_epochs=5,
     max_train_steps=None,
     mixed_precision="fp16",
+    use_latent_cache=True,
+    latent_cache_dir=None,
+    image_size=512,
+    streaming=False,
+    num_workers=4,
+    prefetch_factor=4,
+    lora_rank=None,
+    lora_alpha=None,
+    gradient_checkpointing=False,
+    optimizer="adamw",
+    dataset=None,
+    progress_callback=None,
+    should_stop=None,
+    resume=False,
 ):
+    """Fine-tune the U-Net on a captioned image dataset
+
+    Images are decoded in ``num_workers`` worker processes, ahead of the
+    training loop, and resized to the aspect-ratio bucket closest to their
+    shape. ``streaming`` reads the dataset without downloading it first.
+
+    With ``use_latent_cache`` the frozen VAE and text encoder run over the
+    dataset once, before training, and every epoch reads their outputs from
+    an on-disk cache (``output_dir/latent_cache`` unless ``latent_cache_dir``
+    is given). The cache is rebuilt when the model, dataset or image size
+    changes.
+
+    ``lora_rank`` trains a LoRA adapter of that rank on the U-Net's attention
+    layers instead of every U-Net weight, and checkpoints, including the
+    resume state, hold only the adapter. Together with ``gradient_checkpointing`` and a low-memory
+    ``optimizer`` (one of ``OPTIMIZERS``) this makes training fit on
+    CPU-only machines.
+
+    ``dataset`` trains on records with ``image`` and ``description`` fields
+    instead of loading ``dataset_name``. ``progress_callback`` receives a
+    dict with the step, epoch, loss and throughput after every step. When
+    ``should_stop()`` returns True, training saves a checkpoint and returns
+    None; ``resume`` continues from the checkpoint in ``output_dir``. The
+    checkpoint is deleted once the final U-Net is saved.
+    """
     accelerator = Accelerator(
         gradient_accumulation_steps=gradient_accumulation_steps,
-        mixed_precision=mixed_precision,
+        # fp16 autocast needs a GPU
+        mixed_precision=mixed_precision if torch.cuda.is_available() else "no",
     )
     
     # Initialize the model
     model = StableDiffusionModel(model_id=model_id)
+    os.makedirs(output_dir, exist_ok=True)
     
-    # Load the dataset
-    dataset = load_dataset(dataset_name)
-    train_dataset = ImageCaptionDataset(dataset["train"], model.tokenizer)
+    # Load the dataset; streamed datasets are read record by record and never held in full
+    if dataset is None:
+        dataset = load_dataset(dataset_name, split="train", streaming=streaming)
+    buckets = make_buckets(image_size)
     
-    # Create the dataloader
-    def collate_fn(examples):
-        # Filter out None values (failed image processing)
-        examples = [example for example in examples if example is not None]
-        if not examples:
-            return None
-            
-        captions = [example["caption"] for example in examples]
-        images = torch.stack([example["image"] for example in examples])
+    def image_batches(shuffle):
+        return make_image_dataloader(
+            dataset,
+            buckets,
+            train_batch_size,
+            streaming=streaming,
+            num_workers=num_workers,
+            prefetch_factor=prefetch_factor,
+            shuffle=shuffle,
+            bad_samples_path=os.path.join(output_dir, "bad_samples.json"),
+        )
+    
+    if use_latent_cache:
+        cache_dir = latent_cache_dir or os.path.join(output_dir, "latent_cache")
+        fingerprint = {
+            "model_id": model_id,
+            "dataset": dataset_name,
+            "buckets": [list(bucket) for bucket in buckets],
+            "num_samples": None if streaming else len(dataset),
+        }
+        
+        # Only the main process encodes; the others wait and read its cache
+        if accelerator.is_main_process and not LatentCache.is_valid(cache_dir, fingerprint):
+            LatentCache.build(cache_dir, image_batches(shuffle=False), model, fingerprint)
+        accelerator.wait_for_everyone()
+        cache = LatentCache(cache_dir)
         
-        return {"captions": captions, "images": images}
+        # The frozen encoders are not needed again once their outputs are cached
+        model.vae.to("cpu")
+        model.text_encoder.to("cpu")
+        
+        train_dataloader = DataLoader(
+            LatentDataset(cache),
+            batch_sampler=BucketBatchSampler(cache.sample_buckets(), train_batch_size),
+            **loader_options(num_workers, prefetch_factor),
+        )
+    else:
+        train_dataloader = image_batches(shuffle=True)
     
-    train_dataloader = DataLoader(
-        train_dataset,
-        batch_size=train_batch_size,
-        shuffle=True,
-        collate_fn=collate_fn,
-    )
+    # Reshuffled every epoch; streamed batches have no sampler
+    batch_sampler = getattr(train_dataloader, "batch_sampler", None)
+    if not isinstance(batch_sampler, BucketBatchSampler):
+        batch_sampler = None
+    
+    if lora_rank:
+        add_lora_adapter(model.unet, lora_rank, lora_alpha)
     
-    # Set up the optimizer
-    optimizer = torch.optim.AdamW(model.unet.parameters(), lr=learning_rate)
+    # Recompute activations in the backward pass instead of keeping them all
+    if gradient_checkpointing:
+        model.unet.enable_gradient_checkpointing()
+    
+    # Set up the optimizer over the weights being trained
+    optimizer = make_optimizer(
+        optimizer,
+        [param for param in model.unet.parameters() if param.requires_grad],
+        learning_rate,
+    )
     
     # Prepare for training
     model.unet, optimizer, train_dataloader = accelerator.prepare(
         model.unet, optimizer, train_dataloader
     )
     
-    # Calculate the number of training steps
-    if max_train_steps is None:
+    # Calculate the number of training steps; a stream's length is unknown until it ends
+    if max_train_steps is None and (use_latent_cache or not streaming):
         max_train_steps = num_epochs * len(train_dataloader)
     
-    # Training loop
+    # Optimizer, weights and RNG state to resume from, with the position reached
+    checkpoint_dir = os.path.join(output_dir, "checkpoint")
+    
+    if lora_rank:
+        # Keep only the adapter in the resume state instead of the whole frozen U-Net. It goes
+        # in a subdirectory so the model registry does not list the checkpoint as an adapter.
+        def save_model_hook(models, weights, output_dir):
+            if accelerator.is_main_process:
+                save_unet(accelerator.unwrap_model(models[0]), os.path.join(output_dir, "lora"), lora=True)
+            weights.clear()
+        
+        def load_model_hook(models, input_dir):
+            load_lora_weights(accelerator.unwrap_model(models.pop()), os.path.join(input_dir, "lora"))
+        
+        accelerator.register_save_state_pre_hook(save_model_hook)
+        accelerator.register_load_state_pre_hook(load_model_hook)
+    
+    def save_checkpoint(epoch, epoch_step):
+        accelerator.wait_for_everyone()
+        accelerator.save_state(checkpoint_dir)
+        if accelerator.is_main_process:
+            with open(os.path.join(checkpoint_dir, "progress.json"), "w") as f:
+                json.dump({"epoch": epoch, "epoch_step": epoch_step, "total_steps": total_steps}, f)
+    
     total_steps = 0
-    progress_bar = tqdm(total=max_train_steps)
+    start_epoch = 0
+    skip_steps = 0
+    if resume and os.path.exists(os.path.join(checkpoint_dir, "progress.json")):
+        accelerator.load_state(checkpoint_dir)
+        with open(os.path.join(checkpoint_dir, "progress.json")) as f:
+            position = json.load(f)
+        start_epoch, skip_steps, total_steps = position["epoch"], position["epoch_step"], position["total_steps"]
+    
+    # Training loop
+    progress_bar = tqdm(total=max_train_steps, initial=total_steps)
+    start_time = time.perf_counter()
+    samples_seen = 0
     
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
         model.unet.train()
+        if batch_sampler is not None:
+            batch_sampler.set_epoch(epoch)
         
-        for step, batch in enumerate(train_dataloader):
-            if batch is None:
-                continue
-                
+        # Batches come in the same order for an epoch, so a resumed epoch skips the ones already trained on
+        epoch_dataloader = train_dataloader
+        if epoch == start_epoch and skip_steps:
+            epoch_dataloader = accelerator.skip_first_batches(train_dataloader, skip_steps)
+        
+        for step, batch in enumerate(epoch_dataloader, start=skip_steps if epoch == start_epoch else 0):
             with accelerator.accumulate(model.unet):
-                # Get text embeddings
-                text_embeddings = model.encode_text(batch["captions"])
-                
-                # Convert images to latent space
-                latents = model.encode_image(batch["images"])
+                if use_latent_cache:
+                    # Sample this epoch's latents from the cached VAE distribution
+                    text_embeddings = batch["text_embedding"]
+                    latents = batch["latent_mean"] + batch["latent_std"] * torch.randn_like(batch["latent_std"])
+                    latents = latents * model.vae.config.scaling_factor
+                else:
+                    # Get text embeddings
+                    text_embeddings = model.encode_text(batch["captions"])
+                    
+                    # Convert images to latent space
+                    latents = model.encode_image(batch["images"])
                 
                 # Add noise to the latents
                 noise = torch.randn_like(latents)
@@ -134,24 +298,44 @@ def train(
             progress_bar.update(1)
             progress_bar.set_postfix({"loss": loss.item(), "epoch": epoch})
             total_steps += 1
+            samples_seen += latents.shape[0]
             
-            if total_steps >= max_train_steps:
+            if progress_callback is not None:
+                progress_callback({
+                    "epoch": epoch,
+                    "step": total_steps,
+                    "total_steps": max_train_steps,
+                    "loss": loss.item(),
+                    "samples_per_second": samples_seen / (time.perf_counter() - start_time),
+                })
+            
+            if should_stop is not None and should_stop():
+                save_checkpoint(epoch, step + 1)
+                print("Fine-tuning stopped, checkpoint saved")
+                return None
+            
+            if max_train_steps is not None and total_steps >= max_train_steps:
                 break
         
         # Save checkpoint after each epoch
         accelerator.wait_for_everyone()
         unwrapped_unet = accelerator.unwrap_model(model.unet)
         
-        # Create the output directory if it doesn't exist
-        os.makedirs(output_dir, exist_ok=True)
-        
         # Save the U-Net model
-        unwrapped_unet.save_pretrained(os.path.join(output_dir, f"unet_epoch_{epoch}"))
+        save_unet(unwrapped_unet, os.path.join(output_dir, f"unet_epoch_{epoch}"), lora=bool(lora_rank))
+        save_checkpoint(epoch + 1, 0)
+        
+        if max_train_steps is not None and total_steps >= max_train_steps:
+            break
     
     # Save the final model
     accelerator.wait_for_everyone()
     unwrapped_unet = accelerator.unwrap_model(model.unet)
-    unwrapped_unet.save_pretrained(os.path.join(output_dir, "unet_final"))
+    save_unet(unwrapped_unet, os.path.join(output_dir, "unet_final"), lora=bool(lora_rank))
+    
+    # The resume state is only needed while a run is stopped or failed
+    if accelerator.is_main_process:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
     
     print("Fine-tuning complete!")
     return os.path.join(output_dir, "unet_final")
@@ -1,23 +1,302 @@
+import inspect
+import os
+import re
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import torch
-from PIL import Image
+from diffusers import StableDiffusionPipeline
+from batching import BatchScheduler, grid_chunks
+from cpu_profiles import get_profile, apply_profile, optimize_unet, set_thread_counts
+from memory import MemoryBudgetError, MemoryPlanner
+from metrics import STAGE_SECONDS
 from model import StableDiffusionModel
-from utils import image_to_base64, clean_prompt
+from registry import ModelRegistry, BASE_MODEL
+from schedulers import DEFAULT_SCHEDULER, make_scheduler
+from utils import encode_image, clean_prompt, preprocess_image, postprocess_image, latents_to_preview
 
 
 class StableDiffusionInference:
-    def __init__(self, model_path=None, model_id="CompVis/stable-diffusion-v1-4"):
-        """Initialize the inference pipeline with the fine-tuned model"""
-        self.model = StableDiffusionModel(model_id=model_id)
+    def __init__(
+        self,
+        model_path=None,
+        model_id="CompVis/stable-diffusion-v1-4",
+        batch_window=0.05,
+        max_batch_size=4,
+        embedding_cache_bytes=64 * 1024 * 1024,
+        cache_dir=None,
+        model_dir=None,
+        max_resident_models=2,
+        max_adapters=8,
+        cpu_profile="baseline",
+        num_threads=None,
+        interop_threads=None,
+        memory_budget_bytes=None,
+        vae_tile_size=512,
+        encode_threads=4,
+        png_compress_level=1,
+        weights_dir=None,
+    ):
+        """Initialize the inference pipeline with the fine-tuned model
+        
+        Weights are not loaded here: they load on first use, or in the
+        background after calling ``warmup``. ``cpu_profile`` names one of
+        ``cpu_profiles.CPU_PROFILES`` and only takes effect on the CPU.
+        Requests whose activations would exceed ``memory_budget_bytes`` run
+        with tiled VAE passes and sliced attention, or are refused.
+        Output images are compressed on ``encode_threads`` threads.
+        With a ``weights_dir`` snapshot (see ``serve.prepare_weights``), weights are
+        memory-mapped from it and shared with other processes mapping it.
+        """
+        # Validate the profile and size the thread pools before any torch work runs
+        self.cpu_profile = cpu_profile
+        self._profile = get_profile(cpu_profile)
+        set_thread_counts(num_threads, interop_threads)
+        
+        # Slicing the CPU profile applies to every U-Net, restored after requests that slice further
+        on_cpu = not torch.cuda.is_available()
+        self._attention_slice = "auto" if on_cpu and self._profile["attention_slicing"] else None
+        # diffusers runs unsliced attention through torch 2's fused scaled_dot_product_attention
+        fused_attention = hasattr(torch.nn.functional, "scaled_dot_product_attention")
+        self.memory = MemoryPlanner(memory_budget_bytes, vae_tile_size, self._attention_slice, fused_attention)
+        
+        self._model_options = {
+            "model_id": model_id,
+            "embedding_cache_bytes": embedding_cache_bytes,
+            "cache_dir": cache_dir,
+            # Load the fine-tuned U-Net if provided
+            "unet_path": model_path,
+            "weights_dir": weights_dir,
+        }
+        self._model_path = model_path
+        self._model_dir = model_dir
+        self._max_resident_models = max_resident_models
+        self._max_adapters = max_adapters
+        self._model = None
+        self._pipeline = None
+        self._registry = None
+        self._load_lock = threading.Lock()
+        self.load_error = None
+        
+        # Serialize access to the shared pipeline
+        self._pipeline_lock = threading.Lock()
+        
+        # PIL releases the GIL while compressing, so a batch's images encode in parallel
+        self.png_compress_level = png_compress_level
+        self._encoder = ThreadPoolExecutor(max_workers=max(1, encode_threads), thread_name_prefix="image-encode")
+        
+        # Batch compatible text-to-image requests into single denoising runs
+        self.scheduler = BatchScheduler(
+            self._generate_batch,
+            window=batch_window,
+            max_batch_size=max_batch_size,
+        )
+    
+    @property
+    def ready(self):
+        return self._pipeline is not None
+    
+    @property
+    def model(self):
+        self.load()
+        return self._model
+    
+    @property
+    def pipeline(self):
+        self.load()
+        return self._pipeline
+    
+    @property
+    def registry(self):
+        self.load()
+        return self._registry
+    
+    def load(self):
+        """Load the model components and create the pipeline, once"""
+        if self._pipeline is not None:
+            return
         
-        # Load the fine-tuned U-Net if provided
-        if model_path:
-            self.model.load_unet(model_path)
+        with self._load_lock:
+            if self._pipeline is not None:
+                return
+            
+            try:
+                model = StableDiffusionModel(**self._model_options)
+                
+                # Quantize, cast or compile the components for the CPU profile
+                if model.device == "cpu":
+                    apply_profile(model, self._profile)
+                
+                # Create the pipeline
+                pipeline = model.create_pipeline()
+                
+                # Compile ahead of the first request so it doesn't pay for tracing
+                if model.device == "cpu" and self._profile["compile"]:
+                    self._warmup_compiled(pipeline)
+            except Exception as e:
+                self.load_error = str(e)
+                raise
+            
+            # Fine-tuned U-Nets share the text encoder and VAE loaded above
+            registry = ModelRegistry(
+                self._model_dir or "",
+                lambda path: self._read_unet(model, path),
+                base_version=model.model_id,
+                max_resident=self._max_resident_models,
+                load_adapter=self._load_adapter,
+                unload_adapter=self._unload_adapter,
+                max_adapters=self._max_adapters,
+            )
+            initial_model = self._initial_model_name()
+            registry.default = initial_model
+            registry.add_resident(initial_model, model.unet, path=self._model_path)
+            
+            self.load_error = None
+            self._model = model
+            self._registry = registry
+            self._pipeline = pipeline
+    
+    def _read_unet(self, model, path):
+        """Load a registry U-Net and apply the CPU profile to it like the base U-Net"""
+        unet = model.read_unet(path)
+        if model.device == "cpu":
+            unet = optimize_unet(unet, self._profile)
+        return unet
+    
+    @staticmethod
+    def _adapter_name(name):
+        # Adapter names become module keys, which can't contain dots
+        return re.sub(r"\W", "_", name)
+    
+    def _load_adapter(self, unet, path, name):
+        """Add a LoRA adapter checkpoint to the shared base U-Net, without activating it"""
+        if self._model.device == "cpu" and self._profile["quantize"]:
+            raise ValueError("LoRA adapters cannot be applied to an int8-quantized U-Net")
         
-        # Create the pipeline
-        self.pipeline = self.model.create_pipeline()
+        state_dict, network_alphas = StableDiffusionPipeline.lora_state_dict(path)
         
-        # Set generator for reproducibility
-        self.generator = torch.Generator(device=self.model.device)
+        # Adding layers must not overlap a denoising run on the same U-Net
+        with self._pipeline_lock:
+            StableDiffusionPipeline.load_lora_into_unet(
+                state_dict,
+                network_alphas,
+                unet=getattr(unet, "_orig_mod", unet),
+                adapter_name=self._adapter_name(name),
+            )
+    
+    def _unload_adapter(self, unet, name):
+        with self._pipeline_lock:
+            getattr(unet, "_orig_mod", unet).delete_adapters(self._adapter_name(name))
+    
+    def _activate_adapter(self, entry):
+        """Activate a request's adapter on its U-Net, or turn adapters off for the plain U-Net
+        
+        Must be called with the pipeline lock held, since adapters are
+        switched on the U-Net shared by every request for the base model.
+        """
+        unet = getattr(entry.unet, "_orig_mod", entry.unet)
+        if entry.adapter is not None:
+            unet.enable_adapters()
+            unet.set_adapters([self._adapter_name(entry.adapter)])
+        elif getattr(unet, "peft_config", None):
+            unet.disable_adapters()
+    
+    @staticmethod
+    def _warmup_compiled(pipeline, size=512):
+        """Run a short generation to trigger compilation at the default image size"""
+        with torch.no_grad():
+            pipeline("", height=size, width=size, num_inference_steps=2, output_type="latent")
+    
+    def _autocast(self):
+        """Mixed precision on GPUs; on the CPU only when the profile asks for it"""
+        enabled = self.model.device != "cpu" or self._profile["autocast"]
+        return torch.autocast(self.model.device, enabled=enabled)
+    
+    def _initial_model_name(self):
+        if not self._model_path:
+            return BASE_MODEL
+        if self._model_dir:
+            relative = os.path.relpath(self._model_path, self._model_dir)
+            if not relative.startswith(".."):
+                return relative.replace(os.sep, "/")
+        return self._model_path
+    
+    def plan_memory(self, height, width, batch_size=1, guidance_scale=7.5):
+        """Return how a generation will run within the memory budget; raises ``MemoryBudgetError`` if it can't"""
+        return self.memory.plan(height, width, batch_size, guidance=guidance_scale > 1.0)
+    
+    @contextmanager
+    def _sliced_attention(self, unet, attention_slice):
+        """Slice a U-Net's attention for the duration of one request"""
+        if attention_slice == self._attention_slice:
+            yield
+            return
+        
+        unet.set_attention_slice(attention_slice)
+        try:
+            yield
+        finally:
+            unet.set_attention_slice(self._attention_slice)
+    
+    def resolve_model(self, name=None):
+        """Return ``(name, version)`` of a served model; None means the current default"""
+        return self.registry.resolve(name)
+    
+    def set_default_model(self, name):
+        """Load a model and make it the default for new requests, returning its ``(name, version)``"""
+        self.registry.set_default(name)
+        return self.resolve_model()
+    
+    def resident_models(self):
+        """Names of the models currently in memory"""
+        return set(self.registry.resident())
+    
+    def text_cache_stats(self):
+        # Don't load the model just to report on it
+        return self.model.text_cache.stats() if self.ready else {}
+    
+    def embed_prompts(self, prompts):
+        """Pooled text embeddings of prompts, as a float32 array with one row per prompt"""
+        return self.model.encode_pooled_text(prompts).float().cpu().numpy()
+    
+    def _pipeline_for(self, entry, scheduler):
+        """Pipeline running a resident U-Net with the shared text encoder and VAE
+        
+        Every call gets a pipeline of its own with a fresh scheduler, so
+        requests with different schedulers never see each other's state.
+        The components themselves are shared, not copied.
+        """
+        return StableDiffusionPipeline(
+            **{
+                **self.pipeline.components,
+                "unet": entry.unet,
+                "scheduler": make_scheduler(scheduler, self.model.noise_scheduler.config),
+            },
+            requires_safety_checker=self.pipeline.config.requires_safety_checker,
+        )
+    
+    def warmup(self):
+        """Start loading the model in a background thread"""
+        thread = threading.Thread(target=self._warmup, name="model-warmup", daemon=True)
+        thread.start()
+        return thread
+    
+    def _warmup(self):
+        try:
+            self.load()
+        except Exception:
+            traceback.print_exc()
+    
+    def status(self):
+        """Report whether the model is loaded, still loading or failed to load"""
+        return {
+            "ready": self.ready,
+            "loading": self._load_lock.locked(),
+            "error": self.load_error,
+            "cpu_profile": self.cpu_profile,
+        }
     
     def generate_image(
         self,
@@ -28,37 +307,238 @@ class StableDiffusionInference:
         num_inference_steps=50,
         guidance_scale=7.5,
         seed=None,
+        progress_callback=None,
+        model=None,
+        scheduler=DEFAULT_SCHEDULER,
+        preview_every=0,
+        image_format="png",
+        quality=90,
     ):
-        """Generate an image from a text prompt"""
+        """Generate an image from a text prompt
+
+        ``progress_callback(step, total_steps)`` is called after every denoising step,
+        with a ``preview`` PIL image every ``preview_every`` steps; if it raises, the
+        request is abandoned with that exception.
+        ``model`` names the U-Net to use; None uses the registry's default.
+        ``scheduler`` names one of ``schedulers.SCHEDULERS``.
+        The result's ``image`` holds the image bytes, encoded as ``image_format``
+        (one of ``utils.IMAGE_FORMATS``) at ``quality`` for the lossy formats.
+        """
         # Clean the input prompt
         prompt = clean_prompt(prompt)
         
-        # Set the seed if provided
-        if seed is not None:
-            self.generator.manual_seed(seed)
-        else:
-            self.generator.seed()
-        
-        # Generate the image
-        with torch.autocast(self.model.device):
-            image = self.pipeline(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                height=height,
-                width=width,
-                num_inference_steps=num_inference_steps,
-                guidance_scale=guidance_scale,
-                generator=self.generator,
-            ).images[0]
-        
-        # Convert to base64 for API response
-        base64_image = image_to_base64(image)
+        # Pick the seed up front so every request owns its generator
+        if seed is None:
+            seed = torch.randint(0, 2**32, (1,)).item()
         
-        return {
-            "image": base64_image,
+        # Resolve the model now so a later default change doesn't affect this request
+        model_name, _ = self.resolve_model(model)
+        
+        # Requests sharing a model, scheduler and shape are batched into one pipeline call
+        key = (model_name, scheduler, height, width, num_inference_steps, guidance_scale)
+        future = self.scheduler.submit(key, {
             "prompt": prompt,
-            "seed": self.generator.initial_seed(),
+            "negative_prompt": negative_prompt,
+            "seed": seed,
+            "progress_callback": progress_callback,
+            "preview_every": preview_every,
+            "image_format": image_format,
+            "quality": quality,
+        })
+        
+        return future.result()
+    
+    def generate_grid(
+        self,
+        items,
+        height=512,
+        width=512,
+        model=None,
+        scheduler=DEFAULT_SCHEDULER,
+        image_format="png",
+        quality=90,
+        max_chunk_size=8,
+    ):
+        """Generate a grid of images, yielding the ``(index, result)`` pairs of each chunk as it finishes
+
+        ``items`` are dicts with ``prompt``, ``negative_prompt``, ``seed``,
+        ``guidance_scale`` and ``num_inference_steps``. Items sharing
+        guidance and steps run in batches of up to ``max_chunk_size``, or as
+        many as fit in the memory budget, without waiting in the batching
+        window. Each item has its own seeded generator, so it comes out as
+        ``generate_image`` would make it. Prompts are encoded once for the
+        whole grid.
+        """
+        model_name, _ = self.resolve_model(model)
+        items = [
+            {
+                **item,
+                "prompt": clean_prompt(item["prompt"]),
+                "seed": item["seed"] if item["seed"] is not None else torch.randint(0, 2**32, (1,)).item(),
+            }
+            for item in items
+        ]
+        
+        # Chunks after the first find every embedding in the text cache
+        with STAGE_SECONDS.time("text_encode"):
+            self.model.encode_text(list(dict.fromkeys(
+                [item["prompt"] for item in items] + [item["negative_prompt"] for item in items]
+            )))
+        
+        def chunk_size(guidance_scale, num_inference_steps):
+            return self._max_batch_size(height, width, guidance_scale, max_chunk_size)
+        
+        for guidance_scale, num_inference_steps, indices in grid_chunks(items, chunk_size):
+            key = (model_name, scheduler, height, width, num_inference_steps, guidance_scale)
+            requests = [
+                {
+                    "prompt": items[i]["prompt"],
+                    "negative_prompt": items[i]["negative_prompt"],
+                    "seed": items[i]["seed"],
+                    "progress_callback": None,
+                    "preview_every": 0,
+                    "image_format": image_format,
+                    "quality": quality,
+                }
+                for i in indices
+            ]
+            yield list(zip(indices, self._generate_batch(key, requests)))
+    
+    def _max_batch_size(self, height, width, guidance_scale, limit):
+        """Largest batch of at most ``limit`` images that fits in the memory budget"""
+        for batch_size in range(limit, 1, -1):
+            try:
+                self.plan_memory(height, width, batch_size, guidance_scale)
+                return batch_size
+            except MemoryBudgetError:
+                continue
+        return 1
+    
+    def _generate_batch(self, key, requests):
+        """Run a batch of compatible text-to-image requests as one pipeline call"""
+        model_name, scheduler, height, width, num_inference_steps, guidance_scale = key
+        
+        try:
+            plan = self.plan_memory(height, width, len(requests), guidance_scale)
+        except MemoryBudgetError:
+            if len(requests) == 1:
+                raise
+            # Run batches too large for the memory budget in halves
+            half = len(requests) // 2
+            return self._generate_batch(key, requests[:half]) + self._generate_batch(key, requests[half:])
+        
+        # One seeded generator per request keeps results independent of batching
+        generators = [
+            torch.Generator(device=self.model.device).manual_seed(request["seed"])
+            for request in requests
+        ]
+        
+        # Reuse cached text embeddings instead of re-encoding in the pipeline
+        with STAGE_SECONDS.time("text_encode"):
+            prompt_embeds = self.model.encode_text([request["prompt"] for request in requests])
+            negative_prompt_embeds = self.model.encode_text(
+                [request["negative_prompt"] for request in requests]
+            )
+        
+        # Fan the shared step callback out to every request in the batch
+        listeners = {i: request for i, request in enumerate(requests) if request["progress_callback"]}
+        abandoned = {}
+        last_step = 0
+        step_start = None
+        
+        def report_progress(step, timestep, latents):
+            nonlocal last_step, step_start
+            
+            now = time.perf_counter()
+            STAGE_SECONDS.observe(now - step_start, "unet_step")
+            step_start = now
+            
+            # Some schedulers run an extra warmup step, so don't report past the total
+            step = min(step + 1, num_inference_steps)
+            if step == last_step:
+                return
+            last_step = step
+            
+            for i, request in list(listeners.items()):
+                try:
+                    self._report_step(
+                        request["progress_callback"],
+                        step,
+                        num_inference_steps,
+                        request["preview_every"],
+                        latents[i:i + 1],
+                    )
+                except Exception as e:
+                    # A failing callback, such as a cancelled job, drops its request from the batch
+                    del listeners[i]
+                    abandoned[i] = e
+            
+            # Stop denoising as soon as nobody is waiting for the result
+            if len(abandoned) == len(requests):
+                raise next(iter(abandoned.values()))
+        
+        with self.registry.lease(model_name) as entry, self._pipeline_lock, self._autocast():
+            pipeline = self._pipeline_for(entry, scheduler)
+            self._activate_adapter(entry)
+            with self._sliced_attention(entry.unet, plan["attention_slice"]):
+                step_start = time.perf_counter()
+                latents = pipeline(
+                    prompt_embeds=prompt_embeds,
+                    negative_prompt_embeds=negative_prompt_embeds,
+                    height=height,
+                    width=width,
+                    num_inference_steps=num_inference_steps,
+                    guidance_scale=guidance_scale,
+                    generator=generators,
+                    # The callback also times every step
+                    callback=report_progress,
+                    callback_steps=1,
+                    # Decoded here, so the VAE pass is timed and large images can be tiled
+                    output_type="latent",
+                ).images
+            
+            tile_size = self.memory.tile_size if plan["tiled_vae"] else None
+            with STAGE_SECONDS.time("vae_decode"):
+                images = self._decode(pipeline, latents, prompt_embeds.dtype, tile_size)
+        
+        # Compress for the response; abandoned requests get their exception back
+        encoded = {
+            i: self._encoder.submit(self._encode_image, image, request["image_format"], request["quality"])
+            for i, (request, image) in enumerate(zip(requests, images))
+            if i not in abandoned
         }
+        return [
+            abandoned[i] if i in abandoned else {
+                "image": encoded[i].result(),
+                "format": request["image_format"],
+                "prompt": request["prompt"],
+                "seed": request["seed"],
+                "model": model_name,
+            }
+            for i, request in enumerate(requests)
+        ]
+    
+    def _decode(self, pipeline, latents, dtype, tile_size=None):
+        """Decode latents, in tiles with ``tile_size``, then safety check and convert them as the pipeline would"""
+        images = self.model.decode_latents(latents, tile_size=tile_size)
+        images, has_nsfw_concept = pipeline.run_safety_checker(images, self.model.device, dtype)
+        
+        do_denormalize = None
+        if has_nsfw_concept is not None:
+            do_denormalize = [not has_nsfw for has_nsfw in has_nsfw_concept]
+        return pipeline.image_processor.postprocess(images, output_type="pil", do_denormalize=do_denormalize)
+    
+    def _encode_image(self, image, image_format, quality):
+        with STAGE_SECONDS.time("image_encode"):
+            return encode_image(image, image_format, quality, self.png_compress_level)
+    
+    @staticmethod
+    def _report_step(progress_callback, step, total_steps, preview_every, latents):
+        """Report a finished step, attaching a preview of the latents every ``preview_every`` steps"""
+        if preview_every and (step % preview_every == 0 or step == total_steps):
+            progress_callback(step, total_steps, preview=latents_to_preview(latents))
+        else:
+            progress_callback(step, total_steps)
     
     def generate_variations(
         self,
@@ -69,42 +549,160 @@ class StableDiffusionInference:
         num_inference_steps=50,
         guidance_scale=7.5,
         num_variations=4,
+        progress_callback=None,
+        model=None,
+        scheduler=DEFAULT_SCHEDULER,
+        preview_every=0,
+        image_format="png",
+        quality=90,
     ):
-        """Generate variations of an input image using img2img"""
+        """Generate variations of an input image using img2img
+
+        ``progress_callback(step, total_steps)`` is called after every denoising step,
+        with a ``preview`` PIL image of all variations every ``preview_every`` steps.
+        ``model`` names the U-Net to use; None uses the registry's default.
+        ``scheduler`` names one of ``schedulers.SCHEDULERS``.
+        Images are encoded as for ``generate_image``.
+        """
         # Clean the input prompt
         prompt = clean_prompt(prompt) if prompt else ""
         
-        # Create a list to store the variations
-        variations = []
+        # Plan for the size the init image is encoded at
+        width, height = (dim - dim % 8 for dim in image.size)
+        plan = self.plan_memory(height, width, num_variations, guidance_scale)
         
-        # Generate the variations
-        for i in range(num_variations):
-            # Set a different seed for each variation
-            seed = torch.randint(0, 2**32, (1,)).item()
-            self.generator.manual_seed(seed)
+        # Set a different seed for each variation
+        seeds = [torch.randint(0, 2**32, (1,)).item() for _ in range(num_variations)]
+        generators = [
+            torch.Generator(device=self.model.device).manual_seed(seed)
+            for seed in seeds
+        ]
+        
+        # Generate all variations in a single batched pass
+        with self.registry.lease(model) as entry, self._pipeline_lock, self._autocast():
+            self._activate_adapter(entry)
+            with self._sliced_attention(entry.unet, plan["attention_slice"]):
+                images = self._img2img_batch(
+                    entry.unet,
+                    make_scheduler(scheduler, self.model.noise_scheduler.config),
+                    image,
+                    prompt,
+                    negative_prompt,
+                    strength,
+                    num_inference_steps,
+                    guidance_scale,
+                    generators,
+                    progress_callback,
+                    preview_every,
+                    tile_size=self.memory.tile_size if plan["tiled_vae"] else None,
+                )
+        
+        # Compress all variations in parallel, outside the pipeline lock
+        encoded = [
+            self._encoder.submit(self._encode_image, variation_image, image_format, quality)
+            for variation_image in images
+        ]
+        return [
+            {
+                "image": future.result(),
+                "format": image_format,
+                "prompt": prompt,
+                "seed": seed,
+                "model": entry.name,
+            }
+            for seed, future in zip(seeds, encoded)
+        ]
+    
+    @torch.no_grad()
+    def _img2img_batch(
+        self,
+        unet,
+        scheduler,
+        image,
+        prompt,
+        negative_prompt,
+        strength,
+        num_inference_steps,
+        guidance_scale,
+        generators,
+        progress_callback=None,
+        preview_every=0,
+        tile_size=None,
+    ):
+        """Denoise one batched latent per generator from a single encoded prompt and image
+
+        With ``tile_size`` the VAE encodes and decodes in overlapping tiles of that many pixels.
+        """
+        device = self.model.device
+        batch_size = len(generators)
+        do_classifier_free_guidance = guidance_scale > 1.0
+        
+        # Encode the prompt once and share it across the batch
+        with STAGE_SECONDS.time("text_encode"):
+            text_embeddings = self.model.encode_text([prompt]).repeat(batch_size, 1, 1)
+            if do_classifier_free_guidance:
+                uncond_embeddings = self.model.encode_text([negative_prompt]).repeat(batch_size, 1, 1)
+                text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
+        
+        # Encode the init image once, snapping its size to the VAE's factor of 8
+        width, height = (dim - dim % 8 for dim in image.size)
+        image_tensor = preprocess_image(image, (width, height)).unsqueeze(0).to(device, self.model.vae.dtype)
+        with STAGE_SECONDS.time("vae_encode"):
+            latent_dist = self.model.encode_latent_dist(image_tensor, tile_size)
+        init_latents = torch.cat([latent_dist.sample(generator=g) for g in generators])
+        init_latents = init_latents * self.model.vae.config.scaling_factor
+        
+        # Skip the first part of the schedule according to strength
+        scheduler.set_timesteps(num_inference_steps, device=device)
+        init_timestep = min(int(num_inference_steps * strength), num_inference_steps)
+        t_start = max(num_inference_steps - init_timestep, 0)
+        timesteps = scheduler.timesteps[t_start * scheduler.order:]
+        if len(timesteps) == 0:
+            raise ValueError("Strength is too low to run any denoising steps")
+        if hasattr(scheduler, "set_begin_index"):
+            scheduler.set_begin_index(t_start * scheduler.order)
+        
+        # Stochastic schedulers draw their step noise from the per-variation generators
+        step_kwargs = {}
+        if "generator" in inspect.signature(scheduler.step).parameters:
+            step_kwargs["generator"] = generators
+        
+        # Noise each variation with its own generator
+        noise = torch.cat([
+            torch.randn(
+                init_latents.shape[1:],
+                generator=g,
+                device=device,
+                dtype=init_latents.dtype,
+            ).unsqueeze(0)
+            for g in generators
+        ])
+        latents = scheduler.add_noise(init_latents, noise, timesteps[:1].repeat(batch_size))
+        
+        # Denoise the whole batch together
+        for i, t in enumerate(timesteps):
+            step_start = time.perf_counter()
+            latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
+            latent_model_input = scheduler.scale_model_input(latent_model_input, t)
             
-            with torch.autocast(self.model.device):
-                variation_image = self.pipeline(
-                    prompt=prompt,
-                    negative_prompt=negative_prompt,
-                    image=image,
-                    strength=strength,
-                    num_inference_steps=num_inference_steps,
-                    guidance_scale=guidance_scale,
-                    generator=self.generator,
-                ).images[0]
+            noise_pred = unet(
+                latent_model_input, t, encoder_hidden_states=text_embeddings
+            ).sample
             
-            # Convert to base64 for API response
-            base64_image = image_to_base64(variation_image)
+            if do_classifier_free_guidance:
+                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
             
-            variations.append({
-                "image": base64_image,
-                "prompt": prompt,
-                "seed": seed,
-            })
+            latents = scheduler.step(noise_pred, t, latents, **step_kwargs).prev_sample
+            STAGE_SECONDS.observe(time.perf_counter() - step_start, "unet_step")
+            
+            if progress_callback:
+                self._report_step(progress_callback, i + 1, len(timesteps), preview_every, latents)
         
-        return variations
-
+        # Decode all variations in one VAE batch
+        with STAGE_SECONDS.time("vae_decode"):
+            images = self.model.decode_latents(latents, tile_size).float()
+        return [postprocess_image(image) for image in images]
 
 if __name__ == "__main__":
     # Example usage
@@ -120,9 +718,5 @@ if __name__ == "__main__":
     print(f"Seed: {result['seed']}")
     
     # Save the image to a file
-    import base64
-    from io import BytesIO
-    
-    image_data = base64.b64decode(result["image"].split(",")[1])
-    image = Image.open(BytesIO(image_data))
-    image.save("generated_image.png")
\ No newline at end of file
+    with open(f"generated_image.{result['format']}", "wb") as f:
+        f.write(result["image"])
\ No newline at end of file
@@ -0,0 +1,256 @@
+"""Inference worker: runs generation tasks from a broker on its own model.
+
+Start any number of these next to an API started with the same
+``BROKER_URL``; each loads the model once and takes tasks until stopped.
+Workers read the same environment variables as ``app.py`` and must see
+the same ``MODEL_DIR`` and ``BLOB_DIR`` as the API. Example:
+
+    BROKER_URL=sqlite:///data/broker.db python inference_worker.py --concurrency 4
+
+SIGTERM or Ctrl-C stops taking tasks and finishes the running ones.
+"""
+import argparse
+import base64
+import io
+import os
+import signal
+import threading
+import time
+import traceback
+
+from PIL import Image
+
+from blob_store import SCRATCH_DIR, ScratchStore
+from broker import make_broker
+from inference import StableDiffusionInference
+from jobs import JobCancelled
+from utils import make_thumbnail
+
+MODEL_DIR = os.environ.get("MODEL_DIR", "./models")
+MODEL_ID = os.environ.get("MODEL_ID", "CompVis/stable-diffusion-v1-4")
+BLOB_DIR = os.environ.get("BLOB_DIR", "./blobs")
+BROKER_URL = os.environ.get("BROKER_URL", "")
+WORKER_LEASE_SECONDS = float(os.environ.get("WORKER_LEASE_SECONDS", 30))
+FINETUNED_MODEL_PATH = os.path.join(MODEL_DIR, "unet_final")
+
+# How long finished tasks, departed workers and unread scratch images are kept
+TASK_RETENTION_SECONDS = 3600
+
+
+def inference_from_env():
+    """The inference service ``app.py`` would create in-process, configured the same way"""
+    return StableDiffusionInference(
+        model_path=FINETUNED_MODEL_PATH if os.path.exists(FINETUNED_MODEL_PATH) else None,
+        model_id=MODEL_ID,
+        batch_window=float(os.environ.get("BATCH_WINDOW_MS", 50)) / 1000,
+        max_batch_size=int(os.environ.get("MAX_BATCH_SIZE", 4)),
+        embedding_cache_bytes=int(os.environ.get("EMBEDDING_CACHE_MB", 64)) * 1024 * 1024,
+        cache_dir=os.environ.get("MODEL_CACHE_DIR") or None,
+        model_dir=MODEL_DIR,
+        max_resident_models=int(os.environ.get("MAX_RESIDENT_MODELS", 2)),
+        max_adapters=int(os.environ.get("MAX_RESIDENT_ADAPTERS", 8)),
+        cpu_profile=os.environ.get("CPU_PROFILE", "baseline"),
+        num_threads=int(os.environ.get("TORCH_NUM_THREADS", 0)) or None,
+        interop_threads=int(os.environ.get("TORCH_INTEROP_THREADS", 0)) or None,
+        memory_budget_bytes=int(os.environ.get("MEMORY_BUDGET_MB", 6144)) * 1024 * 1024 or None,
+        vae_tile_size=int(os.environ.get("VAE_TILE_SIZE", 512)),
+        encode_threads=int(os.environ.get("ENCODE_THREADS", 4)),
+        png_compress_level=int(os.environ.get("PNG_COMPRESS_LEVEL", 1)),
+        weights_dir=os.environ.get("WEIGHTS_DIR") or None,
+    )
+
+
+class InferenceWorker:
+    """Takes tasks from a broker and runs them on ``concurrency`` threads
+
+    Concurrent text-to-image tasks for the same model and settings are
+    batched by the inference service, so ``concurrency`` is best set to
+    its ``max_batch_size``. A heartbeat thread keeps the worker's task
+    leases alive and tells the broker which model versions are resident,
+    so tasks for them are routed here.
+    """
+
+    def __init__(self, broker, inference, scratch, concurrency=4, models=(), poll_interval=0.1):
+        self.broker = broker
+        self.inference = inference
+        self.scratch = scratch
+        self.concurrency = max(1, concurrency)
+        self.models = tuple(models)
+        self.poll_interval = poll_interval
+        self.worker_id = None
+        self._routes = []
+
+        self._stopping = threading.Event()
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Load the model, then take tasks until ``stop`` is called"""
+        # Register only once the model is loaded, so tasks are never routed to a worker still loading
+        self.inference.load()
+        self._refresh_routes()
+        self.worker_id = self.broker.register_worker(self.models)
+        print(f"Inference worker {self.worker_id} taking tasks")
+
+        heartbeat = threading.Thread(target=self._heartbeat, name="worker-heartbeat", daemon=True)
+        heartbeat.start()
+        threads = [
+            threading.Thread(target=self._take_tasks, name=f"worker-task-{i}")
+            for i in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.broker.unregister_worker(self.worker_id)
+
+    def stop(self):
+        """Stop taking tasks; running ones finish first"""
+        self._stopping.set()
+
+    def routes(self):
+        """Versions of the models resident here, as of the last heartbeat or task"""
+        return self._routes
+
+    def _refresh_routes(self):
+        # Resolving versions scans the model directory, too slow to do on every claim poll
+        try:
+            self._routes = [self.inference.resolve_model(name)[1] for name in self.inference.resident_models()]
+        except Exception:
+            traceback.print_exc()
+
+    def _heartbeat(self):
+        interval = self.broker.lease_seconds / 3
+        next_prune = 0
+        while True:
+            try:
+                self._refresh_routes()
+                with self._lock:
+                    running = self._running
+                self.broker.heartbeat(self.worker_id, self.routes(), running)
+                self.broker.requeue_expired()
+                if time.monotonic() >= next_prune:
+                    self.broker.prune(TASK_RETENTION_SECONDS)
+                    # Results whose request was abandoned after the task finished are never read
+                    self.scratch.prune(TASK_RETENTION_SECONDS)
+                    next_prune = time.monotonic() + TASK_RETENTION_SECONDS / 10
+            except Exception:
+                traceback.print_exc()
+            time.sleep(interval)
+
+    def _take_tasks(self):
+        while not self._stopping.is_set():
+            try:
+                task = self.broker.claim(self.worker_id, self.models, self.routes())
+            except Exception:
+                traceback.print_exc()
+                task = None
+            if task is None:
+                self._stopping.wait(self.poll_interval)
+                continue
+
+            with self._lock:
+                self._running += 1
+            try:
+                self._run_task(task)
+            except Exception:
+                # The broker was unreachable; the task's lease expires and another worker retries it
+                traceback.print_exc()
+            finally:
+                # The task may have loaded another model
+                self._refresh_routes()
+                with self._lock:
+                    self._running -= 1
+
+    def _run_task(self, task):
+        task_id = task["id"]
+
+        def report_progress(step, total_steps, preview=None):
+            progress = {"step": step, "total_steps": total_steps, "preview": None}
+            if preview is not None:
+                thumbnail = make_thumbnail(preview, size=max(preview.size), quality=60)
+                progress["preview"] = base64.b64encode(thumbnail).decode()
+            if not self.broker.report_progress(task_id, self.worker_id, progress):
+                raise JobCancelled()
+
+        try:
+            result = getattr(self, f"_run_{task['kind']}")(task["payload"], report_progress)
+        except JobCancelled:
+            self.broker.fail(task_id, self.worker_id, "Cancelled", cancelled=True)
+        except Exception as e:
+            traceback.print_exc()
+            self.broker.fail(task_id, self.worker_id, str(e))
+        else:
+            self.broker.complete(task_id, self.worker_id, result)
+
+    def _store(self, results):
+        """Hand images back through the scratch store, returning references to them
+
+        Each result carries its prompt's embedding, from the text cache the
+        generation just filled, so the API can index the prompt without
+        another task.
+        """
+        prompts = list(dict.fromkeys(result["prompt"] for result in results))
+        vectors = dict(zip(prompts, self.inference.embed_prompts(prompts).tolist()))
+        return [
+            {
+                **{key: value for key, value in result.items() if key != "image"},
+                "scratch_ref": self.scratch.put(result["image"], result["format"]),
+                "prompt_vector": vectors[result["prompt"]],
+            }
+            for result in results
+        ]
+
+    def _run_generate(self, payload, report_progress):
+        result = self.inference.generate_image(**payload, progress_callback=report_progress)
+        return self._store([result])[0]
+
+    def _run_variations(self, payload, report_progress):
+        payload = dict(payload)
+        data = self.scratch.get(payload.pop("image_ref"), payload.pop("image_format"))
+        results = self.inference.generate_variations(
+            Image.open(io.BytesIO(data)),
+            image_format=payload.pop("output_format"),
+            progress_callback=report_progress,
+            **payload,
+        )
+        return self._store(results)
+
+    def _run_grid(self, payload, report_progress):
+        # Progress counts images; a cancelled task stops between batches
+        results = []
+        for chunk in self.inference.generate_grid(**payload):
+            results.extend(self._store([result for _, result in chunk]))
+            report_progress(len(results), len(payload["items"]))
+        return results
+
+    def _run_embed(self, payload, report_progress):
+        return {"vectors": self.inference.embed_prompts(payload["prompts"]).tolist()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--broker", default=BROKER_URL, help="Broker URL, such as sqlite:///data/broker.db")
+    parser.add_argument("--concurrency", type=int, default=int(os.environ.get("MAX_BATCH_SIZE", 4)))
+    parser.add_argument("--models", nargs="*", default=[], help="Only run tasks for these models")
+    args = parser.parse_args()
+
+    broker = make_broker(args.broker, lease_seconds=WORKER_LEASE_SECONDS)
+    if broker is None:
+        parser.error("A broker URL is required, with --broker or BROKER_URL")
+
+    worker = InferenceWorker(
+        broker,
+        inference_from_env(),
+        ScratchStore(os.path.join(BLOB_DIR, SCRATCH_DIR)),
+        concurrency=args.concurrency,
+        models=args.models,
+    )
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: worker.stop())
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class QueueFullError(Exception):
+    """Raised when a job is rejected because the queue is at capacity"""
+
+    def __init__(self, retry_after):
+        super().__init__("Job queue is full, retry later")
+        self.retry_after = retry_after
+
+
+class QueueClosedError(Exception):
+    """Raised when a job is submitted to a queue that is draining before shutdown"""
+
+    def __init__(self):
+        super().__init__("The server is shutting down, retry on another instance")
+
+
+class JobCancelled(Exception):
+    """Raised from a job's progress callback once the job has been cancelled"""
+
+    def __init__(self):
+        super().__init__("Job was cancelled")
+
+
+class Job:
+    def __init__(self, kind, func, priority=0):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.func = func
+        self.priority = priority
+        self.state = QUEUED
+        self.progress = {"step": 0, "total_steps": 0}
+        self.preview = None
+        self.cancel_requested = False
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        # Bumped on every change so streams can tell when to push an update
+        self.version = 0
+
+    @property
+    def finished(self):
+        return self.state in FINISHED_STATES
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "type": self.kind,
+            "state": self.state,
+            "priority": self.priority,
+            "progress": dict(self.progress),
+            "preview": self.preview,
+            "cancel_requested": self.cancel_requested,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """Bounded priority queue drained by a fixed pool of worker threads.
+
+    Jobs are callables taking a ``report_progress(step, total_steps,
+    preview=None)`` function. Higher priorities run first; equal priorities
+    run in submission order. When ``max_pending`` jobs are waiting, new jobs
+    are rejected with :class:`QueueFullError` instead of queueing indefinitely.
+
+    A running job is cancelled cooperatively: its next ``report_progress``
+    call raises :class:`JobCancelled`, which unwinds the job and frees the
+    worker.
+
+    With a ``store`` (such as ``db.Database``), every change to a job is
+    also saved there, so server processes sharing the store can report on
+    and cancel each other's jobs.
+    """
+
+    # How often a job owned by another process is checked for changes
+    STORE_POLL_INTERVAL = 0.5
+
+    def __init__(self, num_workers=2, max_pending=32, max_finished=1000, store=None):
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.num_workers = max(1, num_workers)
+        self.store = store
+        self._closed = False
+
+        self._heap = []
+        self._counter = itertools.count()
+        self._jobs = OrderedDict()
+        self._running = 0
+        self._cond = threading.Condition()
+
+        # Moving average of job run time, used for the retry hint
+        self._avg_duration = None
+
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            for i in range(self.num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, kind, func, priority=0):
+        """Queue a job and return it, or raise QueueFullError if the queue is full"""
+        with self._cond:
+            if self._closed:
+                raise QueueClosedError()
+            if len(self._heap) >= self.max_pending:
+                raise QueueFullError(self._retry_after())
+
+            job = Job(kind, func, priority)
+            self._jobs[job.id] = job
+            heapq.heappush(self._heap, (-priority, next(self._counter), job))
+            self._prune_finished()
+            self._cond.notify_all()
+            snapshot = job.to_dict()
+
+        if self.store is not None:
+            self.store.save_job(snapshot, job.version)
+            self.store.prune_jobs(self.max_finished)
+        return job
+
+    def get(self, job_id):
+        """Return a snapshot of a job as a dict, or None if it is unknown"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job.to_dict()
+        if self.store is not None:
+            snapshot, _ = self.store.get_job(job_id)
+            return snapshot
+        return None
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job and return its snapshot, or None if it is unknown"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return self._cancel_stored(job_id)
+
+            if job.state == QUEUED:
+                # Never started, so it can be dropped from the queue right away
+                self._heap = [entry for entry in self._heap if entry[2] is not job]
+                heapq.heapify(self._heap)
+                job.state = CANCELLED
+                job.finished_at = time.time()
+                job.func = None
+                job.version += 1
+            elif job.state == RUNNING and not job.cancel_requested:
+                job.cancel_requested = True
+                job.version += 1
+
+            self._cond.notify_all()
+            snapshot = job.to_dict()
+
+        self._save(snapshot, job.version)
+        return snapshot
+
+    def _cancel_stored(self, job_id):
+        """Ask the process owning a job to cancel it; its worker checks the store at every step"""
+        if self.store is None:
+            return None
+        snapshot, _ = self.store.get_job(job_id)
+        if snapshot is not None and snapshot["state"] not in FINISHED_STATES:
+            self.store.request_job_cancel(job_id)
+            snapshot["cancel_requested"] = True
+        return snapshot
+
+    def wait_for_update(self, job_id, version, timeout=None):
+        """Block until the job changes past ``version``; return ``(snapshot, version)``"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                self._cond.wait_for(lambda: job.version != version, timeout)
+                return job.to_dict(), job.version
+
+        if self.store is None:
+            return None, version
+
+        # Another process owns the job, so poll its stored snapshot
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot, stored_version = self.store.get_job(job_id)
+            if snapshot is None or stored_version != version:
+                return snapshot, stored_version if snapshot is not None else version
+            if deadline is not None and time.monotonic() >= deadline:
+                return snapshot, version
+            time.sleep(self.STORE_POLL_INTERVAL)
+
+    def close(self, timeout=None):
+        """Stop accepting jobs and wait for queued and running ones; returns whether all finished"""
+        with self._cond:
+            self._closed = True
+            return self._cond.wait_for(lambda: not self._heap and not self._running, timeout)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": len(self._heap),
+                "running": self._running,
+                "workers": self.num_workers,
+                "max_pending": self.max_pending,
+                "avg_duration": self._avg_duration,
+            }
+
+    def _retry_after(self):
+        """Estimate seconds until a queue slot frees up"""
+        if self._avg_duration is None:
+            return 1
+        waves = (len(self._heap) + self._running) / self.num_workers
+        return max(1, int(waves * self._avg_duration))
+
+    def _prune_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def _update(self, job, **changes):
+        with self._cond:
+            for name, value in changes.items():
+                setattr(job, name, value)
+            job.version += 1
+            self._cond.notify_all()
+            snapshot = job.to_dict()
+        self._save(snapshot, job.version)
+
+    def _save(self, snapshot, version):
+        if self.store is not None:
+            self.store.save_job(snapshot, version)
+
+    def _cancel_requested(self, job):
+        """Whether a job was cancelled, here or through the store by another process"""
+        if job.cancel_requested:
+            return True
+        if self.store is not None and self.store.job_cancel_requested(job.id):
+            job.cancel_requested = True
+            return True
+        return False
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._heap)
+                _, _, job = heapq.heappop(self._heap)
+                self._running += 1
+
+                # Mark it running under the same lock, so a cancel sees either queued or running
+                job.state = RUNNING
+                job.started_at = time.time()
+                job.version += 1
+                self._cond.notify_all()
+                snapshot = job.to_dict()
+            self._save(snapshot, job.version)
+
+            def report_progress(step, total_steps, preview=None, job=job):
+                if self._cancel_requested(job):
+                    raise JobCancelled()
+                changes = {"progress": {"step": step, "total_steps": total_steps}}
+                if preview is not None:
+                    changes["preview"] = {"step": step, "image": preview}
+                self._update(job, **changes)
+
+            try:
+                # Cancelled from another process while it was queued
+                if self.store is not None and self._cancel_requested(job):
+                    raise JobCancelled()
+                result = job.func(report_progress)
+                self._update(job, state=SUCCEEDED, result=result, finished_at=time.time())
+            except JobCancelled:
+                self._update(job, state=CANCELLED, finished_at=time.time())
+            except Exception as e:
+                traceback.print_exc()
+                self._update(job, state=FAILED, error=str(e), finished_at=time.time())
+
+            with self._cond:
+                self._running -= 1
+                duration = job.finished_at - job.started_at
+                if self._avg_duration is None:
+                    self._avg_duration = duration
+                else:
+                    self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+                # Drop the callable so finished jobs don't pin request data
+                job.func = None
+                self._cond.notify_all()
@@ -0,0 +1,155 @@
+import bisect
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm.auto import tqdm
+
+CACHE_VERSION = 2
+
+# Arrays stored per sample, all float16 to halve the cache size
+ARRAYS = ("latent_mean", "latent_std", "text_embedding")
+
+
+class LatentCache:
+    """Frozen encoder outputs for a training set, stored as memory-mapped arrays.
+
+    Each sample keeps the mean and standard deviation of its VAE latent
+    distribution rather than one sampled latent, so training still draws a
+    fresh latent every epoch. Samples are grouped by image bucket, one set of
+    raw float16 files per bucket shape, so batches read from one bucket
+    stack without padding. ``meta.json`` records what the cache was built
+    from; a cache built from another model, dataset or image size is stale.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+
+        # Memory-mapped read-only, so the cache is paged in on demand and shared between processes
+        self.buckets = []
+        self.offsets = []
+        self.arrays = []
+        total = 0
+        for bucket in self.meta["buckets"]:
+            self.buckets.append(bucket["key"])
+            self.offsets.append(total)
+            self.arrays.append({
+                name: np.memmap(
+                    os.path.join(cache_dir, f"{name}_{bucket['key']}.bin"),
+                    dtype=np.float16,
+                    mode="r",
+                    shape=(bucket["count"], *bucket["shapes"][name]),
+                )
+                for name in ARRAYS
+            })
+            total += bucket["count"]
+        self.count = total
+
+    def __len__(self):
+        return self.count
+
+    def locate(self, idx):
+        """Return ``(bucket number, row)`` of a sample"""
+        bucket = bisect.bisect_right(self.offsets, idx) - 1
+        return bucket, idx - self.offsets[bucket]
+
+    def sample_buckets(self):
+        """Bucket key of every sample, in index order"""
+        return [
+            key
+            for key, bucket in zip(self.buckets, self.meta["buckets"])
+            for _ in range(bucket["count"])
+        ]
+
+    @staticmethod
+    def is_valid(cache_dir, fingerprint):
+        """Whether a complete cache built with ``fingerprint`` exists in ``cache_dir``"""
+        try:
+            with open(os.path.join(cache_dir, "meta.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return meta.get("version") == CACHE_VERSION and meta.get("fingerprint") == fingerprint
+
+    @classmethod
+    def build(cls, cache_dir, batches, model, fingerprint):
+        """Encode ``{"captions", "images"}`` batches once and write the cache
+
+        Every batch must hold images of a single size. Outputs are appended
+        as they are encoded, so the number of samples need not be known up
+        front. The cache is written to a temporary directory and moved into
+        place when complete, so an interrupted build is never mistaken for a
+        valid cache.
+        """
+        tmp_dir = f"{cache_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        buckets = {}
+        files = {}
+        try:
+            for batch in tqdm(batches, desc="Caching latents"):
+                latent_dist = model.encode_latent_dist(batch["images"])
+                outputs = {
+                    "latent_mean": latent_dist.mean,
+                    "latent_std": latent_dist.std,
+                    "text_embedding": model.encode_text(batch["captions"]),
+                }
+
+                height, width = batch["images"].shape[-2:]
+                key = f"{width}x{height}"
+                if key not in buckets:
+                    buckets[key] = {
+                        "key": key,
+                        "count": 0,
+                        "shapes": {name: list(output.shape[1:]) for name, output in outputs.items()},
+                    }
+                    files[key] = {
+                        name: open(os.path.join(tmp_dir, f"{name}_{key}.bin"), "wb")
+                        for name in ARRAYS
+                    }
+
+                for name, output in outputs.items():
+                    files[key][name].write(output.cpu().numpy().astype(np.float16).tobytes())
+                buckets[key]["count"] += len(batch["captions"])
+        finally:
+            for bucket_files in files.values():
+                for f in bucket_files.values():
+                    f.close()
+
+        if not buckets:
+            raise ValueError("No sample in the dataset could be loaded")
+
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({
+                "version": CACHE_VERSION,
+                "fingerprint": fingerprint,
+                "buckets": list(buckets.values()),
+            }, f)
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.replace(tmp_dir, cache_dir)
+        return cls(cache_dir)
+
+
+class LatentDataset(Dataset):
+    """Training samples read from a ``LatentCache``"""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, idx):
+        bucket, row = self.cache.locate(idx)
+        # Copy out of the memory map so the tensors own their storage
+        return {
+            name: torch.from_numpy(np.array(array[row], dtype=np.float32))
+            for name, array in self.cache.arrays[bucket].items()
+        }
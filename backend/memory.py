@@ -0,0 +1,138 @@
+import math
+
+# Stable Diffusion v1 shapes the estimates are based on
+LATENT_SCALE = 8
+UNET_HEADS = 8
+UNET_CHANNELS = 320
+UNET_HEAD_DIM = UNET_CHANNELS // UNET_HEADS
+VAE_DECODER_CHANNELS = 128
+
+# Pixels neighbouring VAE tiles share, cross-faded to hide the seams
+VAE_TILE_OVERLAP = 64
+
+# Activations the U-Net keeps alive at its highest resolution (skip connections, norms, residuals)
+UNET_ACTIVATION_COPIES = 24
+VAE_ACTIVATION_COPIES = 4
+
+# Attention slicing levels, least to most aggressive; the value is how many
+# (batch * head) rows of attention scores are computed at once, None for all
+ATTENTION_SLICES = {None: None, "auto": UNET_HEADS // 2, "max": 1}
+
+
+class MemoryBudgetError(Exception):
+    """Raised when a generation would not fit in the memory budget even in its most frugal mode"""
+
+    def __init__(self, estimated_bytes, budget_bytes):
+        super().__init__(
+            f"Request needs about {math.ceil(estimated_bytes / 2**20)} MB, "
+            f"more than the {budget_bytes // 2**20} MB budget; use a smaller size or fewer images"
+        )
+        self.estimated_bytes = estimated_bytes
+        self.budget_bytes = budget_bytes
+
+
+def attention_bytes(tokens, rows, slice_size, dtype_bytes, fused=False, head_dim=UNET_HEAD_DIM):
+    """Attention scores and their softmax for ``rows`` (batch * head) rows, ``slice_size`` at a time
+
+    Fused attention (torch 2's ``scaled_dot_product_attention``, which
+    diffusers' ``AttnProcessor2_0`` runs unless attention is sliced) goes
+    through the scores block by block. It only keeps each row's output and
+    softmax statistics, so its memory grows linearly with the token count.
+    """
+    if fused and slice_size is None:
+        return rows * tokens * (head_dim + 2) * dtype_bytes
+    if slice_size is not None:
+        rows = min(rows, slice_size)
+    return 2 * rows * tokens * tokens * dtype_bytes
+
+
+def unet_bytes(height, width, batch_size, attention_slice=None, guidance=True, dtype_bytes=4, fused_attention=False):
+    """Peak activation memory of one U-Net step at the highest resolution"""
+    tokens = (height // LATENT_SCALE) * (width // LATENT_SCALE)
+    rows = batch_size * (2 if guidance else 1)
+    activations = rows * tokens * UNET_CHANNELS * dtype_bytes * UNET_ACTIVATION_COPIES
+    scores = attention_bytes(
+        tokens, rows * UNET_HEADS, ATTENTION_SLICES[attention_slice], dtype_bytes, fused=fused_attention
+    )
+    return activations + scores
+
+
+def vae_bytes(height, width, batch_size, tile_size=None, dtype_bytes=4, fused_attention=False):
+    """Peak activation memory of a VAE decode (or encode, which mirrors it)
+
+    Tiled runs process one image tile at a time, so only the blended output
+    buffers grow with the image size.
+    """
+    if tile_size:
+        # Output, blend weights and the concatenated batch, all float32
+        buffers = 3 * batch_size * 3 * height * width * 4
+        height, width, batch_size = min(height, tile_size), min(width, tile_size), 1
+    else:
+        buffers = 0
+    # The mid block attends over every latent position with a single head
+    tokens = (height // LATENT_SCALE) * (width // LATENT_SCALE)
+    activations = batch_size * VAE_DECODER_CHANNELS * height * width * dtype_bytes * VAE_ACTIVATION_COPIES
+    scores = attention_bytes(
+        tokens, batch_size, None, dtype_bytes, fused=fused_attention, head_dim=VAE_DECODER_CHANNELS * 4
+    )
+    return buffers + activations + scores
+
+
+class MemoryPlanner:
+    """Pick the fastest way to run a generation within a memory budget.
+
+    Modes are tried from cheapest to slowest: decoding the VAE in tiles,
+    then slicing the U-Net's attention more and more finely. A request
+    that fits in none of them raises ``MemoryBudgetError``. ``budget_bytes``
+    covers activations only, on top of the loaded weights; None disables
+    the limit. ``attention_slice`` is the slicing the U-Net always runs
+    with, such as the ``low_memory`` CPU profile's. ``fused_attention``
+    says unsliced attention runs fused, as it does on torch 2.
+    """
+
+    def __init__(self, budget_bytes=None, tile_size=512, attention_slice=None, fused_attention=False):
+        if tile_size is not None and (tile_size <= VAE_TILE_OVERLAP or tile_size % LATENT_SCALE):
+            raise ValueError(
+                f"VAE tile size must be a multiple of {LATENT_SCALE} larger than the {VAE_TILE_OVERLAP}-pixel tile overlap"
+            )
+        self.budget_bytes = budget_bytes
+        self.tile_size = tile_size
+        self.attention_slice = attention_slice
+        self.fused_attention = fused_attention
+
+    def estimate(self, height, width, batch_size=1, attention_slice=None, tiled_vae=False, guidance=True):
+        """Estimated peak bytes of a generation; the U-Net and VAE never run at the same time"""
+        return max(
+            unet_bytes(height, width, batch_size, attention_slice, guidance, fused_attention=self.fused_attention),
+            vae_bytes(
+                height,
+                width,
+                batch_size,
+                self.tile_size if tiled_vae else None,
+                fused_attention=self.fused_attention,
+            ),
+        )
+
+    def plan(self, height, width, batch_size=1, guidance=True):
+        """Return ``{"attention_slice", "tiled_vae", "estimated_bytes"}`` for the fastest mode that fits"""
+        slices = list(ATTENTION_SLICES)
+        slices = slices[slices.index(self.attention_slice):]
+
+        if self.budget_bytes is None:
+            return {
+                "attention_slice": self.attention_slice,
+                "tiled_vae": False,
+                "estimated_bytes": self.estimate(height, width, batch_size, self.attention_slice, False, guidance),
+            }
+
+        for attention_slice in slices:
+            for tiled_vae in (False, True):
+                estimated = self.estimate(height, width, batch_size, attention_slice, tiled_vae, guidance)
+                if estimated <= self.budget_bytes:
+                    return {
+                        "attention_slice": attention_slice,
+                        "tiled_vae": tiled_vae,
+                        "estimated_bytes": estimated,
+                    }
+
+        raise MemoryBudgetError(estimated, self.budget_bytes)
@@ -0,0 +1,199 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a fast DB write to a long generation
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120,
+)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def add_labels(labels, extra):
+    """Merge two rendered label sets, such as a sample's and the registry's constant ones"""
+    if not extra:
+        return labels
+    if not labels:
+        return extra
+    return labels[:-1] + "," + extra[1:]
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic count per label combination"""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in values.items():
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    """Distribution of observed values per label combination, in cumulative buckets.
+
+    Observing is a bisect and a few additions under a lock, cheap enough to
+    run on every denoising step.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Bucket counts, then the sum and count of all observations
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observe the duration of the block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def samples(self):
+        with self._lock:
+            series = {label_values: list(values) for label_values, values in self._series.items()}
+        for label_values, values in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values):
+                cumulative += count
+                labels = format_labels(self.labels + ("le",), label_values + (format_value(bound),))
+                yield f"{self.name}_bucket", labels, cumulative
+            labels = format_labels(self.labels, label_values)
+            yield f"{self.name}_sum", labels, values[-2]
+            yield f"{self.name}_count", labels, values[-1]
+
+
+class Gauge:
+    """Value read when metrics are scraped
+
+    ``read()`` returns either a number or ``{label values: number}``; it
+    runs only on scrape, so gauges cost nothing on the hot path. Totals
+    kept elsewhere, such as cache hit counts, are exposed with
+    ``kind="counter"``.
+    """
+
+    def __init__(self, name, help, read, labels=(), kind="gauge"):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.read = read
+        self.kind = kind
+
+    def samples(self):
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            if value is None:
+                continue
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class MetricsRegistry:
+    """Metrics rendered together in the Prometheus text exposition format
+
+    ``const_labels`` are added to every sample, such as the server worker
+    process they come from, so series from processes serving the same
+    scrape target stay apart.
+    """
+
+    def __init__(self, const_labels=None):
+        self._metrics = []
+        self.const_labels = dict(const_labels or {})
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, read, labels=(), kind="gauge"):
+        return self.register(Gauge(name, help, read, labels, kind))
+
+    def render(self):
+        lines = []
+        extra = format_labels(tuple(self.const_labels), tuple(self.const_labels.values()))
+        for metric in self._metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                # One failing gauge must not take down the whole scrape
+                lines.append(f"# {metric.name} unavailable: {escape(e)}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{add_labels(labels, extra)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# Time spent in each stage of serving a request:
+#   text_encode   CLIP text encoding of a batch's prompts
+#   unet_step     one denoising step of a batch
+#   vae_decode    decoding a batch's latents to images
+#   vae_encode    encoding an img2img init image
+#   image_encode  compressing one output image for the response
+#   blob_write    writing an image and its thumbnail to the blob store
+#   db_write      inserting image rows
+STAGE_SECONDS = REGISTRY.histogram(
+    "sd_stage_duration_seconds",
+    "Time spent in each stage of serving a generation",
+    labels=("stage",),
+)
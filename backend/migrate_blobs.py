@@ -0,0 +1,70 @@
+import argparse
+import os
+import sqlite3
+
+from blob_store import BlobStore, add_blob_columns, decode_data_url
+
+
+def migrate(db_path, blob_dir, batch_size=100, vacuum=False):
+    """Move base64 images out of the images table into the blob store
+
+    Rows are read in id order one batch at a time, so the table is never
+    loaded into memory. Each batch is committed on its own, which makes the
+    migration safe to interrupt and re-run.
+    """
+    store = BlobStore(blob_dir)
+    conn = sqlite3.connect(db_path)
+    add_blob_columns(conn)
+
+    migrated = 0
+    last_id = 0
+
+    while True:
+        rows = conn.execute(
+            "SELECT id, image_data FROM images "
+            "WHERE id > ? AND blob_ref IS NULL AND image_data != '' "
+            "ORDER BY id LIMIT ?",
+            (last_id, batch_size),
+        ).fetchall()
+
+        if not rows:
+            break
+
+        updates = []
+        for image_id, image_data in rows:
+            try:
+                data, image_format = decode_data_url(image_data)
+                digest, size = store.put(data, image_format)
+                updates.append((digest, size, image_format, image_id))
+            except Exception as e:
+                # Leave undecodable rows in place
+                print(f"Skipping image {image_id}: {e}")
+
+        conn.executemany(
+            "UPDATE images SET blob_ref = ?, blob_size = ?, blob_format = ?, image_data = '' WHERE id = ?",
+            updates,
+        )
+        conn.commit()
+
+        migrated += len(updates)
+        last_id = rows[-1][0]
+        print(f"Migrated {migrated} images (up to id {last_id})")
+
+    if vacuum:
+        # Give the space held by the old base64 text back to the filesystem
+        conn.execute("VACUUM")
+
+    conn.close()
+    return migrated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move stored images into the blob store")
+    parser.add_argument("--db-path", default=os.environ.get("DB_PATH", "./images.db"))
+    parser.add_argument("--blob-dir", default=os.environ.get("BLOB_DIR", "./blobs"))
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--vacuum", action="store_true", help="Reclaim database space afterwards")
+    args = parser.parse_args()
+
+    total = migrate(args.db_path, args.blob_dir, args.batch_size, args.vacuum)
+    print(f"Migration complete: {total} images moved")
@@ -1,87 +1,359 @@
+import os
 import torch
 import torch.nn as nn
 from diffusers import (
     UNet2DConditionModel, 
     AutoencoderKL, 
     DDPMScheduler,
+    PNDMScheduler,
     StableDiffusionPipeline
 )
-from transformers import CLIPTextModel, CLIPTokenizer
+from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer, CLIPImageProcessor
+from accelerate import init_empty_weights
+from cache import LRUCache, tensor_nbytes
+from memory import VAE_TILE_OVERLAP
+from utils import clean_prompt
+
+# Ratio between image and latent resolution of the VAE
+LATENT_SCALE = 8
+
+# Components whose weights StableDiffusionModel.save_weights snapshots
+WEIGHT_COMPONENTS = ("text_encoder", "vae", "unet")
+
+
+def weights_path(weights_dir, component):
+    return os.path.join(weights_dir, f"{component}.pt")
+
+
+def has_weights(weights_dir):
+    return bool(weights_dir) and all(
+        os.path.exists(weights_path(weights_dir, component)) for component in WEIGHT_COMPONENTS
+    )
+
+
+def map_weights(module, path):
+    """Point a module's parameters at a memory-mapped state dict file, without copying them
+
+    The file's pages live in the page cache, so every process mapping the
+    same file shares one copy of the weights. Tensors keep the dtype and
+    memory format they were saved with.
+    """
+    state_dict = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    module.load_state_dict(state_dict, assign=True)
+    module.eval()
+    return module
+
+
+def tile_starts(size, tile_size, stride):
+    """Offsets of tiles of ``tile_size`` covering ``size``, the last one flush with the end"""
+    starts = list(range(0, max(size - tile_size, 0) + 1, stride))
+    if starts[-1] + tile_size < size:
+        starts.append(size - tile_size)
+    return starts
+
+
+def blend_weights(length, start, size, overlap):
+    """Per-position weights of a tile along one axis, ramping in over edges shared with other tiles"""
+    weights = torch.ones(length)
+    if overlap <= 0:
+        return weights
+    ramp = torch.linspace(0, 1, overlap + 2)[1:-1]
+    if start > 0:
+        weights[:overlap] = ramp
+    if start + length < size:
+        weights[-overlap:] = torch.minimum(weights[-overlap:], ramp.flip(0))
+    return weights
+
+
+def blend_tiles(fn, x, tile_size, overlap, scale):
+    """Apply ``fn`` to overlapping spatial tiles of ``x`` and blend the results into one tensor
+
+    ``fn`` maps a ``[B, C, h, w]`` tile to a ``[B, C', h * scale, w * scale]``
+    one. Overlapping outputs are cross-faded with linear ramps, so tile
+    seams don't show.
+    """
+    if tile_size <= overlap:
+        raise ValueError(f"Tile size {tile_size} must be larger than the overlap {overlap}")
+    height, width = x.shape[-2:]
+    stride = tile_size - overlap
+    out_overlap = int(overlap * scale)
+    output = weight_sum = None
+    
+    for top in tile_starts(height, tile_size, stride):
+        for left in tile_starts(width, tile_size, stride):
+            tile = fn(x[..., top:top + tile_size, left:left + tile_size])
+            if output is None:
+                # Accumulate in float32 so low-precision tiles blend without banding
+                output = torch.zeros(
+                    *tile.shape[:2], int(height * scale), int(width * scale), device=tile.device
+                )
+                weight_sum = torch.zeros(output.shape[-2:], device=tile.device)
+            
+            out_top, out_left = int(top * scale), int(left * scale)
+            tile_height, tile_width = tile.shape[-2:]
+            weight = torch.outer(
+                blend_weights(tile_height, out_top, output.shape[-2], out_overlap),
+                blend_weights(tile_width, out_left, output.shape[-1], out_overlap),
+            ).to(tile.device)
+            
+            output[..., out_top:out_top + tile_height, out_left:out_left + tile_width] += tile.float() * weight
+            weight_sum[out_top:out_top + tile_height, out_left:out_left + tile_width] += weight
+    
+    return (output / weight_sum).to(tile.dtype)
 
 
 class StableDiffusionModel:
-    def __init__(self, model_id="CompVis/stable-diffusion-v1-4", device="cuda" if torch.cuda.is_available() else "cpu"):
+    def __init__(
+        self,
+        model_id="CompVis/stable-diffusion-v1-4",
+        device="cuda" if torch.cuda.is_available() else "cpu",
+        embedding_cache_bytes=64 * 1024 * 1024,
+        cache_dir=None,
+        unet_path=None,
+        weights_dir=None,
+    ):
         self.device = device
         self.model_id = model_id
+        self.cache_dir = cache_dir
+        
+        # Load weights from the local cache, memory-mapping safetensors files
+        # instead of materializing a second copy of every tensor
+        self.load_options = {"cache_dir": cache_dir, "low_cpu_mem_usage": True}
+        
+        # Identifies the weights currently loaded, used to key cached outputs
+        self.model_version = unet_path or model_id
+        self._snapshot_unet_path = unet_path
+        
+        # A snapshot written by save_weights, mapped instead of loading the weights again
+        self.weights_dir = weights_dir if has_weights(weights_dir) else None
+        
+        # LRU cache of text embeddings keyed by model version and cleaned prompt
+        self.text_cache = LRUCache(embedding_cache_bytes, sizeof=tensor_nbytes)
         
         # CLIP tokenizer and text encoder (frozen)
-        self.tokenizer = CLIPTokenizer.from_pretrained(model_id, subfolder="tokenizer")
-        self.text_encoder = CLIPTextModel.from_pretrained(model_id, subfolder="text_encoder")
+        self.tokenizer = CLIPTokenizer.from_pretrained(model_id, subfolder="tokenizer", cache_dir=cache_dir)
+        if self.weights_dir:
+            config = CLIPTextConfig.from_pretrained(model_id, subfolder="text_encoder", cache_dir=cache_dir)
+            with init_empty_weights():
+                self.text_encoder = CLIPTextModel(config)
+            map_weights(self.text_encoder, weights_path(self.weights_dir, "text_encoder"))
+        else:
+            self.text_encoder = CLIPTextModel.from_pretrained(model_id, subfolder="text_encoder", **self.load_options)
         self.text_encoder.to(device)
         self.text_encoder.requires_grad_(False)  # Freeze text encoder
         
         # VAE encoder and decoder (frozen)
-        self.vae = AutoencoderKL.from_pretrained(model_id, subfolder="vae")
+        if self.weights_dir:
+            config = AutoencoderKL.load_config(model_id, subfolder="vae", cache_dir=cache_dir)
+            with init_empty_weights():
+                self.vae = AutoencoderKL.from_config(config)
+            map_weights(self.vae, weights_path(self.weights_dir, "vae"))
+        else:
+            self.vae = AutoencoderKL.from_pretrained(model_id, subfolder="vae", **self.load_options)
         self.vae.to(device)
         self.vae.requires_grad_(False)  # Freeze VAE
         
-        # U-Net as the core diffusion model (to be fine-tuned)
-        self.unet = UNet2DConditionModel.from_pretrained(model_id, subfolder="unet")
-        self.unet.to(device)
+        # U-Net as the core diffusion model (to be fine-tuned); a fine-tuned one replaces the base weights
+        self.unet = self.read_unet(unet_path)
         
         # Noise scheduler
-        self.noise_scheduler = DDPMScheduler.from_pretrained(model_id, subfolder="scheduler")
+        self.noise_scheduler = DDPMScheduler.from_pretrained(model_id, subfolder="scheduler", cache_dir=cache_dir)
         
     def encode_text(self, prompt_batch):
-        """Encode text prompts to embeddings using CLIP tokenizer and text encoder"""
-        text_inputs = self.tokenizer(
-            prompt_batch,
-            padding="max_length",
+        """Encode text prompts to embeddings using CLIP tokenizer and text encoder
+
+        Embeddings are cached per prompt, so only prompts missing from the
+        cache are run through the text encoder.
+        """
+        prompts = [clean_prompt(prompt) for prompt in prompt_batch]
+        keys = [(self.model_version, prompt) for prompt in prompts]
+        
+        embeddings = [self.text_cache.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        
+        if missing:
+            # Encode each distinct missing prompt once
+            missing_prompts = list(dict.fromkeys(prompts[i] for i in missing))
+            text_inputs = self.tokenizer(
+                missing_prompts,
+                padding="max_length",
+                max_length=self.tokenizer.model_max_length,
+                truncation=True,
+                return_tensors="pt",
+            )
+            text_input_ids = text_inputs.input_ids.to(self.device)
+            
+            with torch.no_grad():
+                text_embeddings = self.text_encoder(text_input_ids)[0]
+            
+            encoded = {}
+            for prompt, embedding in zip(missing_prompts, text_embeddings):
+                # Clone so each entry owns its storage rather than a view of the batch
+                encoded[prompt] = embedding.clone()
+                self.text_cache.put((self.model_version, prompt), encoded[prompt])
+            
+            for i in missing:
+                embeddings[i] = encoded[prompts[i]]
+        
+        return torch.stack(embeddings)
+    
+    def encode_pooled_text(self, prompt_batch):
+        """Encode prompts to one vector each, taken at the end-of-text token as CLIP pools them"""
+        embeddings = self.encode_text(prompt_batch)
+        
+        # The tokenizer adds BOS and EOS, so the EOS token sits at the last position of each prompt
+        input_ids = self.tokenizer(
+            [clean_prompt(prompt) for prompt in prompt_batch],
             max_length=self.tokenizer.model_max_length,
             truncation=True,
-            return_tensors="pt",
-        )
-        text_input_ids = text_inputs.input_ids.to(self.device)
+        ).input_ids
+        eos_positions = torch.tensor([len(ids) - 1 for ids in input_ids], device=embeddings.device)
+        
+        return embeddings[torch.arange(len(input_ids), device=embeddings.device), eos_positions]
+    
+    def encode_latent_dist(self, image_batch, tile_size=None, tile_overlap=VAE_TILE_OVERLAP):
+        """Encode images to the VAE's latent distribution
+
+        With ``tile_size`` (in pixels) each image is encoded in overlapping
+        tiles whose distribution parameters are blended across the seams,
+        so memory stays bounded for large images.
+        """
+        image_batch = image_batch.to(self.device)
         
         with torch.no_grad():
-            text_embeddings = self.text_encoder(text_input_ids)[0]
+            if not tile_size:
+                return self.vae.encode(image_batch).latent_dist
+            
+            dist_class = None
+            
+            def encode_tile(tile):
+                nonlocal dist_class
+                latent_dist = self.vae.encode(tile).latent_dist
+                dist_class = type(latent_dist)
+                return latent_dist.parameters
+            
+            parameters = torch.cat([
+                blend_tiles(encode_tile, image, tile_size, tile_overlap, 1 / LATENT_SCALE)
+                for image in image_batch.split(1)
+            ])
         
-        return text_embeddings
+        return dist_class(parameters)
     
-    def encode_image(self, image_batch):
+    def encode_image(self, image_batch, tile_size=None):
         """Encode images to latent representations using VAE encoder"""
-        with torch.no_grad():
-            latents = self.vae.encode(image_batch.to(self.device)).latent_dist.sample()
-            latents = latents * self.vae.config.scaling_factor
+        latents = self.encode_latent_dist(image_batch, tile_size).sample()
+        latents = latents * self.vae.config.scaling_factor
         
         return latents
     
-    def decode_latents(self, latents):
-        """Decode latent representations to images using VAE decoder"""
+    def decode_latents(self, latents, tile_size=None, tile_overlap=VAE_TILE_OVERLAP):
+        """Decode latent representations to images using VAE decoder
+
+        With ``tile_size`` (in output pixels) each image is decoded in
+        overlapping tiles that are cross-faded into one another.
+        """
         latents = 1 / self.vae.config.scaling_factor * latents
         
         with torch.no_grad():
-            images = self.vae.decode(latents).sample
-        
-        return images
+            if not tile_size:
+                return self.vae.decode(latents).sample
+            
+            return torch.cat([
+                blend_tiles(
+                    lambda tile: self.vae.decode(tile).sample,
+                    latent,
+                    tile_size // LATENT_SCALE,
+                    tile_overlap // LATENT_SCALE,
+                    LATENT_SCALE,
+                )
+                for latent in latents.split(1)
+            ])
     
     def save_model(self, output_dir):
         """Save the fine-tuned U-Net model"""
         self.unet.save_pretrained(output_dir)
     
+    def save_weights(self, weights_dir):
+        """Snapshot the weights of the text encoder, VAE and U-Net as loaded, for ``weights_dir`` to map"""
+        os.makedirs(weights_dir, exist_ok=True)
+        for component in WEIGHT_COMPONENTS:
+            torch.save(getattr(self, component).state_dict(), weights_path(weights_dir, component))
+    
+    def read_unet(self, model_path=None):
+        """Load a U-Net onto the device without replacing the current one; None loads the base U-Net
+
+        The snapshot in ``weights_dir`` holds the U-Net the model was created
+        with, so that one is mapped from it rather than loaded.
+        """
+        if self.weights_dir and model_path == self._snapshot_unet_path:
+            config = UNet2DConditionModel.load_config(
+                model_path or self.model_id,
+                subfolder=None if model_path else "unet",
+                cache_dir=self.cache_dir,
+            )
+            with init_empty_weights():
+                unet = UNet2DConditionModel.from_config(config)
+            map_weights(unet, weights_path(self.weights_dir, "unet"))
+        elif model_path:
+            unet = UNet2DConditionModel.from_pretrained(model_path, low_cpu_mem_usage=True)
+        else:
+            unet = UNet2DConditionModel.from_pretrained(self.model_id, subfolder="unet", **self.load_options)
+        unet.to(self.device)
+        return unet
+    
     def load_unet(self, model_path):
         """Load a fine-tuned U-Net model"""
-        self.unet = UNet2DConditionModel.from_pretrained(model_path)
-        self.unet.to(self.device)
+        self.unet = self.read_unet(model_path)
+        
+        # Embeddings cached for the previous model must not be reused
+        self.model_version = model_path
+        self.text_cache.clear()
+    
+    def has_safety_checker(self):
+        """Whether the model ships a safety checker, going by its folders or, on the Hub, its ``model_index.json``"""
+        if os.path.isdir(self.model_id):
+            return os.path.isdir(os.path.join(self.model_id, "safety_checker"))
+        config = StableDiffusionPipeline.load_config(self.model_id, cache_dir=self.cache_dir)
+        return (config.get("safety_checker") or [None])[0] is not None
+    
+    def load_safety_checker(self):
+        """Load the safety checker and its feature extractor, or ``(None, None)`` if the model has none
+        
+        Failing to load one the model has, such as on a Hub outage, is an
+        error rather than a reason to serve without NSFW filtering.
+        """
+        if not self.has_safety_checker():
+            return None, None
+        
+        safety_checker = StableDiffusionSafetyChecker.from_pretrained(
+            self.model_id, subfolder="safety_checker", **self.load_options
+        )
+        feature_extractor = CLIPImageProcessor.from_pretrained(
+            self.model_id, subfolder="feature_extractor", cache_dir=self.cache_dir
+        )
+        
+        safety_checker.to(self.device)
+        return safety_checker, feature_extractor
     
     def create_pipeline(self):
-        """Create a StableDiffusionPipeline with our models for inference"""
-        pipeline = StableDiffusionPipeline.from_pretrained(
-            self.model_id,
-            unet=self.unet,
-            text_encoder=self.text_encoder,
+        """Create a StableDiffusionPipeline with our models for inference
+        
+        The pipeline is assembled from the components already loaded here,
+        so no weights are read from disk a second time.
+        """
+        safety_checker, feature_extractor = self.load_safety_checker()
+        
+        pipeline = StableDiffusionPipeline(
             vae=self.vae,
+            text_encoder=self.text_encoder,
             tokenizer=self.tokenizer,
+            unet=self.unet,
+            # The default inference scheduler of Stable Diffusion v1, built from the same config
+            scheduler=PNDMScheduler.from_config(self.noise_scheduler.config),
+            safety_checker=safety_checker,
+            feature_extractor=feature_extractor,
+            requires_safety_checker=safety_checker is not None,
         )
         pipeline.to(self.device)
-        return pipeline
\ No newline at end of file
+        return pipeline
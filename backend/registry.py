@@ -0,0 +1,329 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from cache import module_nbytes
+
+BASE_MODEL = "base"
+
+# Weights file of a LoRA adapter checkpoint, as written by diffusers' save_lora_weights
+ADAPTER_WEIGHTS = "pytorch_lora_weights.safetensors"
+
+# How long a scan of the model directory is reused; asking for a name it didn't find rescans
+SCAN_TTL_SECONDS = 5
+
+# File in the model directory recording the default model chosen through the API
+DEFAULT_MODEL_FILE = "default_model.json"
+
+
+class ResidentUNet:
+    def __init__(self, name, version, unet, base=None):
+        self.name = name
+        self.version = version
+        self.unet = unet
+        self.leases = 0
+        
+        # Adapters run on the base U-Net's entry, which they hold a lease on while resident
+        self.base = base
+
+    @property
+    def adapter(self):
+        return self.name if self.base is not None else None
+
+
+class ModelRegistry:
+    """Fine-tuned U-Net checkpoints under a model directory, served by name.
+
+    Only ``max_resident`` U-Nets are kept in memory; the least recently used
+    one is evicted when another is loaded. Requests hold a lease on the U-Net
+    they run with, so eviction and changing the default model never pull
+    weights out from under an in-flight request.
+
+    LoRA adapter checkpoints are loaded onto the base U-Net instead of
+    replacing it; up to ``max_adapters`` of them stay loaded, and they keep
+    the base U-Net resident while they are.
+
+    A default chosen with ``set_default`` is saved in the model directory,
+    so every process serving from it follows the change; until one is
+    chosen, ``default`` is the model the process started with.
+    """
+
+    def __init__(
+        self,
+        model_dir,
+        load_unet,
+        base_version,
+        max_resident=2,
+        load_adapter=None,
+        unload_adapter=None,
+        max_adapters=8,
+    ):
+        self.model_dir = model_dir
+        self.max_resident = max(1, max_resident)
+        self.max_adapters = max(1, max_adapters)
+        self.default = BASE_MODEL
+        self._default_path = os.path.join(model_dir, DEFAULT_MODEL_FILE) if model_dir else None
+        self._saved_default = None
+        self._saved_default_mtime = None
+
+        # load_unet(path) returns a U-Net on the serving device; a path of None means the base model
+        self._load_unet = load_unet
+        
+        # load_adapter(unet, path, name) adds an adapter to a U-Net, unload_adapter(unet, name) removes it
+        self._load_adapter = load_adapter
+        self._unload_adapter = unload_adapter
+        self._base_version = base_version
+        self._paths = {}
+        self._scan = None
+        self._scan_time = 0
+
+        self._resident = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    @property
+    def default(self):
+        """The default model: the one last saved by ``set_default`` in any process, or the startup one"""
+        saved = self._read_saved_default()
+        return saved if saved is not None else self._default
+
+    @default.setter
+    def default(self, name):
+        self._default = name
+
+    def _read_saved_default(self):
+        if self._default_path is None:
+            return None
+        try:
+            mtime = os.stat(self._default_path).st_mtime_ns
+        except OSError:
+            return None
+        if mtime != self._saved_default_mtime:
+            try:
+                with open(self._default_path) as f:
+                    name = json.load(f)["name"]
+            except (OSError, ValueError, KeyError):
+                name = None
+            # A saved default whose checkpoint was deleted falls back to the startup one
+            self._saved_default = name if name is not None and self.exists(name) else None
+            self._saved_default_mtime = mtime
+        return self._saved_default
+
+    def save_default(self, name):
+        """Make ``name`` the default of every process serving from the model directory"""
+        self._default = name
+        if self._default_path is None:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.model_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"name": name}, f)
+            os.replace(tmp_path, self._default_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def checkpoints(self, refresh=False):
+        """Return ``{name: {"path", "version", "adapter"}}`` for the base model and every checkpoint
+
+        The model directory is scanned at most every ``SCAN_TTL_SECONDS``,
+        or when ``refresh`` is set, so versions can lag behind a checkpoint
+        rewritten in place by that long.
+        """
+        scan = self._scan
+        if refresh or scan is None or time.monotonic() - self._scan_time > SCAN_TTL_SECONDS:
+            scan = self._scan = self._scan_checkpoints()
+            self._scan_time = time.monotonic()
+        return dict(scan)
+
+    def checkpoint(self, name):
+        """The checkpoint ``name``, rescanning for it if the last scan didn't find it; None if it doesn't exist"""
+        checkpoint = self.checkpoints().get(name)
+        if checkpoint is None:
+            checkpoint = self.checkpoints(refresh=True).get(name)
+        return checkpoint
+
+    def _scan_checkpoints(self):
+        checkpoints = {BASE_MODEL: {"path": None, "version": self._base_version, "adapter": False}}
+
+        for name, path in self._paths.items():
+            checkpoints[name] = self._checkpoint(name, path)
+
+        if os.path.isdir(self.model_dir):
+            for root, dirs, files in os.walk(self.model_dir):
+                dirs.sort()
+                depth = os.path.relpath(root, self.model_dir).count(os.sep)
+                if depth >= 1:
+                    # Checkpoints sit at most two levels deep, e.g. retrained_<timestamp>/unet_final
+                    dirs[:] = []
+                if root != self.model_dir and (self._is_unet(root, files) or ADAPTER_WEIGHTS in files):
+                    name = os.path.relpath(root, self.model_dir).replace(os.sep, "/")
+                    checkpoints[name] = self._checkpoint(name, root)
+
+        return checkpoints
+
+    def _checkpoint(self, name, path):
+        return {
+            "path": path,
+            "version": self._version(name, path),
+            "adapter": os.path.exists(os.path.join(path, ADAPTER_WEIGHTS)),
+        }
+
+    @staticmethod
+    def _is_unet(path, files):
+        if "config.json" not in files:
+            return False
+        try:
+            with open(os.path.join(path, "config.json")) as f:
+                return json.load(f).get("_class_name") == "UNet2DConditionModel"
+        except (OSError, ValueError):
+            return False
+
+    @staticmethod
+    def _version(name, path):
+        """Version a checkpoint by its newest file, so retraining into the same directory changes it"""
+        mtime = max(
+            (entry.stat().st_mtime for entry in os.scandir(path) if entry.is_file()),
+            default=0,
+        )
+        return f"{name}@{int(mtime)}"
+
+    def register(self, name, path):
+        """Make a checkpoint outside the model directory available under ``name``"""
+        with self._lock:
+            self._paths[name] = path
+        self._scan = None
+
+    def exists(self, name):
+        return self.checkpoint(name) is not None
+
+    def resolve(self, name=None):
+        """Return ``(name, version)`` of the requested model, or of the default if name is None"""
+        name = name or self.default
+
+        with self._lock:
+            entry = self._resident.get(name)
+            if entry is not None:
+                return name, entry.version
+
+        checkpoint = self.checkpoint(name)
+        if checkpoint is None:
+            raise KeyError(f"Unknown model: {name}")
+        return name, checkpoint["version"]
+
+    def add_resident(self, name, unet, path=None):
+        """Register a U-Net that is already in memory, such as the one loaded at startup"""
+        if path is not None and name != BASE_MODEL:
+            self.register(name, path)
+        version = self._base_version if name == BASE_MODEL else self._version(name, path)
+        with self._lock:
+            self._resident[name] = ResidentUNet(name, version, unet)
+            evicted = self._evict()
+        self._unload(evicted)
+
+    @contextmanager
+    def lease(self, name=None):
+        """Yield the resident U-Net for ``name``, loading it if needed, and keep it resident meanwhile"""
+        entry = self._acquire(name or self.default)
+        try:
+            yield entry
+        finally:
+            self._release(entry)
+
+    def _release(self, entry):
+        with self._lock:
+            entry.leases -= 1
+            evicted = self._evict()
+        self._unload(evicted)
+
+    def set_default(self, name):
+        """Load a model and make it the default for new requests
+
+        Requests already resolved to the previous default keep using it.
+        """
+        with self.lease(name):
+            self.save_default(name)
+
+    def resident(self):
+        with self._lock:
+            return {name: entry.leases for name, entry in self._resident.items()}
+
+    def resident_bytes(self):
+        """Weight bytes of every resident U-Net, by name; adapters count toward their base"""
+        with self._lock:
+            unets = {name: entry.unet for name, entry in self._resident.items() if entry.base is None}
+        return {name: module_nbytes(unet) for name, unet in unets.items()}
+
+    def _acquire(self, name):
+        with self._lock:
+            entry = self._take(name)
+            if entry is not None:
+                return entry
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # Load outside the registry lock so requests for resident models are not blocked
+        with load_lock:
+            with self._lock:
+                entry = self._take(name)
+                if entry is not None:
+                    return entry
+
+            checkpoint = self.checkpoint(name)
+            if checkpoint is None:
+                raise KeyError(f"Unknown model: {name}")
+
+            if checkpoint["adapter"]:
+                base = self._acquire(BASE_MODEL)
+                try:
+                    self._load_adapter(base.unet, checkpoint["path"], name)
+                except BaseException:
+                    self._release(base)
+                    raise
+                entry = ResidentUNet(name, checkpoint["version"], base.unet, base=base)
+            else:
+                entry = ResidentUNet(name, checkpoint["version"], self._load_unet(checkpoint["path"]))
+
+            with self._lock:
+                entry.leases = 1
+                self._resident[name] = entry
+                evicted = self._evict()
+            self._unload(evicted)
+            return entry
+
+    def _take(self, name):
+        entry = self._resident.get(name)
+        if entry is not None:
+            self._resident.move_to_end(name)
+            entry.leases += 1
+        return entry
+
+    def _evict(self):
+        """Drop least recently used entries that no request is using, returning them
+
+        U-Nets and adapters are limited separately; the default stays resident.
+        """
+        evicted = []
+        for is_adapter, limit in ((True, self.max_adapters), (False, self.max_resident)):
+            names = [name for name, entry in self._resident.items() if (entry.base is not None) == is_adapter]
+            excess = len(names) - limit
+            for name in names:
+                if excess <= 0:
+                    break
+                entry = self._resident[name]
+                if entry.leases == 0 and name != self.default:
+                    del self._resident[name]
+                    evicted.append(entry)
+                    excess -= 1
+        return evicted
+
+    def _unload(self, evicted):
+        """Remove evicted adapters from their U-Net, outside the registry lock"""
+        for entry in evicted:
+            if entry.base is not None:
+                self._unload_adapter(entry.unet, entry.name)
+                self._release(entry.base)
@@ -0,0 +1,293 @@
+import base64
+import io
+import threading
+
+import numpy as np
+from PIL import Image
+
+from batching import grid_chunks
+from broker import TaskFailed
+from cache import LRUCache
+from memory import MemoryBudgetError, MemoryPlanner
+from registry import ModelRegistry
+from schedulers import DEFAULT_SCHEDULER
+from utils import clean_prompt, encode_image
+
+
+# Prompt embeddings kept from worker results until the prompt is indexed
+PROMPT_VECTOR_CACHE_SIZE = 1024
+
+
+class RemoteInference:
+    """Runs generations on inference worker processes through a broker.
+
+    Offers the part of ``StableDiffusionInference`` the API uses, so the
+    API can serve without loading a model. Requests are resolved to a
+    model version here and routed to workers by it; images come back as
+    files in the scratch store both share, deleted once read, and init
+    images go out the same way. Abandoning a request, such as cancelling
+    its job, cancels its task.
+    """
+
+    def __init__(
+        self,
+        broker,
+        scratch,
+        model_id,
+        model_dir,
+        memory_budget_bytes=None,
+        vae_tile_size=512,
+        task_timeout=600,
+    ):
+        self.broker = broker
+        self.scratch = scratch
+        self.task_timeout = task_timeout
+        self.cpu_profile = None
+
+        # Requests are checked against the workers' memory budget before they are queued;
+        # workers run torch 2, whose attention is fused unless sliced
+        self.memory = MemoryPlanner(memory_budget_bytes, vae_tile_size, fused_attention=True)
+
+        # Resolves names to versions without loading anything; workers scan the same model directory
+        self.registry = ModelRegistry(model_dir or "", None, base_version=model_id)
+        self._lock = threading.Lock()
+
+        # Workers send each result's prompt embedding along, so indexing it needs no second task
+        self._prompt_vectors = LRUCache(PROMPT_VECTOR_CACHE_SIZE)
+
+    @property
+    def ready(self):
+        return bool(self.broker.workers())
+
+    def load(self):
+        """Nothing to load here: every worker loads its own model"""
+
+    def warmup(self):
+        pass
+
+    def status(self):
+        workers = self.broker.workers()
+        return {
+            "ready": bool(workers),
+            "loading": False,
+            "error": None if workers else "No inference workers are running",
+            "cpu_profile": self.cpu_profile,
+            "workers": workers,
+            "tasks": self.broker.counts(),
+        }
+
+    def plan_memory(self, height, width, batch_size=1, guidance_scale=7.5):
+        return self.memory.plan(height, width, batch_size, guidance=guidance_scale > 1.0)
+
+    def resolve_model(self, name=None):
+        return self.registry.resolve(name)
+
+    def set_default_model(self, name):
+        """Make a model the default for new requests; a worker loads it on its first request"""
+        name, version = self.registry.resolve(name)
+        with self._lock:
+            self.registry.save_default(name)
+        return name, version
+
+    def resident_models(self):
+        """Names of the models resident on any live worker"""
+        routes = {route for worker in self.broker.workers() for route in worker["routes"]}
+        return {name for name, checkpoint in self.registry.checkpoints().items() if checkpoint["version"] in routes}
+
+    def text_cache_stats(self):
+        # Embeddings are cached by the workers
+        return {}
+
+    def embed_prompts(self, prompts):
+        """Pooled text embeddings of prompts, as a float32 array with one row per prompt
+
+        Prompts of recent results come with their embedding; the others
+        are embedded by a worker.
+        """
+        vectors = {}
+        for prompt in prompts:
+            vector = self._prompt_vectors.get(clean_prompt(prompt))
+            if vector is not None:
+                vectors[prompt] = vector
+        missing = [prompt for prompt in dict.fromkeys(prompts) if prompt not in vectors]
+        if missing:
+            result = self._run("embed", {"prompts": missing})
+            vectors.update(zip(missing, result["vectors"]))
+        return np.asarray([vectors[prompt] for prompt in prompts], dtype=np.float32)
+
+    def generate_image(
+        self,
+        prompt,
+        negative_prompt="",
+        height=512,
+        width=512,
+        num_inference_steps=50,
+        guidance_scale=7.5,
+        seed=None,
+        progress_callback=None,
+        model=None,
+        scheduler=DEFAULT_SCHEDULER,
+        preview_every=0,
+        image_format="png",
+        quality=90,
+    ):
+        """Generate an image on a worker; takes and returns the same as ``StableDiffusionInference.generate_image``"""
+        result = self._run(
+            "generate",
+            {
+                "prompt": clean_prompt(prompt),
+                "negative_prompt": negative_prompt,
+                "height": height,
+                "width": width,
+                "num_inference_steps": num_inference_steps,
+                "guidance_scale": guidance_scale,
+                "seed": seed,
+                "scheduler": scheduler,
+                "preview_every": preview_every,
+                "image_format": image_format,
+                "quality": quality,
+            },
+            model,
+            progress_callback,
+        )
+        return self._fetch_image(result)
+
+    def generate_variations(
+        self,
+        image,
+        prompt="",
+        negative_prompt="",
+        strength=0.75,
+        num_inference_steps=50,
+        guidance_scale=7.5,
+        num_variations=4,
+        progress_callback=None,
+        model=None,
+        scheduler=DEFAULT_SCHEDULER,
+        preview_every=0,
+        image_format="png",
+        quality=90,
+    ):
+        """Generate variations on a worker; takes and returns the same as ``StableDiffusionInference.generate_variations``"""
+        image_ref = self.scratch.put(encode_image(image, "png"), "png")
+        try:
+            results = self._run(
+                "variations",
+                {
+                    "image_ref": image_ref,
+                    "image_format": "png",
+                    "prompt": prompt,
+                    "negative_prompt": negative_prompt,
+                    "strength": strength,
+                    "num_inference_steps": num_inference_steps,
+                    "guidance_scale": guidance_scale,
+                    "num_variations": num_variations,
+                    "scheduler": scheduler,
+                    "preview_every": preview_every,
+                    "output_format": image_format,
+                    "quality": quality,
+                },
+                model,
+                progress_callback,
+            )
+        finally:
+            # Retries of the task read it again, so it goes only once the task is over
+            self.scratch.delete(image_ref, "png")
+        return [self._fetch_image(result) for result in results]
+
+    def generate_grid(
+        self,
+        items,
+        height=512,
+        width=512,
+        model=None,
+        scheduler=DEFAULT_SCHEDULER,
+        image_format="png",
+        quality=90,
+        max_chunk_size=8,
+    ):
+        """Generate a grid on workers; takes and yields the same as ``StableDiffusionInference.generate_grid``
+
+        Every chunk is queued up front as its own task, so idle workers
+        share the grid; chunks are yielded in order as they finish.
+        """
+        name, version = self.resolve_model(model)
+
+        def chunk_size(guidance_scale, num_inference_steps):
+            for batch_size in range(max_chunk_size, 1, -1):
+                try:
+                    self.plan_memory(height, width, batch_size, guidance_scale)
+                    return batch_size
+                except MemoryBudgetError:
+                    continue
+            return 1
+
+        chunks = [indices for _, _, indices in grid_chunks(items, chunk_size)]
+        task_ids = [
+            self.broker.submit(
+                "grid",
+                {
+                    "items": [{**items[i], "prompt": clean_prompt(items[i]["prompt"])} for i in indices],
+                    "height": height,
+                    "width": width,
+                    "model": name,
+                    "scheduler": scheduler,
+                    "image_format": image_format,
+                    "quality": quality,
+                    "max_chunk_size": len(indices),
+                },
+                model=name,
+                route=version,
+            )
+            for indices in chunks
+        ]
+        waited = 0
+        try:
+            for indices, task_id in zip(chunks, task_ids):
+                try:
+                    results = self.broker.wait(task_id, self.task_timeout)
+                except TaskFailed as e:
+                    raise RuntimeError(str(e)) from e
+                waited += 1
+                yield list(zip(indices, (self._fetch_image(result) for result in results)))
+        finally:
+            # Abandoned or failed part-way, so workers skip the chunks nobody will read
+            for task_id in task_ids[waited:]:
+                self.broker.cancel(task_id)
+
+    def _fetch_image(self, result):
+        """Read a result's image from the scratch store the worker wrote it to, and delete it there"""
+        result = dict(result)
+        self._prompt_vectors.put(clean_prompt(result["prompt"]), result.pop("prompt_vector"))
+        scratch_ref = result.pop("scratch_ref")
+        result["image"] = self.scratch.get(scratch_ref, result["format"])
+        self.scratch.delete(scratch_ref, result["format"])
+        return result
+
+    def _run(self, kind, payload, model=None, progress_callback=None):
+        """Submit a task and wait for its result"""
+        name = version = None
+        if kind != "embed":
+            # Resolve the model now so a later default change doesn't affect this request
+            name, version = self.resolve_model(model)
+            payload = {**payload, "model": name}
+
+        def on_progress(progress):
+            preview = progress.get("preview")
+            if preview is not None:
+                preview = Image.open(io.BytesIO(base64.b64decode(preview)))
+            progress_callback(progress["step"], progress["total_steps"], preview=preview)
+
+        task_id = self.broker.submit(kind, payload, model=name, route=version)
+        try:
+            return self.broker.wait(
+                task_id,
+                self.task_timeout,
+                on_progress=on_progress if progress_callback is not None else None,
+            )
+        except TaskFailed as e:
+            raise RuntimeError(str(e)) from e
+        except BaseException:
+            # Abandoned, e.g. by a cancelled job or a timeout, so the worker can stop early
+            self.broker.cancel(task_id)
+            raise
@@ -0,0 +1,68 @@
+from diffusers import (
+    DDIMScheduler,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    LCMScheduler,
+    PNDMScheduler,
+    UniPCMultistepScheduler,
+)
+
+# Samplers selectable per request, with the options they are created with
+SCHEDULERS = {
+    "pndm": (PNDMScheduler, {}),
+    "ddim": (DDIMScheduler, {}),
+    "dpm++": (DPMSolverMultistepScheduler, {"algorithm_type": "dpmsolver++"}),
+    "euler_a": (EulerAncestralDiscreteScheduler, {}),
+    "unipc": (UniPCMultistepScheduler, {}),
+    # Few-step sampling; only gives good images with latent-consistency distilled U-Nets
+    "lcm": (LCMScheduler, {}),
+}
+
+DEFAULT_SCHEDULER = "pndm"
+
+# Steps used when a request names a scheduler but no step count
+DEFAULT_STEPS = {"lcm": 4}
+
+# Quality tiers trading fidelity for latency; U-Net steps dominate the cost of a request
+QUALITY_TIERS = {
+    "fast": {"scheduler": "dpm++", "num_inference_steps": 18},
+    "standard": {"scheduler": "dpm++", "num_inference_steps": 25},
+    "full": {"scheduler": "pndm", "num_inference_steps": 50},
+}
+
+
+def make_scheduler(name, config):
+    """Create a new scheduler instance from a base scheduler config
+
+    Schedulers keep per-run state (timesteps, step index, solver history),
+    so every pipeline call gets its own instance.
+    """
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler '{name}', expected one of {', '.join(SCHEDULERS)}")
+    scheduler_class, options = SCHEDULERS[name]
+    return scheduler_class.from_config(config, **options)
+
+
+def sampling_options(data, default_quality="standard"):
+    """Return ``(scheduler, num_inference_steps)`` for a request body
+
+    An explicit ``scheduler`` or ``num_inference_steps`` overrides the
+    request's ``quality`` tier, which falls back to ``default_quality``.
+    """
+    quality = data.get("quality") or default_quality
+    if quality not in QUALITY_TIERS:
+        raise ValueError(f"Unknown quality '{quality}', expected one of {', '.join(QUALITY_TIERS)}")
+    tier = QUALITY_TIERS[quality]
+
+    scheduler = data.get("scheduler") or tier["scheduler"]
+    if scheduler not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler '{scheduler}', expected one of {', '.join(SCHEDULERS)}")
+
+    if data.get("num_inference_steps"):
+        num_inference_steps = int(data["num_inference_steps"])
+    elif data.get("scheduler"):
+        num_inference_steps = DEFAULT_STEPS.get(scheduler, tier["num_inference_steps"])
+    else:
+        num_inference_steps = tier["num_inference_steps"]
+
+    return scheduler, num_inference_steps
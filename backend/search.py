@@ -0,0 +1,87 @@
+import threading
+import numpy as np
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query matching every word as a prefix
+
+    Each word is quoted, so punctuation and FTS operators in user input are
+    matched literally instead of being parsed as query syntax.
+    """
+    terms = [word.replace('"', '""') for word in text.split()]
+    return ' '.join(f'"{term}"*' for term in terms if term)
+
+
+class PromptIndex:
+    """In-memory cosine-similarity index over prompt embeddings.
+
+    Vectors are L2-normalized on insert and kept in one contiguous float32
+    matrix, so a query is a single matrix-vector product. The matrix grows
+    by doubling to keep appends amortized O(1).
+    """
+
+    def __init__(self, dim=None):
+        self.dim = dim
+        self._prompts = []
+        self._positions = {}
+        self._vectors = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._prompts)
+
+    def __contains__(self, prompt):
+        return prompt in self._positions
+
+    @staticmethod
+    def to_bytes(vector):
+        """Serialize a vector for storage, as float16 to halve its size"""
+        return np.asarray(vector, dtype=np.float16).tobytes()
+
+    @staticmethod
+    def from_bytes(data):
+        return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+
+    def add(self, prompts, vectors):
+        """Add prompts with their embeddings, skipping prompts already indexed"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+
+        with self._lock:
+            for prompt, vector in zip(prompts, vectors):
+                if prompt in self._positions:
+                    continue
+                self._append(prompt, vector)
+
+    def _append(self, prompt, vector):
+        if self._vectors is None:
+            self.dim = self.dim or vector.shape[0]
+            self._vectors = np.empty((1024, self.dim), dtype=np.float32)
+        elif len(self._prompts) == self._vectors.shape[0]:
+            grown = np.empty((self._vectors.shape[0] * 2, self.dim), dtype=np.float32)
+            grown[:len(self._prompts)] = self._vectors
+            self._vectors = grown
+
+        self._vectors[len(self._prompts)] = vector
+        self._positions[prompt] = len(self._prompts)
+        self._prompts.append(prompt)
+
+    def search(self, vector, k=20):
+        """Return up to ``k`` ``(prompt, score)`` pairs, most similar first"""
+        with self._lock:
+            count = len(self._prompts)
+            if count == 0:
+                return []
+            vectors = self._vectors[:count]
+            prompts = self._prompts[:count]
+
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / max(np.linalg.norm(query), 1e-12)
+        scores = vectors @ query
+
+        # Partial sort: only the top k need ordering
+        k = min(k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(prompts[i], float(scores[i])) for i in top]
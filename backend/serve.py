@@ -0,0 +1,228 @@
+"""Serve the API in production with several worker processes.
+
+``app.py`` runs Flask's single-process development server. This runs the
+same app under gunicorn instead:
+
+- Each worker process gets its own slice of the CPUs and sizes torch's
+  thread pools to it, so workers don't compete for cores.
+- Weights are snapshotted once into ``WEIGHTS_DIR`` and memory-mapped by
+  every worker, so adding a worker doesn't add another copy of them.
+- A worker only accepts connections once its model is loaded.
+- On SIGTERM, workers stop accepting, finish in-flight requests and
+  drain queued jobs for up to ``GRACEFUL_TIMEOUT`` seconds.
+
+Settings come from the same environment variables as ``app.py``, plus
+the ones below; flags override them. Example:
+
+    python serve.py --workers 4 --bind 0.0.0.0:5000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+from importlib.metadata import version
+
+from gunicorn.app.base import BaseApplication
+
+BIND = os.environ.get("BIND", "0.0.0.0:5000")
+WORKERS = int(os.environ.get("WORKERS", 2))
+# Torch intra-op threads per worker; 0 splits the available CPUs evenly
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 0))
+# Concurrent requests per worker; requests waiting on the same batch share one denoising run
+HTTP_THREADS = int(os.environ.get("HTTP_THREADS", 8))
+PIN_CPUS = os.environ.get("PIN_CPUS", "1") == "1"
+GRACEFUL_TIMEOUT = int(os.environ.get("GRACEFUL_TIMEOUT", 120))
+# Loading a model can take minutes on a cold disk, so workers get this long to boot
+WORKER_TIMEOUT = int(os.environ.get("WORKER_TIMEOUT", 600))
+
+MODEL_DIR = os.environ.get("MODEL_DIR", "./models")
+MODEL_ID = os.environ.get("MODEL_ID", "CompVis/stable-diffusion-v1-4")
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR") or None
+CPU_PROFILE = os.environ.get("CPU_PROFILE", "baseline")
+WEIGHTS_DIR = os.environ.get("WEIGHTS_DIR", os.path.join(MODEL_DIR, "shared_weights"))
+FINETUNED_MODEL_PATH = os.path.join(MODEL_DIR, "unet_final")
+
+
+def cpu_slices(cpus, workers):
+    """Split ``cpus`` into one contiguous slice per worker; with fewer CPUs than workers, they share"""
+    cpus = sorted(cpus)
+    if len(cpus) < workers:
+        return [[cpus[i % len(cpus)]] for i in range(workers)]
+    size, extra = divmod(len(cpus), workers)
+    slices = []
+    start = 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(cpus[start:end])
+        start = end
+    return slices
+
+
+def weights_fingerprint(model_id, model_path, cpu_profile):
+    """What a weights snapshot was made from; a snapshot that doesn't match it is rewritten"""
+    return {
+        "model_id": model_id,
+        "model_path": model_path,
+        "model_mtime": os.path.getmtime(model_path) if model_path else None,
+        "cpu_profile": cpu_profile,
+        "torch": version("torch"),
+    }
+
+
+def write_weights(weights_dir, model_id, model_path, cpu_profile, cache_dir):
+    """Load the model, cast it for the CPU profile and snapshot its weights"""
+    from cpu_profiles import cast_weights, get_profile
+    from model import StableDiffusionModel
+
+    model = StableDiffusionModel(model_id=model_id, device="cpu", cache_dir=cache_dir, unet_path=model_path)
+    cast_weights(model, get_profile(cpu_profile))
+    model.save_weights(weights_dir)
+
+
+def prepare_weights(weights_dir, model_id, model_path=None, cpu_profile="baseline", cache_dir=None):
+    """Write the weights snapshot workers map, unless an up-to-date one exists; returns whether it wrote one
+
+    The model is loaded in a child process, so this process never holds
+    the weights or starts torch's thread pools before forking workers.
+    """
+    fingerprint = weights_fingerprint(model_id, model_path, cpu_profile)
+    try:
+        with open(os.path.join(weights_dir, "meta.json")) as f:
+            if json.load(f) == fingerprint:
+                return False
+    except (OSError, ValueError):
+        pass
+
+    parent = os.path.dirname(os.path.abspath(weights_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".weights-")
+    try:
+        process = multiprocessing.get_context("spawn").Process(
+            target=write_weights,
+            args=(tmp_dir, model_id, model_path, cpu_profile, cache_dir),
+            name="prepare-weights",
+        )
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"Preparing shared weights failed with exit code {process.exitcode}")
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(fingerprint, f)
+
+        # Workers still running on the old snapshot keep their mappings of the replaced files
+        shutil.rmtree(weights_dir, ignore_errors=True)
+        os.replace(tmp_dir, weights_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return True
+
+
+class Server(BaseApplication):
+    """Gunicorn application that loads the model in each worker before it accepts connections"""
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        import app as server
+
+        # Readiness gate: a worker that can't load the model never serves a request
+        server.inference.load()
+        return server.app
+
+
+def cuda_available():
+    """Whether torch sees a GPU, checked in a child so this process never initializes CUDA before forking"""
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(_cuda_available)
+
+
+def _cuda_available():
+    import torch
+    return torch.cuda.is_available()
+
+
+def worker_hooks(cpu_sets, worker_threads, pin_cpus, drain_timeout):
+    """Gunicorn server hooks placing each worker on its CPU set and draining it on exit"""
+
+    def pre_fork(server, worker):
+        # A replacement worker takes over the slot, and so the CPUs, of the one that exited
+        taken = {getattr(other, "slot", None) for other in server.WORKERS.values()}
+        worker.slot = next(slot for slot in range(len(taken) + 1) if slot not in taken)
+
+    def post_fork(server, worker):
+        cpus = cpu_sets[worker.slot % len(cpu_sets)]
+        if pin_cpus and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+
+        # Size torch's thread pools before app.py imports it
+        threads = str(worker_threads or len(cpus))
+        for name in ("TORCH_NUM_THREADS", "OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+            os.environ[name] = threads
+        # Labels the worker's metrics; a replacement keeps the slot, so its counters read as a reset
+        os.environ["WORKER_SLOT"] = str(worker.slot)
+        server.log.info("Worker %s (slot %s) runs on CPUs %s with %s threads", worker.pid, worker.slot, cpus, threads)
+
+    def worker_exit(server, worker):
+        # Finish jobs accepted before the shutdown; clients can poll any worker for their results
+        server_app = sys.modules.get("app")
+        if server_app is not None and not server_app.drain(drain_timeout):
+            server.log.warning("Worker %s exited with jobs still queued or running", worker.pid)
+
+    return {"pre_fork": pre_fork, "post_fork": post_fork, "worker_exit": worker_exit}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bind", default=BIND)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--worker-threads", type=int, default=WORKER_THREADS, help="Torch threads per worker")
+    parser.add_argument("--http-threads", type=int, default=HTTP_THREADS, help="Concurrent requests per worker")
+    parser.add_argument("--no-pin", dest="pin_cpus", action="store_false", default=PIN_CPUS)
+    parser.add_argument("--graceful-timeout", type=int, default=GRACEFUL_TIMEOUT)
+    parser.add_argument("--weights-dir", default=WEIGHTS_DIR, help="Shared weights snapshot; empty disables sharing")
+    args = parser.parse_args()
+
+    workers = max(1, args.workers)
+    cpus = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else range(os.cpu_count() or 1)
+    cpu_sets = cpu_slices(cpus, workers)
+
+    # Workers load the model before accepting connections, not in the background
+    os.environ["MODEL_WARMUP"] = "0"
+    if workers > 1:
+        os.environ.setdefault("SHARED_JOBS", "1")
+
+    # Weights are only shared on the CPU, where the CPU profile is applied ahead of time;
+    # with a broker, inference workers load the model and this tier never does
+    if args.weights_dir and not os.environ.get("BROKER_URL") and not cuda_available():
+        model_path = FINETUNED_MODEL_PATH if os.path.exists(FINETUNED_MODEL_PATH) else None
+        if prepare_weights(args.weights_dir, MODEL_ID, model_path, CPU_PROFILE, MODEL_CACHE_DIR):
+            print(f"Wrote shared weights to {args.weights_dir}")
+        os.environ["WEIGHTS_DIR"] = args.weights_dir
+    else:
+        os.environ.pop("WEIGHTS_DIR", None)
+
+    Server({
+        "bind": args.bind,
+        "workers": workers,
+        "worker_class": "gthread",
+        "threads": max(1, args.http_threads),
+        "timeout": WORKER_TIMEOUT,
+        "graceful_timeout": args.graceful_timeout,
+        "accesslog": "-",
+        **worker_hooks(cpu_sets, args.worker_threads, args.pin_cpus, args.graceful_timeout),
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+
+from batching import BatchScheduler, grid_chunks
+
+
+def test_requests_batch_by_key():
+    calls = []
+
+    def run_batch(key, payloads):
+        calls.append((key, payloads))
+        return [f"{key}{payload}" for payload in payloads]
+
+    scheduler = BatchScheduler(run_batch, window=0.5, max_batch_size=2)
+    futures = [scheduler.submit("a", 1), scheduler.submit("b", 2), scheduler.submit("a", 3)]
+
+    assert [future.result(timeout=5) for future in futures] == ["a1", "b2", "a3"]
+    assert sorted(calls) == [("a", [1, 3]), ("b", [2])]
+    scheduler.close()
+
+
+def test_an_exception_result_fails_only_its_request():
+    def run_batch(key, payloads):
+        return [ValueError("bad payload") if payload < 0 else payload * 2 for payload in payloads]
+
+    scheduler = BatchScheduler(run_batch, window=0.5, max_batch_size=2)
+    bad = scheduler.submit("a", -1)
+    good = scheduler.submit("a", 2)
+
+    with pytest.raises(ValueError):
+        bad.result(timeout=5)
+    assert good.result(timeout=5) == 4
+    scheduler.close()
+
+
+def test_a_failed_batch_fails_all_its_requests():
+    def run_batch(key, payloads):
+        raise RuntimeError("model crashed")
+
+    scheduler = BatchScheduler(run_batch, window=0.5, max_batch_size=2)
+    futures = [scheduler.submit("a", 1), scheduler.submit("a", 2)]
+
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(timeout=5)
+    scheduler.close()
+
+
+def test_cancelled_requests_are_skipped():
+    started = threading.Event()
+    release = threading.Event()
+    seen = []
+
+    def run_batch(key, payloads):
+        seen.extend(payloads)
+        started.set()
+        release.wait(5)
+        return payloads
+
+    scheduler = BatchScheduler(run_batch, window=0, max_batch_size=1)
+    first = scheduler.submit("a", 1)
+    assert started.wait(5)
+
+    # Queued behind the running batch, so it can still be cancelled
+    cancelled = scheduler.submit("a", 2)
+    assert cancelled.cancel()
+    last = scheduler.submit("a", 3)
+    release.set()
+
+    assert first.result(timeout=5) == 1
+    assert last.result(timeout=5) == 3
+    assert seen == [1, 3]
+    scheduler.close()
+
+
+def test_closed_scheduler_rejects_requests():
+    scheduler = BatchScheduler(lambda key, payloads: payloads)
+    scheduler.close()
+    with pytest.raises(RuntimeError):
+        scheduler.submit("a", 1)
+
+
+def test_grid_chunks_group_settings_and_cap_size():
+    items = [
+        {"guidance_scale": 7.5, "num_inference_steps": 20},
+        {"guidance_scale": 5.0, "num_inference_steps": 20},
+        {"guidance_scale": 7.5, "num_inference_steps": 20},
+        {"guidance_scale": 7.5, "num_inference_steps": 20},
+    ]
+
+    assert grid_chunks(items, lambda guidance_scale, steps: 2) == [
+        (7.5, 20, [0, 2]),
+        (7.5, 20, [3]),
+        (5.0, 20, [1]),
+    ]
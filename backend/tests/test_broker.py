@@ -0,0 +1,185 @@
+import time
+
+import pytest
+
+from broker import SQLiteBroker, TaskFailed, make_broker
+from jobs import CANCELLED, FAILED, QUEUED, RUNNING, SUCCEEDED
+
+
+@pytest.fixture
+def broker(tmp_path):
+    return SQLiteBroker(str(tmp_path / "broker.db"), lease_seconds=30, affinity_seconds=30)
+
+
+def test_make_broker(tmp_path):
+    assert make_broker("") is None
+    assert isinstance(make_broker(f"sqlite://{tmp_path / 'broker.db'}"), SQLiteBroker)
+    with pytest.raises(ValueError):
+        make_broker("redis://localhost")
+
+
+def test_claim_takes_higher_priority_then_older_tasks(broker):
+    worker = broker.register_worker()
+    first = broker.submit("generate", {"n": 1})
+    second = broker.submit("generate", {"n": 2})
+    urgent = broker.submit("generate", {"n": 3}, priority=5)
+
+    claimed = [broker.claim(worker)["id"] for _ in range(3)]
+    assert claimed == [urgent, first, second]
+    assert broker.claim(worker) is None
+
+    task = broker.get(first)
+    assert task["state"] == RUNNING
+    assert task["worker_id"] == worker
+    assert task["attempts"] == 1
+    assert task["payload"] == {"n": 1}
+
+
+def test_claim_only_takes_tasks_for_the_workers_models(broker):
+    worker = broker.register_worker(models=["a"])
+    broker.submit("generate", {}, model="b")
+    wanted = broker.submit("generate", {}, model="a")
+
+    assert broker.claim(worker, models=["a"])["id"] == wanted
+    assert broker.claim(worker, models=["a"]) is None
+
+
+def test_claim_prefers_tasks_routed_to_resident_models(broker):
+    worker = broker.register_worker()
+    broker.submit("generate", {}, route="other@1")
+    routed = broker.submit("generate", {}, route="mine@1")
+
+    assert broker.claim(worker, routes=["mine@1"])["id"] == routed
+
+
+def test_claim_leaves_tasks_to_the_worker_with_their_model_resident(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "broker.db"), affinity_seconds=0.2)
+    resident = broker.register_worker()
+    other = broker.register_worker()
+    broker.heartbeat(resident, routes=["model@1"])
+    task_id = broker.submit("generate", {}, route="model@1")
+
+    assert broker.claim(other) is None
+
+    # Once the affinity window passes, any free worker takes it
+    time.sleep(0.25)
+    assert broker.claim(other)["id"] == task_id
+
+
+def test_complete_and_wait(broker):
+    worker = broker.register_worker()
+    task_id = broker.submit("generate", {})
+    broker.claim(worker)
+
+    assert broker.report_progress(task_id, worker, {"step": 1, "total_steps": 2})
+    broker.complete(task_id, worker, {"image": "ref"})
+
+    assert broker.get(task_id)["state"] == SUCCEEDED
+    assert broker.wait(task_id, timeout=1) == {"image": "ref"}
+
+
+def test_wait_raises_for_failed_tasks_and_times_out(broker):
+    worker = broker.register_worker()
+    failed = broker.submit("generate", {})
+    broker.claim(worker)
+    broker.fail(failed, worker, "boom")
+
+    with pytest.raises(TaskFailed, match="boom"):
+        broker.wait(failed, timeout=1)
+
+    queued = broker.submit("generate", {})
+    with pytest.raises(TimeoutError):
+        broker.wait(queued, timeout=0.05)
+
+
+def test_wait_reports_progress(broker):
+    worker = broker.register_worker()
+    task_id = broker.submit("generate", {})
+    broker.claim(worker)
+    broker.report_progress(task_id, worker, {"step": 1})
+    updates = []
+
+    with pytest.raises(TimeoutError):
+        broker.wait(task_id, timeout=0.1, on_progress=updates.append)
+    assert updates == [{"step": 1}]
+
+
+def test_cancel_drops_queued_tasks_and_stops_running_ones(broker):
+    worker = broker.register_worker()
+    running = broker.submit("generate", {})
+    broker.claim(worker)
+    queued = broker.submit("generate", {})
+
+    broker.cancel(queued)
+    broker.cancel(running)
+
+    assert broker.get(queued)["state"] == CANCELLED
+    assert broker.claim(worker) is None
+    assert broker.get(running)["state"] == RUNNING
+    assert not broker.report_progress(running, worker, {"step": 1})
+
+
+def test_expired_leases_are_requeued_until_out_of_attempts(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "broker.db"), lease_seconds=0.05, max_attempts=2)
+    task_id = broker.submit("generate", {})
+
+    for attempt in (1, 2):
+        worker = broker.register_worker()
+        assert broker.claim(worker)["attempts"] == attempt
+        time.sleep(0.1)
+        assert broker.requeue_expired() == 1
+
+    task = broker.get(task_id)
+    assert task["state"] == FAILED
+    assert "stopped responding" in task["error"]
+
+
+def test_heartbeats_renew_leases(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "broker.db"), lease_seconds=0.2)
+    worker = broker.register_worker()
+    task_id = broker.submit("generate", {})
+    broker.claim(worker)
+
+    for _ in range(3):
+        time.sleep(0.1)
+        broker.heartbeat(worker)
+        assert broker.requeue_expired() == 0
+    assert broker.get(task_id)["state"] == RUNNING
+
+
+def test_requeued_task_belongs_to_its_new_worker(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "broker.db"), lease_seconds=0.05)
+    stale = broker.register_worker()
+    task_id = broker.submit("generate", {})
+    broker.claim(stale)
+    time.sleep(0.1)
+    broker.requeue_expired()
+    assert broker.get(task_id)["state"] == QUEUED
+
+    fresh = broker.register_worker()
+    broker.claim(fresh)
+
+    # The worker that lost its lease can neither report on nor finish the task
+    assert not broker.report_progress(task_id, stale, {"step": 1})
+    broker.complete(task_id, stale, {"image": "stale"})
+    assert broker.get(task_id)["state"] == RUNNING
+
+    broker.complete(task_id, fresh, {"image": "fresh"})
+    assert broker.get(task_id)["result"] == {"image": "fresh"}
+
+
+def test_workers_and_prune(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "broker.db"), lease_seconds=0.05)
+    worker = broker.register_worker(models=["a"])
+    broker.heartbeat(worker, routes=["a@1"], running=1)
+    assert [(w["models"], w["routes"], w["running"]) for w in broker.workers()] == [(["a"], ["a@1"], 1)]
+
+    task_id = broker.submit("generate", {})
+    broker.claim(worker)
+    broker.complete(task_id, worker, {})
+    time.sleep(0.1)
+
+    assert broker.workers() == []
+    broker.prune(keep_seconds=0.05)
+    assert broker.get(task_id) is None
+    assert broker.counts() == {}
@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+
+from cache import LRUCache, ResultCache
+
+
+def test_lru_cache_evicts_least_recently_used_by_size():
+    cache = LRUCache(4, sizeof=len)
+    cache.put("a", "xx")
+    cache.put("b", "xx")
+    assert cache.get("a") == "xx"
+
+    cache.put("c", "xx")
+    assert "b" not in cache
+    assert cache.get("a") == "xx" and cache.get("c") == "xx"
+
+    # Larger than the whole budget, so never stored
+    cache.put("d", "xxxxx")
+    assert "d" not in cache
+    assert cache.stats()["evictions"] == 1
+
+
+def test_result_cache_returns_cached_values():
+    cache = ResultCache(max_entries=8)
+    key = ResultCache.make_key("prompt", 42)
+
+    assert cache.get_or_compute(key, lambda: "image") == ("image", False)
+    assert cache.get_or_compute(key, lambda: "other") == ("image", True)
+
+    cache.invalidate(key)
+    assert cache.get_or_compute(key, lambda: "other") == ("other", False)
+
+
+def test_concurrent_calls_share_one_computation():
+    cache = ResultCache(max_entries=8)
+    computing = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        computing.set()
+        release.wait(5)
+        return "image"
+
+    results = []
+    owner = threading.Thread(target=lambda: results.append(cache.get_or_compute("key", compute)))
+    owner.start()
+    assert computing.wait(5)
+
+    waiter = threading.Thread(target=lambda: results.append(cache.get_or_compute("key", compute)))
+    waiter.start()
+    time.sleep(0.05)
+    assert cache.stats()["in_flight"] == 1
+    release.set()
+    owner.join(5)
+    waiter.join(5)
+
+    assert len(calls) == 1
+    assert sorted(results) == [("image", False), ("image", True)]
+
+
+def test_waiters_compute_themselves_when_the_owner_fails():
+    cache = ResultCache(max_entries=8)
+    computing = threading.Event()
+    release = threading.Event()
+
+    def failing():
+        computing.set()
+        release.wait(5)
+        raise RuntimeError("request cancelled")
+
+    errors = []
+
+    def run_owner():
+        try:
+            cache.get_or_compute("key", failing)
+        except RuntimeError as e:
+            errors.append(e)
+
+    owner = threading.Thread(target=run_owner)
+    owner.start()
+    assert computing.wait(5)
+
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(cache.get_or_compute("key", lambda: "image")))
+    waiter.start()
+    time.sleep(0.05)
+    release.set()
+    owner.join(5)
+    waiter.join(5)
+
+    assert len(errors) == 1
+    assert results == [("image", False)]
+    assert cache.stats()["in_flight"] == 0
+
+
+def test_failed_computations_are_not_cached():
+    cache = ResultCache(max_entries=8)
+
+    def failing():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        cache.get_or_compute("key", failing)
+    assert cache.get_or_compute("key", lambda: "image") == ("image", False)
@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+from jobs import CANCELLED, FAILED, QUEUED, RUNNING, SUCCEEDED, JobQueue, QueueClosedError, QueueFullError
+
+
+def wait_for_state(queue, job_id, state, timeout=5):
+    snapshot, version = queue.wait_for_update(job_id, None, timeout=0)
+    deadline = time.monotonic() + timeout
+    while snapshot["state"] != state:
+        remaining = deadline - time.monotonic()
+        assert remaining > 0, f"job stayed {snapshot['state']}, expected {state}"
+        snapshot, version = queue.wait_for_update(job_id, version, timeout=remaining)
+    return snapshot
+
+
+def blocking_job(release, started=None):
+    def run(report_progress):
+        if started is not None:
+            started.set()
+        release.wait(5)
+        return "done"
+    return run
+
+
+def test_jobs_run_by_priority_then_submission_order():
+    queue = JobQueue(num_workers=1)
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    blocker = queue.submit("generate", blocking_job(release, started))
+    assert started.wait(5)
+    jobs = [
+        queue.submit("generate", lambda report_progress, n=n: order.append(n), priority=priority)
+        for n, priority in [(1, 0), (2, 5), (3, 0)]
+    ]
+    release.set()
+
+    for job in [blocker, *jobs]:
+        wait_for_state(queue, job.id, SUCCEEDED)
+    assert order == [2, 1, 3]
+    assert queue.get(blocker.id)["result"] == "done"
+
+
+def test_full_queue_rejects_jobs_with_a_retry_hint():
+    queue = JobQueue(num_workers=1, max_pending=1)
+    started = threading.Event()
+    release = threading.Event()
+
+    queue.submit("generate", blocking_job(release, started))
+    assert started.wait(5)
+    queue.submit("generate", blocking_job(release))
+
+    with pytest.raises(QueueFullError) as excinfo:
+        queue.submit("generate", blocking_job(release))
+    assert excinfo.value.retry_after >= 1
+    release.set()
+
+
+def test_cancel_drops_queued_jobs():
+    queue = JobQueue(num_workers=1)
+    started = threading.Event()
+    release = threading.Event()
+    ran = []
+
+    blocker = queue.submit("generate", blocking_job(release, started))
+    assert started.wait(5)
+    queued = queue.submit("generate", lambda report_progress: ran.append(1))
+    assert queue.get(queued.id)["state"] == QUEUED
+
+    assert queue.cancel(queued.id)["state"] == CANCELLED
+    release.set()
+    wait_for_state(queue, blocker.id, SUCCEEDED)
+    assert queue.close(timeout=5)
+    assert ran == []
+
+
+def test_cancel_stops_running_jobs_at_their_next_step():
+    queue = JobQueue(num_workers=1)
+    started = threading.Event()
+
+    def run(report_progress):
+        started.set()
+        for step in range(1000):
+            report_progress(step, 1000)
+            time.sleep(0.01)
+
+    job = queue.submit("generate", run)
+    assert started.wait(5)
+    wait_for_state(queue, job.id, RUNNING)
+
+    assert queue.cancel(job.id)["cancel_requested"]
+    snapshot = wait_for_state(queue, job.id, CANCELLED)
+    assert snapshot["progress"]["step"] < 999
+
+
+def test_failed_jobs_keep_their_error():
+    queue = JobQueue(num_workers=1)
+
+    def run(report_progress):
+        raise ValueError("bad request")
+
+    job = queue.submit("generate", run)
+    assert wait_for_state(queue, job.id, FAILED)["error"] == "bad request"
+    assert queue.cancel("unknown") is None
+
+
+def test_closed_queue_rejects_jobs():
+    queue = JobQueue(num_workers=1)
+    assert queue.close(timeout=5)
+    with pytest.raises(QueueClosedError):
+        queue.submit("generate", lambda report_progress: None)
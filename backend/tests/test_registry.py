@@ -0,0 +1,51 @@
+import json
+import os
+
+import pytest
+
+from registry import BASE_MODEL, ModelRegistry
+
+
+def write_unet(model_dir, name):
+    path = os.path.join(model_dir, name)
+    os.makedirs(path)
+    with open(os.path.join(path, "config.json"), "w") as f:
+        json.dump({"_class_name": "UNet2DConditionModel"}, f)
+    return path
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return ModelRegistry(str(tmp_path), lambda path: object(), base_version="base-model")
+
+
+def test_scan_finds_checkpoints_up_to_two_levels_deep(registry, tmp_path):
+    write_unet(tmp_path, "unet_final")
+    write_unet(tmp_path, os.path.join("retrained_1", "unet_final"))
+    write_unet(tmp_path, os.path.join("a", "b", "too_deep"))
+
+    assert sorted(registry.checkpoints()) == [BASE_MODEL, "retrained_1/unet_final", "unet_final"]
+
+
+def test_scan_is_reused_until_a_name_is_missing(registry, tmp_path, monkeypatch):
+    scans = []
+    scan = registry._scan_checkpoints
+    monkeypatch.setattr(registry, "_scan_checkpoints", lambda: scans.append(1) or scan())
+
+    registry.resolve(BASE_MODEL)
+    registry.exists(BASE_MODEL)
+    assert len(scans) == 1
+
+    # A checkpoint added after the scan is found by rescanning on the miss
+    write_unet(tmp_path, "unet_final")
+    assert registry.exists("unet_final")
+    assert len(scans) == 2
+    assert not registry.exists("missing")
+
+
+def test_registered_checkpoints_are_served(registry, tmp_path):
+    path = write_unet(tmp_path / "elsewhere", "unet")
+    registry.checkpoints()
+    registry.register("custom", path)
+
+    assert registry.resolve("custom")[0] == "custom"
@@ -0,0 +1,115 @@
+"""Build a tiny randomly initialized Stable Diffusion model, fully offline.
+
+The model is laid out like a Hugging Face model repository (``tokenizer``,
+``text_encoder``, ``vae``, ``unet`` and ``scheduler`` subfolders), so it
+loads anywhere a model id does, such as ``MODEL_ID`` or
+``StableDiffusionModel(model_id=...)``. Its outputs are noise, but it runs
+every code path of the real model in a fraction of the time and memory.
+Example:
+
+    python tiny_model.py ./tiny-sd
+"""
+import argparse
+import json
+import os
+
+import torch
+from diffusers import AutoencoderKL, DDPMScheduler, UNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+# Width of the text embeddings the U-Net attends to
+HIDDEN_SIZE = 32
+MAX_PROMPT_TOKENS = 77
+
+
+def build_tokenizer(output_dir):
+    """A CLIP tokenizer over single bytes, without BPE merges"""
+    os.makedirs(output_dir, exist_ok=True)
+    symbols = list(bytes_to_unicode().values())
+    tokens = symbols + [symbol + "</w>" for symbol in symbols] + ["<|startoftext|>", "<|endoftext|>"]
+
+    vocab_file = os.path.join(output_dir, "vocab.json")
+    merges_file = os.path.join(output_dir, "merges.txt")
+    with open(vocab_file, "w") as f:
+        json.dump({token: i for i, token in enumerate(tokens)}, f)
+    with open(merges_file, "w") as f:
+        f.write("#version: 0.2\n")
+
+    tokenizer = CLIPTokenizer(vocab_file, merges_file, model_max_length=MAX_PROMPT_TOKENS)
+    tokenizer.save_pretrained(output_dir)
+    return tokenizer
+
+
+def build_tiny_model(output_dir, seed=0):
+    """Write a tiny model to ``output_dir`` and return its path
+
+    The same ``seed`` always produces the same weights, so results stay
+    comparable across runs.
+    """
+    torch.manual_seed(seed)
+
+    tokenizer = build_tokenizer(os.path.join(output_dir, "tokenizer"))
+
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=HIDDEN_SIZE,
+        intermediate_size=37,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        max_position_embeddings=MAX_PROMPT_TOKENS,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    ))
+    text_encoder.save_pretrained(os.path.join(output_dir, "text_encoder"))
+
+    # Four blocks keep the real model's 8x latent downscaling
+    vae = AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D"] * 4,
+        up_block_types=["UpDecoderBlock2D"] * 4,
+        block_out_channels=[32] * 4,
+        layers_per_block=1,
+        latent_channels=4,
+    )
+    vae.save_pretrained(os.path.join(output_dir, "vae"))
+
+    unet = UNet2DConditionModel(
+        sample_size=64,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        cross_attention_dim=HIDDEN_SIZE,
+    )
+    unet.save_pretrained(os.path.join(output_dir, "unet"))
+
+    # Stable Diffusion v1's noise schedule
+    DDPMScheduler(
+        num_train_timesteps=1000,
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        clip_sample=False,
+        steps_offset=1,
+    ).save_pretrained(os.path.join(output_dir, "scheduler"))
+
+    return output_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output_dir")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    build_tiny_model(args.output_dir, args.seed)
+    print(f"Wrote a tiny model to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,420 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from blob_store import BlobStore, decode_data_url
+from db import Database
+
+IDLE = "idle"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# Stopped runs that left a checkpoint behind can be resumed
+RESUMABLE_STATES = (FAILED, CANCELLED)
+
+
+class TrainingBusyError(Exception):
+    """Raised when a training run is started while another one is running"""
+
+    def __init__(self):
+        super().__init__("A training run is already in progress")
+
+
+class TrainingStatus:
+    """Progress of the current or last training run, kept in a JSON file.
+
+    Only one process writes at a time: the training process while it runs,
+    the server before and after. Writes replace the file atomically, so
+    readers never see a partial update. Cancelling is recorded in a file of
+    its own, which server processes create while the training process
+    keeps rewriting the status, so a step's update can't drop it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, status):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(status, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @property
+    def cancel_path(self):
+        return self.path + ".cancel"
+
+    def request_cancel(self):
+        with open(self.cancel_path, "w"):
+            pass
+
+    def cancel_requested(self):
+        return os.path.exists(self.cancel_path)
+
+    def clear_cancel(self):
+        try:
+            os.remove(self.cancel_path)
+        except FileNotFoundError:
+            pass
+
+    def update(self, **changes):
+        status = {**(self.read() or {}), **changes}
+        self.write(status)
+        return status
+
+    @contextmanager
+    def exclusive(self):
+        """Hold a lock file, so server processes sharing the status start runs one at a time"""
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def process_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def idle_status():
+    return {
+        "state": IDLE,
+        "active": False,
+        "progress": 0,
+        "step": 0,
+        "total_steps": 0,
+        "current_epoch": 0,
+        "total_epochs": 0,
+        "current_loss": 0.0,
+        "samples_per_second": 0.0,
+        "cancel_requested": False,
+        "pid": None,
+        "error": None,
+        "completed": False,
+        "start_time": None,
+        "end_time": None,
+    }
+
+
+class FeedbackDataset:
+    """Images rated at least ``min_feedback``, as ``{"image", "description"}`` training records.
+
+    Only the image ids are read up front, unless given as ``ids``; each
+    record's row and image bytes are fetched when it is accessed. Every
+    process (such as a DataLoader worker) opens its own database connections.
+    """
+
+    def __init__(self, db_path, blob_dir, ids=None, min_feedback=1):
+        self.db_path = db_path
+        self.blob_store = BlobStore(blob_dir)
+        if ids is None:
+            ids = [
+                image_id
+                for batch in Database(db_path).iter_feedback_image_ids(min_feedback)
+                for image_id in batch
+            ]
+        self.ids = ids
+        self._db = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _database(self):
+        if self._pid != os.getpid():
+            self._db = Database(self.db_path, pool_size=1)
+            self._pid = os.getpid()
+        return self._db
+
+    def __getitem__(self, idx):
+        row = self._database().get_image(self.ids[idx])
+        if row is None:
+            raise KeyError(f"Image {self.ids[idx]} was deleted")
+        if row["blob_ref"]:
+            data = self.blob_store.get(row["blob_ref"], row["blob_format"])
+        else:
+            data, _ = decode_data_url(row["image_data"])
+        return {"image": data, "description": row["prompt"]}
+
+
+def run_training(options, status_path, num_threads, parent_pid=None):
+    """Run a training run in this process, reporting to the status file
+
+    The run stops at its next step, saving a checkpoint, when it is
+    cancelled through the status file or the server process ``parent_pid``
+    exits.
+    """
+    # Size the thread pools before torch is imported, leaving the other cores to inference
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    os.environ["MKL_NUM_THREADS"] = str(num_threads)
+    if hasattr(os, "nice"):
+        os.nice(10)
+
+    import torch
+    from fine_tuning import train
+
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+    status = TrainingStatus(status_path)
+
+    def should_stop():
+        # Server processes cancel the run through the status file
+        if parent_pid is not None and os.getppid() != parent_pid:
+            return True
+        return status.cancel_requested()
+
+    def report_progress(progress):
+        total_steps = progress["total_steps"] or 0
+        status.update(
+            step=progress["step"],
+            total_steps=total_steps,
+            current_epoch=progress["epoch"] + 1,
+            current_loss=progress["loss"],
+            samples_per_second=progress["samples_per_second"],
+            progress=100 * progress["step"] / total_steps if total_steps else 0,
+        )
+
+    try:
+        # A resumed run trains on the same images, even if feedback changed since
+        ids_path = os.path.join(options["output_dir"], "training_images.json")
+        if options["resume"] and os.path.exists(ids_path):
+            with open(ids_path) as f:
+                dataset = FeedbackDataset(options.pop("db_path"), options.pop("blob_dir"), ids=json.load(f))
+        else:
+            dataset = FeedbackDataset(options.pop("db_path"), options.pop("blob_dir"))
+            os.makedirs(options["output_dir"], exist_ok=True)
+            with open(ids_path, "w") as f:
+                json.dump(dataset.ids, f)
+
+        model_path = train(
+            dataset=dataset,
+            progress_callback=report_progress,
+            should_stop=should_stop,
+            **options,
+        )
+    except Exception as e:
+        traceback.print_exc()
+        status.update(state=FAILED, active=False, error=str(e), end_time=datetime.now().isoformat())
+        return
+
+    if model_path is None:
+        status.update(state=CANCELLED, active=False, end_time=datetime.now().isoformat())
+    else:
+        status.update(
+            state=COMPLETED,
+            active=False,
+            completed=True,
+            progress=100,
+            model_path=model_path,
+            end_time=datetime.now().isoformat(),
+        )
+
+
+class TrainingOrchestrator:
+    """Runs fine-tuning on positively rated images in a separate process, one run at a time.
+
+    The training process gets ``num_threads`` CPU threads and a lower
+    scheduling priority, so it doesn't slow down inference in the server
+    process. Progress is written to a ``TrainingStatus`` file at every step.
+    Cancelling a run saves a checkpoint it can be resumed from. When a run
+    completes, ``on_complete(name, path)`` is called with the name the new
+    U-Net can be served under.
+
+    Server processes sharing a status file share the run: the status
+    records the training process's pid, so any of them sees a run as busy
+    while it is alive and can cancel it.
+    """
+
+    def __init__(self, model_dir, db, blob_dir, status_path, num_threads=1, model_id=None, on_complete=None):
+        self.model_dir = model_dir
+        self.db = db
+        self.blob_dir = blob_dir
+        self.store = TrainingStatus(status_path)
+        self.num_threads = max(1, num_threads)
+        self.model_id = model_id
+        self.on_complete = on_complete
+
+        self._process = None
+        self._lock = threading.Lock()
+
+        # A run still marked as running whose process is gone was cut off by a server restart
+        with self.store.exclusive():
+            status = self.store.read()
+            if status and status.get("state") == RUNNING and not process_alive(status.get("pid")):
+                self.store.update(state=FAILED, active=False, error="Interrupted by a server restart")
+
+    @property
+    def running(self):
+        """Whether this server process's training process is running"""
+        return self._process is not None and self._process.poll() is None
+
+    @property
+    def active(self):
+        """Whether any server process's training process is running"""
+        return self.running or self._foreign_run() is not None
+
+    def _foreign_run(self):
+        """The status of a run started by another server process, if it is still running"""
+        status = self.store.read()
+        if status and status.get("state") == RUNNING and process_alive(status.get("pid")):
+            return status
+        return None
+
+    def status(self):
+        status = self.store.read() or idle_status()
+        if status.get("state") == RUNNING:
+            status["cancel_requested"] = self.store.cancel_requested()
+        return status
+
+    def start(self, parameters=None, resume=False):
+        """Start a training run, or resume the last stopped one, and return its status"""
+        with self._lock, self.store.exclusive():
+            if self.running or self._foreign_run() is not None:
+                raise TrainingBusyError()
+
+            if resume:
+                previous = self.store.read()
+                if not previous or previous.get("state") not in RESUMABLE_STATES:
+                    raise ValueError("There is no stopped training run to resume")
+                output_dir = previous["output_dir"]
+                if not os.path.exists(os.path.join(output_dir, "checkpoint", "progress.json")):
+                    raise ValueError("The stopped training run has no checkpoint to resume from")
+                parameters = previous["parameters"]
+            else:
+                if next(self.db.iter_feedback_image_ids(batch_size=1), None) is None:
+                    raise ValueError("No images with positive feedback to train on")
+                output_dir = os.path.join(self.model_dir, f"retrained_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+
+            options = {
+                "db_path": self.db.db_path,
+                "blob_dir": self.blob_dir,
+                "output_dir": output_dir,
+                "dataset_name": "feedback",
+                "learning_rate": parameters["learning_rate"],
+                "num_epochs": parameters["num_epochs"],
+                "train_batch_size": parameters["batch_size"],
+                "lora_rank": parameters["lora_rank"] or None,
+                "gradient_checkpointing": True,
+                # Workers would be children of a daemon process, which can't have any
+                "num_workers": 0,
+                "resume": resume,
+            }
+            if self.model_id:
+                options["model_id"] = self.model_id
+
+            status = {
+                **idle_status(),
+                "state": RUNNING,
+                "active": True,
+                "total_epochs": parameters["num_epochs"],
+                "parameters": parameters,
+                "output_dir": output_dir,
+                "start_time": datetime.now().isoformat(),
+            }
+            self.store.clear_cancel()
+            self.store.write(status)
+
+            # A fresh interpreter running this module, so none of the server's
+            # import-time setup (model loading, job workers) is repeated in it.
+            # The run checkpoints and stops when the server exits, and can be resumed.
+            self._process = subprocess.Popen([
+                sys.executable,
+                os.path.abspath(__file__),
+                "--status-path", self.store.path,
+                "--threads", str(self.num_threads),
+                "--parent-pid", str(os.getpid()),
+                "--options", json.dumps(options),
+            ])
+            status = self.store.update(pid=self._process.pid)
+
+            threading.Thread(
+                target=self._watch,
+                args=(self._process, output_dir),
+                name="training-watcher",
+                daemon=True,
+            ).start()
+            return status
+
+    def cancel(self):
+        """Ask the running training process to checkpoint and stop; returns False if none is running"""
+        with self._lock, self.store.exclusive():
+            if not self.running and self._foreign_run() is None:
+                return False
+            self.store.request_cancel()
+            return True
+
+    def _watch(self, process, output_dir):
+        process.wait()
+        status = self.store.read() or {}
+
+        if status.get("state") == RUNNING:
+            # The process died without reporting, e.g. killed for running out of memory
+            self.store.update(
+                state=FAILED,
+                active=False,
+                error=f"Training process exited with code {process.returncode}",
+                end_time=datetime.now().isoformat(),
+            )
+        elif status.get("state") == COMPLETED and self.on_complete is not None:
+            model_path = status["model_path"]
+            name = os.path.relpath(model_path, self.model_dir).replace(os.sep, "/")
+            try:
+                self.on_complete(name, model_path)
+                self.store.update(model=name)
+            except Exception:
+                traceback.print_exc()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a training run started by TrainingOrchestrator")
+    parser.add_argument("--status-path", required=True)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--parent-pid", type=int, default=None)
+    parser.add_argument("--options", required=True, help="Training options as JSON")
+    args = parser.parse_args()
+    run_training(json.loads(args.options), args.status_path, args.threads, args.parent_pid)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,14 @@ from PIL import Image
 import torch
 import numpy as np
 
+# Linear map from Stable Diffusion v1 latent channels to approximate RGB in [-1, 1]
+LATENT_RGB_FACTORS = torch.tensor([
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+])
+
 
 def base64_to_image(base64_string):
     """Convert a base64 string to a PIL Image"""
@@ -15,19 +23,73 @@ def base64_to_image(base64_string):
     return image
 
 
-def image_to_base64(image):
-    """Convert a PIL Image to a base64 string"""
+# Output formats generated images can be encoded in
+IMAGE_FORMATS = ("png", "webp", "jpeg")
+
+
+def encode_image(image, image_format="png", quality=90, compress_level=1):
+    """Encode a PIL Image, returning its bytes
+
+    PNG is lossless; ``compress_level`` (0-9) trades size for encoding
+    time, and levels above 1 spend several times the CPU for a few percent
+    smaller files. WebP and JPEG are lossy at ``quality`` (1-100), and
+    come out several times smaller than PNG.
+    """
     buffer = io.BytesIO()
-    image.save(buffer, format="PNG")
-    img_str = base64.b64encode(buffer.getvalue()).decode("utf-8")
-    return f"data:image/png;base64,{img_str}"
+    if image_format == "png":
+        image.save(buffer, format="PNG", compress_level=compress_level)
+    elif image_format == "webp":
+        # method 4 keeps most of the compression of the slowest method at a fraction of the time
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    elif image_format == "jpeg":
+        image.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    else:
+        raise ValueError(f"Unknown image format '{image_format}'; expected one of {', '.join(IMAGE_FORMATS)}")
+    return buffer.getvalue()
+
+
+def image_to_base64(image, image_format="png", quality=90, compress_level=1):
+    """Convert a PIL Image to a base64 data URL"""
+    img_str = base64.b64encode(encode_image(image, image_format, quality, compress_level)).decode("utf-8")
+    return f"data:image/{image_format};base64,{img_str}"
+
+
+def make_thumbnail(image, size=256, image_format="WEBP", quality=80):
+    """Downscale a PIL Image to fit in a size x size box and encode it"""
+    thumbnail = image.convert("RGB")
+    thumbnail.thumbnail((size, size))
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def make_contact_sheet(images, columns, cell_size=256, padding=4):
+    """Tile PIL Images row by row into one image, each scaled to fit a cell_size x cell_size cell"""
+    columns = max(1, min(columns, len(images)))
+    rows = -(-len(images) // columns)
+    step = cell_size + padding
+    sheet = Image.new("RGB", (columns * step + padding, rows * step + padding), "white")
+    for i, image in enumerate(images):
+        cell = image.convert("RGB")
+        cell.thumbnail((cell_size, cell_size))
+        row, column = divmod(i, columns)
+        # Center each image in its cell, so non-square images line up
+        x = padding + column * step + (cell_size - cell.width) // 2
+        y = padding + row * step + (cell_size - cell.height) // 2
+        sheet.paste(cell, (x, y))
+    return sheet
 
 
 def preprocess_image(image, size=512):
-    """Preprocess an image for the model"""
+    """Preprocess an image for the model
+
+    ``size`` is either a square edge length or a ``(width, height)`` tuple.
+    """
+    if isinstance(size, int):
+        size = (size, size)
     if image.mode != "RGB":
         image = image.convert("RGB")
-    image = image.resize((size, size))
+    image = image.resize(size)
     image = np.array(image) / 127.5 - 1.0  # Normalize to [-1, 1]
     image = torch.from_numpy(image).permute(2, 0, 1).float()  # [C, H, W]
     return image
@@ -43,6 +105,18 @@ def postprocess_image(tensor):
     return image
 
 
+def latents_to_preview(latents):
+    """Approximate a batch of latents as one RGB image without running the VAE
+
+    The images sit side by side at latent resolution (1/8 of the output size).
+    """
+    latents = latents.detach().float().cpu()
+    # Cast back in case the projection ran under autocast
+    rgb = torch.einsum("bchw,cr->rhbw", latents, LATENT_RGB_FACTORS).float()
+    rgb = rgb.reshape(3, latents.shape[2], -1)  # [3, H, B * W]
+    return postprocess_image(rgb)
+
+
 def clean_prompt(text):
     """Clean prompt text for better results"""
     text = text.strip()
@@ -18,7 +18,7 @@ import {
   Tooltip,
 } from '@chakra-ui/react';
 import { ChevronLeftIcon, ChevronRightIcon } from '@chakra-ui/icons';
-import { getImages } from './api';
+import { getImageThumbnails } from './api';
 
 const GalleryItem = ({ image }) => {
   const bgColor = useColorModeValue('white', 'gray.800');
@@ -55,7 +55,7 @@ const GalleryItem = ({ image }) => {
             left="0"
             w="100%"
             h="100%"
-            src={image.image_data}
+            src={image.thumbnail_url}
             alt={image.prompt}
             objectFit="cover"
           />
@@ -91,23 +91,25 @@ const Gallery = () => {
   const [images, setImages] = useState([]);
   const [loading, setLoading] = useState(true);
   const [page, setPage] = useState(0);
+  // cursors[n] is the cursor that fetches page n; page 0 starts from the newest image
+  const [cursors, setCursors] = useState([null]);
   const [hasMore, setHasMore] = useState(true);
   const pageSize = 12;
   
   const fetchImages = async (pageNum) => {
     setLoading(true);
     try {
-      const data = await getImages(pageSize, pageNum * pageSize);
+      const data = await getImageThumbnails(pageSize, cursors[pageNum]);
       
-      if (data.length < pageSize) {
-        setHasMore(false);
-      }
+      setImages(data.items);
+      setHasMore(Boolean(data.next_cursor));
       
-      // If it's the first page, replace images, otherwise append
-      if (pageNum === 0) {
-        setImages(data);
-      } else {
-        setImages((prevImages) => [...prevImages, ...data]);
+      if (data.next_cursor) {
+        setCursors((prevCursors) => {
+          const nextCursors = prevCursors.slice(0, pageNum + 1);
+          nextCursors[pageNum + 1] = data.next_cursor;
+          return nextCursors;
+        });
       }
     } catch (error) {
       console.error('Error fetching images:', error);
@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { useNavigate } from 'react-router-dom';
 import {
   Box,
@@ -39,6 +39,9 @@ import {
   TabPanel,
   useColorModeValue,
   Skeleton,
+  Select,
+  Progress,
+  SimpleGrid,
 } from '@chakra-ui/react';
 import { 
   DownloadIcon, 
@@ -51,7 +54,10 @@ import {
   ChevronRightIcon,
   MoonIcon
 } from '@chakra-ui/icons';
-import { generateImage } from './api';
+import { submitGenerateJob, subscribeToJob, cancelJob, streamBatch } from './api';
+
+// Denoising steps between preview frames streamed while an image generates
+const PREVIEW_EVERY = 2;
 
 // Example prompts to inspire users
 const EXAMPLE_PROMPTS = [
@@ -65,12 +71,19 @@ const EXAMPLE_PROMPTS = [
 const ImageGenerator = () => {
   const [prompt, setPrompt] = useState('');
   const [negativePrompt, setNegativePrompt] = useState('');
+  const [quality, setQuality] = useState('standard');
   const [inferenceSteps, setInferenceSteps] = useState(50);
   const [guidanceScale, setGuidanceScale] = useState(7.5);
   const [seed, setSeed] = useState('');
+  const [seedCount, setSeedCount] = useState(1);
+  const [sweepImages, setSweepImages] = useState(null);
   const [loading, setLoading] = useState(false);
   const [generatedImage, setGeneratedImage] = useState(null);
   const [imageId, setImageId] = useState(null);
+  const [jobId, setJobId] = useState(null);
+  const [progress, setProgress] = useState(null);
+  const [preview, setPreview] = useState(null);
+  const closeStreamRef = useRef(null);
   
   const toast = useToast();
   const navigate = useNavigate();
@@ -94,21 +107,87 @@ const ImageGenerator = () => {
     }
 
     setLoading(true);
+    setProgress(null);
+    setPreview(null);
+    setSweepImages(null);
+    
+    const params = {
+      prompt,
+      negative_prompt: negativePrompt,
+      // Quality tiers pick the scheduler and step count on the server
+      ...(quality === 'custom'
+        ? { num_inference_steps: inferenceSteps }
+        : { quality }),
+      guidance_scale: guidanceScale,
+      seed: seed ? parseInt(seed) : undefined,
+    };
+    
+    if (seedCount > 1) {
+      handleSeedSweep(params);
+      return;
+    }
     
     try {
-      const seedValue = seed ? parseInt(seed) : undefined;
-      
-      const result = await generateImage({
-        prompt,
-        negative_prompt: negativePrompt,
-        num_inference_steps: inferenceSteps,
-        guidance_scale: guidanceScale,
-        seed: seedValue,
+      const { job_id } = await submitGenerateJob({
+        ...params,
+        preview_every: PREVIEW_EVERY,
       });
       
-      setGeneratedImage(result.image);
-      setImageId(result.id);
-      setSeed(result.seed.toString());
+      setJobId(job_id);
+      
+      // Closing the stream, e.g. by leaving the page, cancels the job on the server
+      closeStreamRef.current = subscribeToJob(job_id, handleJobUpdate, {
+        onPreview: (update) => setPreview(update.image),
+        cancelOnClose: true,
+      });
+    } catch (error) {
+      showGenerationError(error.message);
+      setLoading(false);
+    }
+  };
+  
+  // One request for the whole sweep; the server batches the seeds and streams each chunk back
+  const handleSeedSweep = (params) => {
+    const finish = () => {
+      closeStreamRef.current = null;
+      setProgress(null);
+      setLoading(false);
+    };
+    let images = [];
+    setSweepImages(images);
+    setProgress({ step: 0, total_steps: seedCount });
+    
+    closeStreamRef.current = streamBatch(
+      { ...params, seed_count: seedCount },
+      {
+        onImages: (items) => {
+          images = [...images, ...items].sort((a, b) => a.index - b.index);
+          setSweepImages(images);
+          setProgress({ step: images.length, total_steps: seedCount });
+        },
+        onDone: finish,
+        onError: (message) => {
+          showGenerationError(message);
+          finish();
+        },
+      }
+    );
+  };
+  
+  const handleSelectSweepImage = (item) => {
+    setSweepImages(null);
+    setGeneratedImage(item.image);
+    setImageId(item.id);
+    setSeed(item.seed.toString());
+  };
+  
+  const handleJobUpdate = (job) => {
+    setProgress(job.progress);
+    
+    if (job.state === 'succeeded') {
+      setGeneratedImage(job.result.image);
+      setImageId(job.result.id);
+      setSeed(job.result.seed.toString());
       
       toast({
         title: 'Success!',
@@ -118,19 +197,50 @@ const ImageGenerator = () => {
         isClosable: true,
         position: 'top-right',
       });
-    } catch (error) {
-      toast({
-        title: 'Generation Failed',
-        description: error.message || 'Failed to generate image. Please try again.',
-        status: 'error',
-        duration: 5000,
-        isClosable: true,
-        position: 'top',
-      });
-    } finally {
+    } else if (job.state === 'failed') {
+      showGenerationError(job.error);
+    }
+    
+    if (['succeeded', 'failed', 'cancelled'].includes(job.state)) {
+      closeStreamRef.current = null;
+      setJobId(null);
+      setPreview(null);
       setLoading(false);
     }
   };
+  
+  const showGenerationError = (message) => {
+    toast({
+      title: 'Generation Failed',
+      description: message || 'Failed to generate image. Please try again.',
+      status: 'error',
+      duration: 5000,
+      isClosable: true,
+      position: 'top',
+    });
+  };
+  
+  const handleCancel = async () => {
+    if (!jobId) {
+      // A sweep stops when its stream closes; chunks already finished are kept
+      if (closeStreamRef.current) {
+        closeStreamRef.current();
+        closeStreamRef.current = null;
+        setProgress(null);
+        setLoading(false);
+      }
+      return;
+    }
+    
+    try {
+      await cancelJob(jobId);
+    } catch (error) {
+      // The job may have finished in the meantime; its final event still arrives
+    }
+  };
+  
+  // Stop streaming (and cancel any running job) when leaving the page
+  useEffect(() => () => closeStreamRef.current && closeStreamRef.current(), []);
 
   const handleRandomSeed = () => {
     setSeed(Math.floor(Math.random() * 4294967295).toString());
@@ -283,11 +393,43 @@ const ImageGenerator = () => {
                         >
                           Generate Image
                         </Button>
+                        
+                        {(jobId || (loading && sweepImages)) && (
+                          <Button
+                            variant="outline"
+                            colorScheme="red"
+                            onClick={handleCancel}
+                          >
+                            Cancel
+                          </Button>
+                        )}
                       </VStack>
                     </TabPanel>
                     
                     <TabPanel>
                       <VStack spacing={5} align="stretch">
+                        <FormControl>
+                          <FormLabel fontWeight="medium">
+                            Quality
+                            <Tooltip label="Fast and Standard use a few-step sampler for much quicker results; Full runs 50 steps">
+                              <IconButton
+                                aria-label="Info"
+                                icon={<InfoIcon />}
+                                size="xs"
+                                ml={2}
+                                variant="ghost"
+                              />
+                            </Tooltip>
+                          </FormLabel>
+                          <Select value={quality} onChange={(e) => setQuality(e.target.value)}>
+                            <option value="fast">Fast</option>
+                            <option value="standard">Standard</option>
+                            <option value="full">Full</option>
+                            <option value="custom">Custom steps</option>
+                          </Select>
+                        </FormControl>
+                        
+                        {quality === 'custom' && (
                         <FormControl>
                           <FormLabel fontWeight="medium">
                             Inference Steps: {inferenceSteps}
@@ -315,6 +457,7 @@ const ImageGenerator = () => {
                             <SliderThumb boxSize={6} boxShadow="md" />
                           </Slider>
                         </FormControl>
+                        )}
                         
                         <FormControl>
                           <FormLabel fontWeight="medium">
@@ -377,6 +520,26 @@ const ImageGenerator = () => {
                             Use the same seed to generate similar images
                           </Text>
                         </FormControl>
+                        
+                        <FormControl>
+                          <FormLabel fontWeight="medium">Seed Sweep</FormLabel>
+                          <NumberInput
+                            value={seedCount}
+                            onChange={(_, value) => setSeedCount(Number.isNaN(value) ? 1 : value)}
+                            min={1}
+                            max={16}
+                            focusBorderColor="brand.500"
+                          >
+                            <NumberInputField borderColor={borderColor} />
+                            <NumberInputStepper>
+                              <NumberIncrementStepper />
+                              <NumberDecrementStepper />
+                            </NumberInputStepper>
+                          </NumberInput>
+                          <Text fontSize="sm" color="gray.500" mt={1}>
+                            Generate this many images on consecutive seeds in one batch
+                          </Text>
+                        </FormControl>
                       </VStack>
                     </TabPanel>
                   </TabPanels>
@@ -407,7 +570,37 @@ const ImageGenerator = () => {
                   justifyContent="center"
                   position="relative"
                 >
-                  {loading ? (
+                  {sweepImages && sweepImages.length > 0 ? (
+                    <SimpleGrid
+                      columns={Math.ceil(Math.sqrt(seedCount))}
+                      spacing={1}
+                      w="100%"
+                      h="100%"
+                      overflowY="auto"
+                    >
+                      {sweepImages.map((item) => (
+                        <Tooltip key={item.index} label={`Seed ${item.seed}`}>
+                          <Image
+                            src={item.image}
+                            alt={`Seed ${item.seed}`}
+                            w="100%"
+                            objectFit="contain"
+                            cursor={item.id ? 'pointer' : 'default'}
+                            onClick={() => item.id && handleSelectSweepImage(item)}
+                          />
+                        </Tooltip>
+                      ))}
+                    </SimpleGrid>
+                  ) : loading && preview ? (
+                    <Image
+                      src={preview}
+                      alt="Generation preview"
+                      h="100%"
+                      w="100%"
+                      objectFit="contain"
+                      filter="blur(2px)"
+                    />
+                  ) : loading ? (
                     <Skeleton height="100%" width="100%" />
                   ) : generatedImage ? (
                     <Image
@@ -428,6 +621,17 @@ const ImageGenerator = () => {
                       </Text>
                     </VStack>
                   )}
+                  {loading && progress && progress.total_steps > 0 && (
+                    <Progress
+                      value={(100 * progress.step) / progress.total_steps}
+                      size="sm"
+                      colorScheme="brand"
+                      position="absolute"
+                      bottom={0}
+                      left={0}
+                      right={0}
+                    />
+                  )}
                 </Box>
               </CardBody>
               
@@ -35,7 +35,7 @@ import {
   Tooltip,
 } from '@chakra-ui/react';
 import { InfoIcon, RepeatIcon } from '@chakra-ui/icons';
-import { retrain, getTrainingStatus } from './api';
+import { retrain, getTrainingStatus, cancelTraining, resumeTraining } from './api';
 
 const RetrainModel = () => {
   const [learningRate, setLearningRate] = useState(0.00001);
@@ -47,6 +47,17 @@ const RetrainModel = () => {
   
   const toast = useToast();
   
+  // Pick up a run that is already in progress, or one that can be resumed
+  useEffect(() => {
+    getTrainingStatus()
+      .then((status) => {
+        setTrainingStatus(status);
+        setProgress(status.progress || 0);
+        setIsTraining(Boolean(status.active));
+      })
+      .catch((error) => console.error('Error fetching training status:', error));
+  }, []);
+  
   useEffect(() => {
     // Polling for training status
     let interval;
@@ -67,11 +78,24 @@ const RetrainModel = () => {
             
             toast({
               title: 'Training Complete',
-              description: 'The model has been successfully retrained',
+              description: status.model
+                ? `The retrained model is available as "${status.model}"`
+                : 'The model has been successfully retrained',
               status: 'success',
               duration: 5000,
               isClosable: true,
             });
+          } else if (status && !status.active) {
+            setIsTraining(false);
+            clearInterval(interval);
+            
+            toast({
+              title: status.state === 'cancelled' ? 'Training Cancelled' : 'Training Failed',
+              description: status.error || 'Training stopped; it can be resumed from its last checkpoint',
+              status: status.state === 'cancelled' ? 'info' : 'error',
+              duration: 5000,
+              isClosable: true,
+            });
           }
         } catch (error) {
           console.error('Error fetching training status:', error);
@@ -119,6 +143,39 @@ const RetrainModel = () => {
     }
   };
   
+  const handleCancelTraining = async () => {
+    try {
+      setTrainingStatus(await cancelTraining());
+    } catch (error) {
+      toast({
+        title: 'Error',
+        description: error.message || 'Failed to cancel training',
+        status: 'error',
+        duration: 5000,
+        isClosable: true,
+      });
+    }
+  };
+  
+  const handleResumeTraining = async () => {
+    try {
+      const status = await resumeTraining();
+      setTrainingStatus(status);
+      setProgress(status.progress || 0);
+      setIsTraining(true);
+    } catch (error) {
+      toast({
+        title: 'Error',
+        description: error.message || 'Failed to resume training',
+        status: 'error',
+        duration: 5000,
+        isClosable: true,
+      });
+    }
+  };
+  
+  const canResume = !isTraining && ['cancelled', 'failed'].includes(trainingStatus?.state);
+  
   const formatLearningRate = (val) => {
     return `${val.toExponential(5)}`;
   };
@@ -237,13 +294,36 @@ const RetrainModel = () => {
               <Text fontWeight="bold">Training Progress</Text>
               <Progress value={progress} size="sm" colorScheme="blue" />
               <HStack>
-                <Text>Epoch: {trainingStatus?.current_epoch || 0}/{numEpochs}</Text>
+                <Text>Epoch: {trainingStatus?.current_epoch || 0}/{trainingStatus?.total_epochs || numEpochs}</Text>
+                <Text>Step: {trainingStatus?.step || 0}/{trainingStatus?.total_steps || '?'}</Text>
                 <Text>Loss: {trainingStatus?.current_loss?.toFixed(4) || 'N/A'}</Text>
+                <Text>{trainingStatus?.samples_per_second?.toFixed(2) || 0} images/s</Text>
               </HStack>
+              <Button
+                size="sm"
+                variant="outline"
+                colorScheme="red"
+                onClick={handleCancelTraining}
+                isDisabled={trainingStatus?.cancel_requested}
+              >
+                {trainingStatus?.cancel_requested ? 'Stopping...' : 'Cancel'}
+              </Button>
             </VStack>
           </Box>
         )}
         
+        {canResume && (
+          <Alert status="warning" borderRadius="md">
+            <AlertIcon />
+            <AlertDescription flex="1">
+              The last training run was {trainingStatus.state} at step {trainingStatus.step || 0}.
+            </AlertDescription>
+            <Button size="sm" onClick={handleResumeTraining}>
+              Resume
+            </Button>
+          </Alert>
+        )}
+        
         <Button
           leftIcon={<RepeatIcon />}
           colorScheme="blue"
@@ -31,6 +31,117 @@ export const generateVariations = async (params) => {
   }
 };
 
+// Submit a generation job and return its id without waiting for the result
+export const submitGenerateJob = async (params) => {
+  try {
+    const response = await api.post('/generate', { ...params, async: true });
+    return response.data;
+  } catch (error) {
+    throw handleApiError(error);
+  }
+};
+
+// Get the state, progress and result of a job
+export const getJob = async (jobId) => {
+  try {
+    const response = await api.get(`/jobs/${jobId}`);
+    return response.data;
+  } catch (error) {
+    throw handleApiError(error);
+  }
+};
+
+// Cancel a queued or running job
+export const cancelJob = async (jobId) => {
+  try {
+    const response = await api.post(`/jobs/${jobId}/cancel`);
+    return response.data;
+  } catch (error) {
+    throw handleApiError(error);
+  }
+};
+
+// Subscribe to progress events of a job, returning a function that closes the stream.
+// onPreview receives { step, image } previews when the job was submitted with preview_every;
+// with cancelOnClose the server cancels the job if the stream closes before it finishes.
+export const subscribeToJob = (jobId, onUpdate, { onPreview, cancelOnClose = false } = {}) => {
+  const query = cancelOnClose ? '?cancel_on_close=1' : '';
+  const source = new EventSource(`${API_BASE_URL}/jobs/${jobId}/events${query}`);
+  const handleEvent = (event) => {
+    const job = JSON.parse(event.data);
+    onUpdate(job);
+    if (['succeeded', 'failed', 'cancelled'].includes(job.state)) {
+      source.close();
+    }
+  };
+  ['queued', 'running', 'succeeded', 'failed', 'cancelled'].forEach((state) => {
+    source.addEventListener(state, handleEvent);
+  });
+  if (onPreview) {
+    source.addEventListener('preview', (event) => onPreview(JSON.parse(event.data)));
+  }
+  return () => source.close();
+};
+
+// Generate a grid of images, such as one prompt across several seeds, streaming each chunk as it finishes.
+// onImages receives the finished items, each with its grid index; onDone receives the stored image ids
+// in grid order and the contact sheet, if asked for. Returns a function that stops the stream.
+export const streamBatch = (params, { onImages, onDone, onError }) => {
+  const controller = new AbortController();
+  let finished = false;
+  const handleEvent = (name, data) => {
+    if (name === 'images') {
+      onImages(data);
+    } else if (name === 'done') {
+      finished = true;
+      onDone(data);
+    } else if (name === 'error') {
+      finished = true;
+      onError(data.error);
+    }
+  };
+
+  (async () => {
+    // EventSource can only make GET requests, so read the event stream from fetch
+    const response = await fetch(`${API_BASE_URL}/generate/batch`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', Accept: 'text/event-stream' },
+      body: JSON.stringify({ ...params, stream: true }),
+      signal: controller.signal,
+    });
+    if (!response.ok) {
+      const body = await response.json().catch(() => ({}));
+      throw new Error(body.error || `Error: ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const events = buffer.split('\n\n');
+      buffer = events.pop();
+      events.forEach((event) => {
+        let name = 'message';
+        let data = '';
+        event.split('\n').forEach((line) => {
+          if (line.startsWith('event: ')) name = line.slice(7);
+          else if (line.startsWith('data: ')) data += line.slice(6);
+        });
+        if (data) handleEvent(name, JSON.parse(data));
+      });
+    }
+    // A server crash or a proxy cutting the connection ends the stream without either event
+    if (!finished) throw new Error('The stream ended before the batch finished');
+  })().catch((error) => {
+    if (error.name !== 'AbortError') onError(error.message);
+  });
+
+  return () => controller.abort();
+};
+
 // Get list of images
 export const getImages = async (limit = 20, offset = 0) => {
   try {
@@ -43,6 +154,18 @@ export const getImages = async (limit = 20, offset = 0) => {
   }
 };
 
+// Get a page of gallery thumbnails, starting after the given cursor
+export const getImageThumbnails = async (limit = 20, cursor = null, filters = {}) => {
+  try {
+    const response = await api.get('/images', {
+      params: { view: 'thumbnails', limit, cursor, ...filters },
+    });
+    return response.data;
+  } catch (error) {
+    throw handleApiError(error);
+  }
+};
+
 // Get image details by ID
 export const getImageDetails = async (id) => {
   try {
@@ -76,6 +199,26 @@ export const retrain = async (params) => {
   }
 };
 
+// Resume the last cancelled or failed training run
+export const resumeTraining = async () => {
+  try {
+    const response = await api.post('/retrain/resume');
+    return response.data;
+  } catch (error) {
+    throw handleApiError(error);
+  }
+};
+
+// Cancel the running training run, keeping a checkpoint to resume from
+export const cancelTraining = async () => {
+  try {
+    const response = await api.post('/retrain/cancel');
+    return response.data;
+  } catch (error) {
+    throw handleApiError(error);
+  }
+};
+
 // Get training status
 export const getTrainingStatus = async () => {
   try {